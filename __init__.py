@@ -3,12 +3,13 @@ import yaml
 import os
 import imp
 import logging
-from src import annotation_dispatcher, annotation_worker
-from src import generation_dispatcher, generation_worker
-from src import classification_dispatcher, classification_worker
+import threading
 
 __name__ = "bayzee"
 
+# stage modules (and their dependencies like orange) are imported by the functions below
+# only when the stage runs, so that workers start without loading the other stages
+
 def __loadConfig(configFilePath):
   config = None
   if not os.path.exists(configFilePath):
@@ -30,6 +31,8 @@ def __loadProcessors(configFilePath, config):
     modulePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), module["path"]))
     processorInstances.append(imp.load_source(module["name"], modulePath))
   config["processor_instances"] = processorInstances
+  if "modelCacheDir" in config["processor"]:
+    config["processor"]["modelCacheDir"] = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["processor"]["modelCacheDir"]))
 
 def __initLogger(configFilePath, config):
   logsDir = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["logger"]["logsDir"]))
@@ -49,6 +52,9 @@ def __initLogger(configFilePath, config):
   logger.addHandler(ch)
   config["logger"] = logger
 
+  if "metrics" in config and "dir" in config["metrics"]:
+    config["metrics"]["dir"] = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["metrics"]["dir"]))
+
   logger = logging.getLogger("elasticsearch")
   fh = logging.FileHandler(logsDir + "/elasticsearch.log")
   formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -65,78 +71,168 @@ def __initLogger(configFilePath, config):
   fh.setFormatter(formatter)
   logger.addHandler(fh)
 
+# runs numWorkers worker processes under a supervisor, or a single worker in this process
+def __runWorkers(config, stage, createWorker, runWorker, numWorkers):
+  if numWorkers <= 1:
+    runWorker(createWorker())
+    return
+  from src import worker_supervisor
+  supervisor = worker_supervisor.WorkerSupervisor(config, stage, createWorker, runWorker, numWorkers)
+  supervisor.supervise()
+
+# loads the classification model once, for the worker processes of a supervisor to share
+def __loadModel(config):
+  from src import classification_model
+  try:
+    config["classification_model"] = classification_model.load(config["classifier"]["modelFilePath"], classification_model.getFeatures(config))
+  except:
+    error = sys.exc_info()
+    config["logger"].error("Failed to load classification model, run 'bin/dispatcher -t' first: " + str(error))
+    sys.exit(1)
+
+def __resolveModelFilePath(configFilePath, config):
+  config["classifier"]["modelFilePath"] = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["classifier"]["modelFilePath"]))
+
 def dispatchToAnnotate(configFilePath, processingStartIndex, processingEndIndex):
   config = __loadConfig(configFilePath)
   __loadProcessors(configFilePath, config)
   __initLogger(configFilePath, config)
 
+  from src import annotation_dispatcher
   ann = annotation_dispatcher.AnnotationDispatcher(config, processingStartIndex, processingEndIndex)
   ann.dispatchToAnnotate()
 
-def annotate(configFilePath):
+def annotate(configFilePath, numWorkers = 1):
   config = __loadConfig(configFilePath)
   __loadProcessors(configFilePath, config)
   __initLogger(configFilePath, config)
 
-  ann = annotation_worker.AnnotationWorker(config)
-  ann.annotate()
+  from src import annotation_worker
+  __runWorkers(config, "annotation", lambda: annotation_worker.AnnotationWorker(config), lambda x: x.annotate(), numWorkers)
 
 def dispatchToGenerate(configFilePath, processingStartIndex, processingEndIndex):
   config = __loadConfig(configFilePath)
   __loadProcessors(configFilePath, config)
   __initLogger(configFilePath, config)
 
+  from src import generation_dispatcher
+  gen = generation_dispatcher.GenerationDispatcher(config, processingStartIndex, processingEndIndex)
+  gen.dispatchToGenerate()
+
+def generate(configFilePath, numWorkers = 1):
+  config = __loadConfig(configFilePath)
+  __loadProcessors(configFilePath, config)
+  __initLogger(configFilePath, config)
+
+  from src import generation_worker
+  __runWorkers(config, "generation", lambda: generation_worker.GenerationWorker(config), lambda x: x.generate(), numWorkers)
+
+def label(configFilePath):
+  config = __loadConfig(configFilePath)
+  __initLogger(configFilePath, config)
+
   trainingFilePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["generator"]["trainingPhrasesFilePath"]))
   holdOutFilePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["generator"]["holdOutPhrasesFilePath"]))
-  trainingFile = open(trainingFilePath, "r")
-  holdOutFile = open(holdOutFilePath, "r")
 
-  trainingDataset = {}
-  for row in trainingFile.readlines()[1:]:
-    values = row.split(",")
-    trainingDataset[values[0]] = values[1]
+  from src import phrase_labeler
+  lbl = phrase_labeler.PhraseLabeler(config, trainingFilePath, holdOutFilePath)
+  lbl.label()
 
-  holdOutDataset = {}
-  for row in holdOutFile.readlines()[1:]:
-    values = row.split(",")
-    holdOutDataset[values[0]] = values[1]
+def train(configFilePath):
+  config = __loadConfig(configFilePath)
+  __resolveModelFilePath(configFilePath, config)
+  __initLogger(configFilePath, config)
 
-  gen = generation_dispatcher.GenerationDispatcher(config, trainingDataset, holdOutDataset, processingStartIndex, processingEndIndex)
-  gen.dispatchToGenerate()
+  from src import classification_trainer
+  trn = classification_trainer.ClassificationTrainer(config)
+  trn.train()
 
-def generate(configFilePath):
+def evaluate(configFilePath):
   config = __loadConfig(configFilePath)
-  __loadProcessors(configFilePath, config)
   __initLogger(configFilePath, config)
 
-  trainingFilePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["generator"]["trainingPhrasesFilePath"]))
-  holdOutFilePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["generator"]["holdOutPhrasesFilePath"]))
-  trainingFile = open(trainingFilePath, "r")
-  holdOutFile = open(holdOutFilePath, "r")
-  
-  trainingDataset = {}
-  for row in trainingFile.readlines()[1:]:
-    values = row.split(",")
-    trainingDataset[values[0]] = values[1]
-
-  holdOutDataset = {}
-  for row in holdOutFile.readlines()[1:]:
-    values = row.split(",")
-    holdOutDataset[values[0]] = values[1]
-
-  gen = generation_worker.GenerationWorker(config, trainingDataset, holdOutDataset)
-  gen.generate()
+  from src import classification_evaluator
+  evl = classification_evaluator.ClassificationEvaluator(config)
+  evl.evaluate()
 
 def dispatchToClassify(configFilePath, processingStartIndex, processingEndIndex):
   config = __loadConfig(configFilePath)
   __initLogger(configFilePath, config)
 
+  from src import classification_dispatcher
   cls = classification_dispatcher.ClassificationDispatcher(config, processingStartIndex, processingEndIndex)
   cls.dispatchToClassify()
 
-def classify(configFilePath):
+def classify(configFilePath, numWorkers = 1):
+  config = __loadConfig(configFilePath)
+  __resolveModelFilePath(configFilePath, config)
+  __initLogger(configFilePath, config)
+
+  from src import classification_worker
+  if numWorkers > 1: __loadModel(config)
+  __runWorkers(config, "classification", lambda: classification_worker.ClassificationWorker(config), lambda x: x.classify(), numWorkers)
+
+def dispatchToStream(configFilePath):
   config = __loadConfig(configFilePath)
   __initLogger(configFilePath, config)
 
-  cls = classification_worker.ClassificationWorker(config)
-  cls.classify()
\ No newline at end of file
+  from src import stream_dispatcher
+  stm = stream_dispatcher.StreamDispatcher(config, sys.stdin)
+  stm.dispatchToStream()
+
+def stream(configFilePath, numWorkers = 1):
+  config = __loadConfig(configFilePath)
+  __loadProcessors(configFilePath, config)
+  __resolveModelFilePath(configFilePath, config)
+  __initLogger(configFilePath, config)
+
+  from src import stream_worker
+  if numWorkers > 1: __loadModel(config)
+  __runWorkers(config, "stream", lambda: stream_worker.StreamWorker(config), lambda x: x.stream(), numWorkers)
+
+# runs the dispatcher and a worker of each stage, in order, in this process with the "local" transport.
+# stages are any of "annotate", "generate", "label", "train" and "classify"
+def run(configFilePath, stages):
+  config = __loadConfig(configFilePath)
+  __loadProcessors(configFilePath, config)
+  __resolveModelFilePath(configFilePath, config)
+  __initLogger(configFilePath, config)
+  config["transport"] = "local"
+  # the dispatchers and workers of the stages can't all serve their metrics on one port
+  if "metrics" in config: config["metrics"]["port"] = 0
+
+  if "annotate" in stages:
+    from src import annotation_dispatcher
+    from src import annotation_worker
+    __runLocally(config, lambda: annotation_dispatcher.AnnotationDispatcher(config, None, None), lambda x: x.dispatchToAnnotate(), lambda: annotation_worker.AnnotationWorker(config), lambda x: x.annotate())
+  if "generate" in stages:
+    from src import generation_dispatcher
+    from src import generation_worker
+    __runLocally(config, lambda: generation_dispatcher.GenerationDispatcher(config, None, None), lambda x: x.dispatchToGenerate(), lambda: generation_worker.GenerationWorker(config), lambda x: x.generate())
+  if "label" in stages:
+    from src import phrase_labeler
+    trainingFilePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["generator"]["trainingPhrasesFilePath"]))
+    holdOutFilePath = os.path.abspath(os.path.join(os.path.dirname(configFilePath), config["generator"]["holdOutPhrasesFilePath"]))
+    phrase_labeler.PhraseLabeler(config, trainingFilePath, holdOutFilePath).label()
+  if "train" in stages:
+    from src import classification_trainer
+    classification_trainer.ClassificationTrainer(config).train()
+  if "classify" in stages:
+    from src import classification_dispatcher
+    from src import classification_worker
+    __runLocally(config, lambda: classification_dispatcher.ClassificationDispatcher(config, None, None), lambda x: x.dispatchToClassify(), lambda: classification_worker.ClassificationWorker(config), lambda x: x.classify())
+
+# runs a worker in a thread while the dispatcher dispatches, the dispatcher is created first since it may
+# set up the indices the worker reads
+def __runLocally(config, createDispatcher, dispatch, createWorker, runWorker):
+  from src import transport
+  dispatcher = createDispatcher()
+  worker = createWorker()
+  workerThread = threading.Thread(target=runWorker, args=(worker,))
+  workerThread.daemon = True
+  workerThread.start()
+  dispatch(dispatcher)
+  # a worker that got no message never hears that the dispatcher is done
+  transport.DurableChannel("bayzee.local", config).send("kill", worker.workerName)
+  while workerThread.isAlive():
+    workerThread.join(1)
\ No newline at end of file
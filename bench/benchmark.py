@@ -0,0 +1,147 @@
+import os
+import os.path
+import imp
+import time
+import shutil
+import logging
+import tempfile
+import yaml
+from bench import fake_channels
+from bench.corpus import SyntheticCorpus
+from bench.fake_elasticsearch import FakeElasticsearch
+
+__name__ = "benchmark"
+
+DISPATCHER_NAME = "bayzee.benchmark.dispatcher"
+
+# Runs the annotation, generation and classification workers over a synthetic corpus held by an
+# in-memory Elasticsearch, with in-memory muppet channels and Redis, and measures their throughput
+# and the number of Elasticsearch calls they make per item.
+class Benchmark:
+
+  def __init__(self, configFilePath, numDocuments, batchSize = None, stages = None, loadProcessors = True, overrides = None, verbose = False):
+    fake_channels.install()
+    self.tempDir = tempfile.mkdtemp(prefix="bayzee-benchmark-")
+    self.config = self.__loadConfig(configFilePath, loadProcessors, verbose)
+    if overrides != None:
+      for key, value in overrides.iteritems():
+        section = self.config
+        path = key.split(".")
+        for name in path[:-1]:
+          section = section[name]
+        section[path[-1]] = value
+    self.batchSize = batchSize
+    if self.batchSize == None:
+      self.batchSize = 1
+      if "dispatchBatchSize" in self.config: self.batchSize = self.config["dispatchBatchSize"]
+    self.stages = stages
+    if self.stages == None: self.stages = ["annotate", "generate", "classify"]
+    self.corpus = SyntheticCorpus(numDocuments, self.config["corpus"]["text_fields"])
+    self.esClient = FakeElasticsearch(self.config["generator"]["minShingleSize"], self.config["generator"]["maxShingleSize"])
+    # the stages get the fake client from es_client.getClient
+    self.config["es_client"] = self.esClient
+    self.config["es_client_pid"] = os.getpid()
+    self.processorIndex = self.config["processor"]["index"]
+    self.processorPhraseType = self.config["processor"]["type"] + "__phrase"
+
+  def __loadConfig(self, configFilePath, loadProcessors, verbose):
+    configFile = open(configFilePath, "r")
+    config = yaml.load(configFile)
+    configFile.close()
+    configDir = os.path.dirname(configFilePath)
+    processorInstances = []
+    if loadProcessors:
+      for module in config["processor"]["modules"]:
+        processorInstances.append(imp.load_source(module["name"], os.path.abspath(os.path.join(configDir, module["path"]))))
+    else:
+      config["processor"]["modules"] = []
+    config["processor_instances"] = processorInstances
+    if "modelCacheDir" in config["processor"]:
+      config["processor"]["modelCacheDir"] = os.path.abspath(os.path.join(configDir, config["processor"]["modelCacheDir"]))
+    config["classifier"]["modelFilePath"] = os.path.join(self.tempDir, "classifier.model")
+    config.pop("metrics", None)
+    logger = logging.getLogger("bayzee.benchmark")
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.WARNING)
+    if verbose: logger.setLevel(logging.INFO)
+    config["logger"] = logger
+    return config
+
+  def run(self):
+    self.esClient.load(self.config["corpus"]["index"], self.config["corpus"]["type"], self.corpus.documents())
+    results = []
+    try:
+      for stage in ["annotate", "generate", "classify"]:
+        if stage not in self.stages: continue
+        if stage == "annotate": result = self.__annotate()
+        elif stage == "generate": result = self.__generate()
+        else: result = self.__classify()
+        self.__report(result)
+        results.append(result)
+    finally:
+      shutil.rmtree(self.tempDir, True)
+    return results
+
+  def __annotate(self):
+    from src import annotation_worker
+    documentIds = sorted(self.esClient.store[self.config["corpus"]["index"]][self.config["corpus"]["type"]].keys())
+    result = self.__runWorker("annotate", "bayzee.annotation.worker", "documentIds", "failedDocumentIds", documentIds, lambda: annotation_worker.AnnotationWorker(self.config), lambda x: x.annotate())
+    result["unit"] = "documents"
+    result["phrases"] = len(self.__phraseIds())
+    return result
+
+  def __generate(self):
+    from src import generation_worker
+    result = self.__runWorker("generate", "bayzee.generation.worker", "phraseIds", "failedPhraseIds", self.__phraseIds(), lambda: generation_worker.GenerationWorker(self.config), lambda x: x.generate())
+    result["unit"] = "phrases"
+    return result
+
+  # labels the phrases after the synthetic corpus' domain words and trains a model before classifying
+  def __classify(self):
+    from src import classification_trainer
+    from src import classification_worker
+    phrases = self.esClient.store[self.processorIndex][self.processorPhraseType]
+    for i, phraseId in enumerate(self.__phraseIds()):
+      label = self.corpus.label(phrases[phraseId]["phrase"])
+      if i % 5 < 3: phrases[phraseId]["is_training"] = label
+      elif i % 5 == 3: phrases[phraseId]["is_holdout"] = label
+    classification_trainer.ClassificationTrainer(self.config).train()
+    result = self.__runWorker("classify", "bayzee.classification.worker", "phraseIds", "failedPhraseIds", self.__phraseIds(), lambda: classification_worker.ClassificationWorker(self.config), lambda x: x.classify())
+    result["unit"] = "phrases"
+    return result
+
+  def __phraseIds(self):
+    return sorted(self.esClient.store.get(self.processorIndex, {}).get(self.processorPhraseType, {}).keys())
+
+  def __runWorker(self, messageType, workerName, itemsKey, failedItemsKey, itemIds, createWorker, runWorker):
+    fake_channels.broker = fake_channels.FakeBroker()
+    for i in range(0, len(itemIds), self.batchSize):
+      content = {itemsKey: itemIds[i:i + self.batchSize], "type": messageType, "count": 1, "from": DISPATCHER_NAME}
+      fake_channels.broker.send(content, workerName, DISPATCHER_NAME)
+    fake_channels.broker.dyingChannels = [DISPATCHER_NAME]
+    worker = createWorker()
+    self.esClient.transport.reset()
+    start = time.time()
+    runWorker(worker)
+    seconds = time.time() - start
+    replies = fake_channels.broker.replies.get(DISPATCHER_NAME, [])
+    return {
+      "stage": messageType,
+      "items": sum(map(lambda x: len(x[itemsKey]), replies)),
+      "failed": sum(map(lambda x: len(x[failedItemsKey]), replies)),
+      "seconds": seconds,
+      "messages": len(replies),
+      "esCalls": dict(map(lambda x: (x[0], x[1]["count"]), self.esClient.transport.stats.iteritems()))
+    }
+
+  def __report(self, result):
+    items = max(result["items"] + result["failed"], 1)
+    seconds = max(result["seconds"], 0.000001)
+    line = result["stage"] + ": " + str(result["items"]) + " " + result["unit"] + " (" + str(result["failed"]) + " failed) in " + str(round(seconds, 2)) + "s, "
+    line += str(round(result["items"] / seconds, 1)) + " " + result["unit"] + "/sec"
+    if "phrases" in result:
+      line += ", " + str(result["phrases"]) + " phrases (" + str(round(result["phrases"] / seconds, 1)) + " phrases/sec)"
+    print line
+    totalCalls = sum(result["esCalls"].values())
+    calls = map(lambda x: x[0] + " " + str(round(x[1] * 1.0 / items, 3)), sorted(result["esCalls"].iteritems()))
+    print "  Elasticsearch calls per " + result["unit"][:-1] + ": " + str(round(totalCalls * 1.0 / items, 3)) + " (" + ", ".join(calls) + ")"
@@ -0,0 +1,52 @@
+import random
+
+__name__ = "corpus"
+
+STOP_WORDS = ["a", "an", "and", "are", "as", "at", "be", "by", "for", "in", "is", "it", "of", "on", "or", "the", "this", "to", "with"]
+SYLLABLES = ["ba", "co", "da", "fe", "gi", "ka", "lo", "ma", "ne", "po", "ra", "si", "ta", "vu", "xe", "zo", "tri", "pla", "gro", "ster"]
+
+# Synthetic corpus with a Zipf-like word distribution, so that some phrases occur in many documents
+# and most in few, like in real text. The same seed always generates the same corpus.
+class SyntheticCorpus:
+
+  def __init__(self, numDocuments, fields, vocabularySize = 5000, seed = 42):
+    self.numDocuments = numDocuments
+    self.fields = fields
+    self.random = random.Random(seed)
+    words = set()
+    while len(words) < vocabularySize:
+      numSyllables = self.random.randint(1, 4)
+      words.add("".join(map(lambda x: self.random.choice(SYLLABLES), range(numSyllables))))
+    self.words = sorted(words)
+    self.random.shuffle(self.words)
+    # words that make a phrase relevant to the domain, used to label phrases
+    self.domainWords = set(self.words[10:60])
+
+  def __word(self):
+    if self.random.random() < 0.25:
+      return self.random.choice(STOP_WORDS)
+    return self.words[int(len(self.words) * self.random.random() ** 3)]
+
+  def __sentence(self):
+    words = map(lambda x: self.__word(), range(self.random.randint(5, 20)))
+    if self.random.random() < 0.1:
+      words.insert(self.random.randint(0, len(words)), str(self.random.randint(1, 500)))
+    sentence = " ".join(words)
+    return sentence[0].upper() + sentence[1:] + "."
+
+  def __text(self):
+    return " ".join(map(lambda x: self.__sentence(), range(self.random.randint(3, 12))))
+
+  # yields (document id, document source)
+  def documents(self):
+    for i in range(self.numDocuments):
+      source = {}
+      for field in self.fields:
+        source[field] = self.__text()
+      yield "doc-" + str(i).zfill(8), source
+
+  # "1" when the phrase contains a domain word, "0" otherwise
+  def label(self, phrase):
+    for word in phrase.split():
+      if word in self.domainWords: return "1"
+    return "0"
@@ -0,0 +1,88 @@
+import sys
+import types
+from src.local_redis import LocalRedis
+
+__name__ = "fake_channels"
+
+# In-memory message broker behind the fake muppet channels. Messages are delivered in the order
+# they are sent. When a channel receives while its queue is empty, the broker tells the listeners
+# of every remote channel in 'dyingChannels' that it is dying, the way a dispatcher does when it is
+# done, which makes workers send themselves the "kill" message.
+class FakeBroker:
+
+  def __init__(self):
+    self.queues = {}
+    self.listeners = {}
+    self.replies = {}
+    self.dyingChannels = []
+    self.nextRequestId = 0
+    self.messagesSent = 0
+
+  def send(self, content, to, sender):
+    self.nextRequestId += 1
+    self.messagesSent += 1
+    self.queues.setdefault(to, []).append({"requestId": self.nextRequestId, "content": content, "from": sender})
+
+  def receive(self, name):
+    queue = self.queues.setdefault(name, [])
+    if len(queue) == 0:
+      dyingChannels = self.dyingChannels
+      self.dyingChannels = []
+      for channelName in dyingChannels:
+        self.broadcast(channelName, "dying")
+    if len(queue) == 0:
+      raise Exception("Channel '" + name + "' would wait forever for a message")
+    return queue.pop(0)
+
+  def reply(self, message, content):
+    self.messagesSent += 1
+    self.replies.setdefault(message["content"]["from"], []).append(content)
+
+  def broadcast(self, name, message):
+    for callback in list(self.listeners.get(name, [])):
+      callback(name, message)
+
+broker = FakeBroker()
+
+class DurableChannel:
+
+  def __init__(self, name, config, timeoutCallback = None):
+    self.name = name
+
+  def send(self, content, to, timeout = None):
+    broker.send(content, to, self.name)
+
+  def receive(self):
+    return broker.receive(self.name)
+
+  def reply(self, message, content, timeout = None):
+    broker.reply(message, content)
+
+  def close(self, message):
+    pass
+
+  def end(self):
+    pass
+
+class RemoteChannel:
+
+  def __init__(self, name, config):
+    self.name = name
+
+  def send(self, message):
+    broker.broadcast(self.name, message)
+
+  def listen(self, callback):
+    broker.listeners.setdefault(self.name, []).append(callback)
+
+redisClient = LocalRedis()
+
+# replaces the muppet and redis modules, must run before the stages are imported
+def install():
+  muppet = types.ModuleType("muppet")
+  muppet.DurableChannel = DurableChannel
+  muppet.RemoteChannel = RemoteChannel
+  sys.modules["muppet"] = muppet
+  redis = types.ModuleType("redis")
+  redis.StrictRedis = lambda *args, **kwargs: redisClient
+  sys.modules["redis"] = redis
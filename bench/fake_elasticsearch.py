@@ -0,0 +1,447 @@
+import copy
+import json
+import math
+import time
+import threading
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.serializer import JSONSerializer
+from src.shingle_analyzer import ShingleAnalyzer
+
+__name__ = "fake_elasticsearch"
+
+# Stand-in for the transport of a real client: counts the calls made per operation in the same
+# format as es_client.InstrumentedTransport, so es_client.formatStats works
+class FakeTransport:
+
+  def __init__(self):
+    self.serializer = JSONSerializer()
+    self.stats = {}
+    self.statsLock = threading.Lock()
+
+  def record(self, operation, duration, failed):
+    with self.statsLock:
+      if operation not in self.stats:
+        self.stats[operation] = {"count": 0, "errors": 0, "totalTime": 0.0, "maxTime": 0.0}
+      stats = self.stats[operation]
+      stats["count"] += 1
+      if failed: stats["errors"] += 1
+      stats["totalTime"] += duration
+      if duration > stats["maxTime"]: stats["maxTime"] = duration
+
+  def calls(self):
+    return sum(map(lambda x: x["count"], self.stats.values()))
+
+  def reset(self):
+    self.stats = {}
+
+class FakeIndices:
+
+  def __init__(self, client):
+    self.client = client
+
+  def exists(self, index, **kwargs):
+    self.client.record("exists")
+    return index in self.client.store
+
+  def create(self, index, body = None, **kwargs):
+    self.client.record("create_index")
+    self.client.store.setdefault(index, {})
+    return {"acknowledged": True}
+
+  def delete(self, index, **kwargs):
+    self.client.record("delete_index")
+    self.client.store.pop(index, None)
+    return {"acknowledged": True}
+
+  def put_mapping(self, index, doc_type, body, **kwargs):
+    self.client.record("mapping")
+    self.client.store.setdefault(index, {}).setdefault(doc_type, {})
+    return {"acknowledged": True}
+
+  def refresh(self, index = None, **kwargs):
+    self.client.record("refresh")
+    return {"_shards": {}}
+
+  # every analyzer behaves like the 'analyzer_shingle' analyzer created by the annotation dispatcher
+  def analyze(self, index = None, body = None, analyzer = None, **kwargs):
+    self.client.record("analyze")
+    return self.client.analyzer.analyze(body)
+
+# In-memory Elasticsearch with the subset of the client API bayzee uses. Queries support match_all,
+# term, terms, match_phrase, bool/should and filtered/exists, which is all the stages send. Scores of
+# phrase queries use the classic TF-IDF formula and explanations contain the tf(freq=...) entries
+# the generation worker parses. Text fields are analyzed with the standard tokenizer and lowercase
+# filter, or with the function of 'fieldAnalyzers' that returns the (term, position) pairs of a text.
+class FakeElasticsearch:
+
+  def __init__(self, minShingleSize, maxShingleSize, fieldAnalyzers = None):
+    self.transport = FakeTransport()
+    self.indices = FakeIndices(self)
+    self.analyzer = ShingleAnalyzer(minShingleSize, maxShingleSize)
+    self.fieldAnalyzers = fieldAnalyzers
+    if self.fieldAnalyzers == None: self.fieldAnalyzers = {}
+    self.store = {}
+    self.scrolls = {}
+    self.nextScrollId = 0
+    # (term, position) pairs of the text fields of each document, and the documents containing each term, by (index, type)
+    self.tokenCache = {}
+    self.invertedIndexes = {}
+    # version of each document by (index, type, id), incremented on every write like in Elasticsearch
+    self.versions = {}
+
+  def record(self, operation):
+    self.transport.record(operation, 0.0, False)
+
+  def __documents(self, index, docType):
+    return self.store.setdefault(index, {}).setdefault(docType, {})
+
+  def __changed(self, index, docType, id):
+    if id in self.__documents(index, docType):
+      self.versions[(index, docType, id)] = self.versions.get((index, docType, id), 0) + 1
+    else:
+      self.versions.pop((index, docType, id), None)
+    self.tokenCache.pop((index, docType, id), None)
+    self.invertedIndexes.pop((index, docType), None)
+
+  def __hit(self, index, docType, id, source, fields = None, sourceInclude = None):
+    hit = {"_index": index, "_type": docType, "_id": id, "_version": self.versions.get((index, docType, id), 1), "found": True}
+    if fields != None:
+      hit["fields"] = {}
+      for field in fields:
+        if field in source:
+          value = source[field]
+          if type(value) is not list: value = [value]
+          hit["fields"][field] = copy.deepcopy(value)
+    elif sourceInclude != None:
+      hit["_source"] = dict(map(lambda x: (x, copy.deepcopy(source[x])), filter(lambda x: x in source, sourceInclude)))
+    else:
+      hit["_source"] = copy.deepcopy(source)
+    return hit
+
+  def load(self, index, docType, documents):
+    for id, source in documents:
+      self.__documents(index, docType)[id] = source
+      self.__changed(index, docType, id)
+
+  def get(self, index, doc_type, id, fields = None, _source_include = None, **kwargs):
+    self.record("get")
+    documents = self.__documents(index, doc_type)
+    if id not in documents:
+      raise NotFoundError(404, "document missing", {"_index": index, "_type": doc_type, "_id": id, "found": False})
+    return self.__hit(index, doc_type, id, documents[id], fields, _source_include)
+
+  def mget(self, body, index, doc_type, fields = None, _source_include = None, **kwargs):
+    self.record("mget")
+    documents = self.__documents(index, doc_type)
+    docs = []
+    for id in body["ids"]:
+      if id in documents:
+        docs.append(self.__hit(index, doc_type, id, documents[id], fields, _source_include))
+      else:
+        docs.append({"_index": index, "_type": doc_type, "_id": id, "found": False})
+    return {"docs": docs}
+
+  def exists(self, index, doc_type, id, **kwargs):
+    self.record("exists")
+    return id in self.__documents(index, doc_type)
+
+  def index(self, index, doc_type, body, id, **kwargs):
+    self.record("index")
+    self.__documents(index, doc_type)[id] = copy.deepcopy(body)
+    self.__changed(index, doc_type, id)
+    return {"_index": index, "_type": doc_type, "_id": id, "created": True}
+
+  def update(self, index, doc_type, id, body, **kwargs):
+    self.record("update")
+    status, error = self.__update(index, doc_type, id, body)
+    if status == 404:
+      raise NotFoundError(404, error, {"_id": id})
+    return {"_index": index, "_type": doc_type, "_id": id}
+
+  def __update(self, index, doc_type, id, body):
+    documents = self.__documents(index, doc_type)
+    if id not in documents:
+      if not body.get("doc_as_upsert", False):
+        return 404, "DocumentMissingException[[" + index + "][" + id + "]: document missing]"
+      documents[id] = {}
+    documents[id].update(copy.deepcopy(body["doc"]))
+    self.__changed(index, doc_type, id)
+    return 200, None
+
+  def delete(self, index, doc_type, id, **kwargs):
+    self.record("delete")
+    documents = self.__documents(index, doc_type)
+    if id not in documents:
+      raise NotFoundError(404, "not found", {"_id": id})
+    del documents[id]
+    self.__changed(index, doc_type, id)
+    return {"_index": index, "_type": doc_type, "_id": id, "found": True}
+
+  # body is the newline delimited bulk body, as a string or as a list of lines depending on the client version
+  def bulk(self, body, index = None, doc_type = None, **kwargs):
+    self.record("bulk")
+    if type(body) is list: body = "\n".join(body)
+    lines = filter(lambda x: len(x.strip()) > 0, body.split("\n"))
+    items = []
+    errors = False
+    i = 0
+    while i < len(lines):
+      action = json.loads(lines[i])
+      opType, meta = action.items()[0]
+      i += 1
+      source = None
+      if opType != "delete":
+        source = json.loads(lines[i])
+        i += 1
+      actionIndex = meta.get("_index", index)
+      actionType = meta.get("_type", doc_type)
+      id = meta["_id"]
+      documents = self.__documents(actionIndex, actionType)
+      status = 200
+      error = None
+      if opType == "create":
+        if id in documents:
+          status, error = 409, "DocumentAlreadyExistsException[[" + actionIndex + "][" + id + "]: document already exists]"
+        else:
+          documents[id] = source
+          self.__changed(actionIndex, actionType, id)
+          status = 201
+      elif opType == "index":
+        documents[id] = source
+        self.__changed(actionIndex, actionType, id)
+      elif opType == "update":
+        status, error = self.__update(actionIndex, actionType, id, source)
+      elif opType == "delete":
+        if id in documents:
+          del documents[id]
+          self.__changed(actionIndex, actionType, id)
+        else:
+          status = 404
+      item = {"_index": actionIndex, "_type": actionType, "_id": id, "status": status}
+      if error != None:
+        item["error"] = error
+        errors = True
+      items.append({opType: item})
+    return {"took": 0, "errors": errors, "items": items}
+
+  def count(self, index, doc_type, body = None, **kwargs):
+    self.record("count")
+    query = {"match_all": {}}
+    if body != None and "query" in body: query = body["query"]
+    return {"count": len(self.__match(index, doc_type, query, False))}
+
+  def search(self, index, doc_type, body = None, size = None, explain = False, scroll = None, fields = None, **kwargs):
+    self.record("search")
+    return self.__search(index, doc_type, body, size, explain, scroll, fields)
+
+  def __search(self, index, doc_type, body, size, explain, scroll, fields):
+    if body == None: body = {}
+    query = body.get("query", {"match_all": {}})
+    if size == None: size = body.get("size", 10)
+    if fields == None: fields = body.get("fields", None)
+    if fields != None: fields = filter(lambda x: x != "_id", fields)
+    matches = self.__match(index, doc_type, query, explain)
+    if "sort" in body:
+      for sort in reversed(body["sort"]):
+        field, options = sort.items()[0]
+        reverse = options.get("order", "asc") == "desc"
+        if field == "_id":
+          matches.sort(key=lambda x: x[0], reverse=reverse)
+        else:
+          matches.sort(key=lambda x: self.__documents(index, doc_type)[x[0]].get(field, ""), reverse=reverse)
+    else:
+      matches.sort(key=lambda x: -x[1])
+    documents = self.__documents(index, doc_type)
+    hits = []
+    for id, score, explanation in matches:
+      hit = self.__hit(index, doc_type, id, documents[id], fields)
+      del hit["found"]
+      if not body.get("version", False): del hit["_version"]
+      hit["_score"] = score
+      if explain: hit["_explanation"] = explanation
+      hits.append(hit)
+    maxScore = None
+    if len(matches) > 0: maxScore = max(map(lambda x: x[1], matches))
+    response = {"took": 0, "timed_out": False, "hits": {"total": len(hits), "max_score": maxScore, "hits": hits[:size]}}
+    if scroll != None:
+      scrollId = str(self.nextScrollId)
+      self.nextScrollId += 1
+      self.scrolls[scrollId] = (hits[size:], size)
+      response["_scroll_id"] = scrollId
+    return response
+
+  def scroll(self, scroll_id, scroll = None, **kwargs):
+    self.record("scroll")
+    if scroll_id not in self.scrolls:
+      raise NotFoundError(404, "no search context found", {})
+    hits, size = self.scrolls[scroll_id]
+    self.scrolls[scroll_id] = (hits[size:], size)
+    return {"_scroll_id": scroll_id, "hits": {"total": len(hits), "hits": hits[:size]}}
+
+  def clear_scroll(self, scroll_id = None, **kwargs):
+    self.record("clear_scroll")
+    self.scrolls.pop(scroll_id, None)
+    return {}
+
+  def msearch(self, body, **kwargs):
+    self.record("msearch")
+    responses = []
+    for i in range(0, len(body), 2):
+      header = body[i]
+      responses.append(self.__search(header["index"], header["type"], body[i + 1], None, False, None, None))
+    return {"responses": responses}
+
+  # returns the term vectors of stored documents ("_id") and of artificial documents ("doc")
+  def mtermvectors(self, index, doc_type, body, **kwargs):
+    self.record("mtermvectors")
+    documents = self.__documents(index, doc_type)
+    docs = []
+    for request in body["docs"]:
+      if "doc" in request:
+        doc = {"_index": index, "_type": doc_type, "_version": 0, "found": True}
+        tokens = self.__analyzeSource(request["doc"])
+      elif request["_id"] in documents:
+        doc = {"_index": index, "_type": doc_type, "_id": request["_id"], "_version": self.versions.get((index, doc_type, request["_id"]), 1), "found": True}
+        tokens = self.__tokens(index, doc_type, request["_id"], documents[request["_id"]])
+      else:
+        docs.append({"_index": index, "_type": doc_type, "_id": request["_id"], "found": False})
+        continue
+      fields = request.get("fields", tokens.keys())
+      doc["term_vectors"] = {}
+      for field in filter(lambda x: x in tokens, fields):
+        terms = {}
+        for term, position in tokens[field]:
+          entry = terms.setdefault(term, {"term_freq": 0, "tokens": []})
+          entry["term_freq"] += 1
+          entry["tokens"].append({"position": position})
+        doc["term_vectors"][field] = {"terms": terms}
+      docs.append(doc)
+    return {"docs": docs}
+
+  # returns (id, score, explanation) of the documents matching the query
+  def __match(self, index, docType, query, explain):
+    documents = self.__documents(index, docType)
+    candidates = documents.keys()
+    phrases = self.__phrases(query)
+    if len(phrases) > 0:
+      invertedIndex = self.__invertedIndex(index, docType)
+      candidates = set()
+      for field, words in phrases:
+        if len(words) == 0: continue
+        fieldCandidates = invertedIndex.get(words[0], set())
+        for word in words[1:]:
+          fieldCandidates = fieldCandidates & invertedIndex.get(word, set())
+        candidates.update(fieldCandidates)
+    matches = []
+    for id in candidates:
+      score, explanation = self.__score(index, docType, id, documents[id], query)
+      if score != None: matches.append((id, score, explanation))
+    return matches
+
+  # (field, words) of the match_phrase clauses of a query made only of phrase clauses
+  def __phrases(self, query):
+    queryType, clause = query.items()[0]
+    if queryType == "match_phrase":
+      field, text = clause.items()[0]
+      return [(field, map(lambda x: x[0], self.__analyze(field, text)))]
+    if queryType == "bool" and "should" in clause and len(clause) == 1:
+      phrases = []
+      for should in clause["should"]:
+        shouldPhrases = self.__phrases(should)
+        if len(shouldPhrases) == 0: return []
+        phrases += shouldPhrases
+      return phrases
+    return []
+
+  def __invertedIndex(self, index, docType):
+    key = (index, docType)
+    if key not in self.invertedIndexes:
+      invertedIndex = {}
+      for id, source in self.__documents(index, docType).iteritems():
+        for tokens in self.__tokens(index, docType, id, source).values():
+          for word, position in tokens:
+            invertedIndex.setdefault(word, set()).add(id)
+      self.invertedIndexes[key] = invertedIndex
+    return self.invertedIndexes[key]
+
+  def __tokens(self, index, docType, id, source):
+    key = (index, docType, id)
+    if key not in self.tokenCache:
+      self.tokenCache[key] = self.__analyzeSource(source)
+    return self.tokenCache[key]
+
+  # (term, position) pairs of each text field, the values of a multi-valued field follow each other
+  def __analyzeSource(self, source):
+    tokens = {}
+    for field, value in source.iteritems():
+      values = value
+      if type(values) is not list: values = [values]
+      fieldTokens = []
+      for text in values:
+        if isinstance(text, basestring):
+          offset = 0
+          if len(fieldTokens) > 0: offset = fieldTokens[-1][1] + 1
+          fieldTokens += map(lambda x: (x[0], x[1] + offset), self.__analyze(field, text))
+      tokens[field] = fieldTokens
+    return tokens
+
+  def __analyze(self, field, text):
+    if field in self.fieldAnalyzers: return self.fieldAnalyzers[field](text)
+    return self.analyzer.tokenize(text)
+
+  # returns the score and explanation of the document for the query, or (None, None) when it doesn't match
+  def __score(self, index, docType, id, source, query):
+    queryType, clause = query.items()[0]
+    if queryType == "match_all":
+      return 1.0, {"value": 1.0, "description": "ConstantScore(*:*)", "details": []}
+    if queryType == "term":
+      field, value = clause.items()[0]
+      values = source.get(field)
+      if type(values) is not list: values = [values]
+      if value in values:
+        return 1.0, {"value": 1.0, "description": "ConstantScore(" + field + ")", "details": []}
+      return None, None
+    if queryType == "terms":
+      field, values = clause.items()[0]
+      if source.get(field) in values:
+        return 1.0, {"value": 1.0, "description": "ConstantScore(" + field + ")", "details": []}
+      return None, None
+    if queryType == "filtered":
+      if "filter" in clause and "exists" in clause["filter"]:
+        if source.get(clause["filter"]["exists"]["field"]) == None: return None, None
+      if "query" in clause: return self.__score(index, docType, id, source, clause["query"])
+      return 1.0, {"value": 1.0, "description": "ConstantScore(filter)", "details": []}
+    if queryType == "bool":
+      score = 0.0
+      details = []
+      for should in clause.get("should", []):
+        shouldScore, explanation = self.__score(index, docType, id, source, should)
+        if shouldScore != None:
+          score += shouldScore
+          details.append(explanation)
+      if len(details) == 0: return None, None
+      return score, {"value": score, "description": "sum of:", "details": details}
+    if queryType == "match_phrase":
+      field, text = clause.items()[0]
+      phraseTokens = self.__analyze(field, text)
+      phraseWords = map(lambda x: x[0], phraseTokens)
+      words = self.__tokens(index, docType, id, source).get(field, [])
+      # the phrase occurs where each of its terms is at the same distance from the first as in the query
+      freq = 0
+      if len(phraseTokens) > 0:
+        wordPositions = set(words)
+        for word, position in words:
+          if all(map(lambda x: (x[0], position + x[1] - phraseTokens[0][1]) in wordPositions, phraseTokens)):
+            freq += 1
+      if freq == 0: return None, None
+      invertedIndex = self.__invertedIndex(index, docType)
+      numDocuments = len(self.__documents(index, docType))
+      idf = sum(map(lambda x: 1.0 + math.log(numDocuments * 1.0 / (len(invertedIndex.get(x, [])) + 1)), phraseWords))
+      score = math.sqrt(freq) * idf / math.sqrt(len(words))
+      explanation = {"value": score, "description": "weight(" + field + ":\"" + " ".join(phraseWords) + "\" in " + id + ") [PerFieldSimilarity], result of:", "details": [
+        {"value": math.sqrt(freq), "description": "tf(freq=" + repr(float(freq)) + "), with freq of:", "details": [{"value": float(freq), "description": "phraseFreq=" + repr(float(freq))}]},
+        {"value": idf, "description": "idf(), sum of:"},
+        {"value": 1.0 / math.sqrt(len(words)), "description": "fieldNorm(doc=0)"}
+      ]}
+      return score, explanation
+    raise Exception("Query type '" + queryType + "' is not supported by the fake Elasticsearch client")
@@ -1,10 +1,24 @@
 import re
+import os
+import os.path
+import pickle
+import threading
+import multiprocessing
 import nltk
-from nltk.corpus import conll2000
-from elasticsearch import Elasticsearch
+from elasticsearch import helpers
+from src import es_client
+from src.lru_cache import LRUCache
 
 __name__ = "pos_processor"
 
+documentCache = None
+tagger = None
+chunker = None
+taggingPool = None
+# guards the lazy initialization of the above, since workers call the processor from several threads.
+# The document cache has its own lock, and Elasticsearch requests and tagging run outside of both
+initLock = threading.RLock()
+
 def trim(value) :
   return value.strip()
 
@@ -28,7 +42,10 @@ def getChunkSequence(tree):
   return sequence
 
 class UnigramChunker(nltk.ChunkParserI):
-  def __init__(self, train_sents): 
+  def __init__(self, train_sents = None, tagger = None): 
+    if tagger != None:
+      self.tagger = tagger
+      return
     train_data = [[(t,c) for w,t,c in nltk.chunk.tree2conlltags(sent)]
                   for sent in train_sents]
     self.tagger = nltk.UnigramTagger(train_data)
@@ -41,18 +58,75 @@ class UnigramChunker(nltk.ChunkParserI):
                  in zip(sentence, chunktags)]
     return nltk.chunk.util.conlltags2tree(conlltags)
 
-train_sents = conll2000.chunked_sents('train.txt')
-chunker = UnigramChunker(train_sents)
+# same client as the worker running the processor
+def __getEsClient(config):
+  return es_client.getClient(config)
 
-def annotate(config, documentId):
-  if "getPosTags" in config and config["getPosTags"] == False: return
-  esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
-  corpusIndex = config["corpus"]["index"]
-  corpusType = config["corpus"]["type"]
-  corpusFields = config["corpus"]["text_fields"]
-  processorIndex = config["processor"]["index"]
-  processorType = config["processor"]["type"]
-  document = esClient.get(index=corpusIndex, doc_type=corpusType, id = documentId, fields=corpusFields)
+def __getDocumentCache(config):
+  global documentCache
+  with initLock:
+    if documentCache == None:
+      maxDocuments = 10000
+      maxBytes = 256 * 1024 * 1024
+      if "documentCache" in config["processor"]:
+        if "maxDocuments" in config["processor"]["documentCache"]: maxDocuments = config["processor"]["documentCache"]["maxDocuments"]
+        if "maxBytes" in config["processor"]["documentCache"]: maxBytes = config["processor"]["documentCache"]["maxBytes"]
+      documentCache = LRUCache(maxDocuments, maxBytes)
+    return documentCache
+
+# rough in-memory size of a list of pos tagged sentences
+def __getSize(posTaggedSentences):
+  size = 64
+  for sentence in posTaggedSentences:
+    size += 64
+    for word, tag in sentence:
+      size += len(word) + len(tag) + 96
+  return size
+
+def __getPosTaggedSentences(config, esClient, documentId):
+  cache = __getDocumentCache(config)
+  posTaggedSentences = cache.get(documentId)
+  if posTaggedSentences == None:
+    annotatedDocument = esClient.get(index=config["processor"]["index"], doc_type=config["processor"]["type"], id=documentId, _source_include=["pos_tagged_sentences"])["_source"]
+    posTaggedSentences = annotatedDocument["pos_tagged_sentences"]
+    cache.put(documentId, posTaggedSentences, __getSize(posTaggedSentences))
+  stats = cache.stats()
+  if (stats["hits"] + stats["misses"]) % 1000 == 0:
+    config["logger"].info("pos-processor: document cache " + str(stats))
+  return posTaggedSentences
+
+# the chunker is trained on the conll2000 corpus the first time it is needed and cached on disk,
+# so that importing the processor stays cheap
+def getChunker(config):
+  with initLock:
+    return __loadChunker(config)
+
+def __loadChunker(config):
+  global chunker
+  if chunker != None: return chunker
+  modelFilePath = __getChunkerFilePath(config)
+  if modelFilePath != None and os.path.exists(modelFilePath):
+    modelFile = open(modelFilePath, "rb")
+    chunker = UnigramChunker(tagger=pickle.load(modelFile))
+    modelFile.close()
+    return chunker
+  from nltk.corpus import conll2000
+  chunker = UnigramChunker(conll2000.chunked_sents('train.txt'))
+  if modelFilePath != None:
+    if not os.path.exists(config["processor"]["modelCacheDir"]):
+      os.makedirs(config["processor"]["modelCacheDir"])
+    tempFilePath = modelFilePath + "." + str(os.getpid()) + ".tmp"
+    modelFile = open(tempFilePath, "wb")
+    pickle.dump(chunker.tagger, modelFile, pickle.HIGHEST_PROTOCOL)
+    modelFile.close()
+    os.rename(tempFilePath, modelFilePath)
+  return chunker
+
+def __getChunkerFilePath(config):
+  if "modelCacheDir" not in config["processor"]: return None
+  return os.path.join(config["processor"]["modelCacheDir"], "pos-processor-chunker.pickle")
+
+def __getContent(document, corpusFields):
   content = ""
   if "fields" in document:
     for field in corpusFields:
@@ -62,34 +136,109 @@ def annotate(config, documentId):
             content += element + ". "
         else:
           content += document["fields"][field] + ". "
-      
-  annotatedDocument = {}
+  return content
+
+# same tagger as nltk.pos_tag, loaded once per process
+def __getTagger():
+  global tagger
+  with initLock:
+    if tagger == None:
+      if hasattr(nltk.tag, "_POS_TAGGER"):
+        tagger = nltk.data.load(nltk.tag._POS_TAGGER)
+      else:
+        tagger = nltk.tag.PerceptronTagger()
+    return tagger
+
+# splits content into sentences and POS tags all of them in one batch
+def __tagContent(content):
   sentences = nltk.sent_tokenize(content)
-  posTaggedSentences = []
+  sentencesWords = []
   for sentence in sentences:
     sentence = sentence.strip()
     if len(sentence) > 1:
       sentence = sentence.replace("-", " ")
       sentenceWords = nltk.word_tokenize(sentence.lower())
       sentenceWords = filter(lambda x: len(x) > 0, map(lambda x: x.replace(".", "").strip(), sentenceWords))
-      posTags = nltk.pos_tag(sentenceWords)
-      posTaggedSentences.append(posTags)
-  if esClient.exists(index=processorIndex, doc_type=processorType, id=document["_id"]):
-    annotatedDocument = esClient.get(index=processorIndex, doc_type=processorType, id=document["_id"])["_source"]
-  annotatedDocument["pos_tagged_sentences"] = posTaggedSentences
-  esClient.index(index=processorIndex, doc_type=processorType, id=document["_id"], body=annotatedDocument)
-  config["logger"].info("pos-processor: Annotated document '" + document["_id"] + "'")
+      sentencesWords.append(sentenceWords)
+  if len(sentencesWords) == 0: return []
+  posTagger = __getTagger()
+  if hasattr(posTagger, "tag_sents"):
+    return posTagger.tag_sents(sentencesWords)
+  return posTagger.batch_tag(sentencesWords)
+
+def __initTaggingProcess():
+  __getTagger()
+
+# pool of processes tagging documents in parallel, None when tagging runs in the worker process
+def __getTaggingPool(config):
+  global taggingPool
+  with initLock:
+    if taggingPool == None and "taggingProcesses" in config and config["taggingProcesses"] != 1:
+      processes = config["taggingProcesses"]
+      if processes <= 0: processes = multiprocessing.cpu_count()
+      taggingPool = multiprocessing.Pool(processes, __initTaggingProcess)
+      config["logger"].info("pos-processor: Started " + str(processes) + " tagging processes")
+    return taggingPool
+
+# loads the tagger before a worker supervisor forks its worker processes, which then share it. The chunker
+# is only loaded when it is already cached on disk, since annotation doesn't use it and training it is slow
+def preload(config):
+  __getTagger()
+  modelFilePath = __getChunkerFilePath(config)
+  if modelFilePath != None and os.path.exists(modelFilePath): getChunker(config)
+
+def annotate(config, documentId):
+  if len(annotateDocuments(config, [documentId])) > 0:
+    raise Exception("pos-processor: Failed to annotate document '" + documentId + "'")
+
+# returns ids of the documents that could not be annotated
+def annotateDocuments(config, documentIds):
+  if "getPosTags" in config and config["getPosTags"] == False: return []
+  esClient = __getEsClient(config)
+  corpusIndex = config["corpus"]["index"]
+  corpusType = config["corpus"]["type"]
+  corpusFields = config["corpus"]["text_fields"]
+  processorIndex = config["processor"]["index"]
+  processorType = config["processor"]["type"]
+  documents = esClient.mget(index=corpusIndex, doc_type=corpusType, body={"ids": documentIds}, fields=corpusFields)["docs"]
+  documents = filter(lambda x: x.get("found", False), documents)
+  contents = map(lambda x: __getContent(x, corpusFields), documents)
+
+  # tagging is CPU bound and runs in the tagging processes, Elasticsearch requests stay in this process
+  pool = __getTaggingPool(config)
+  if pool != None:
+    taggedContents = pool.map(__tagContent, contents)
+  else:
+    taggedContents = map(__tagContent, contents)
+
+  annotatedDocuments = esClient.mget(index=processorIndex, doc_type=processorType, body={"ids": map(lambda x: x["_id"], documents)})["docs"]
+  actions = []
+  for document, posTaggedSentences, annotatedDocument in zip(documents, taggedContents, annotatedDocuments):
+    source = {}
+    if annotatedDocument.get("found", False):
+      source = annotatedDocument["_source"]
+    source["pos_tagged_sentences"] = posTaggedSentences
+    actions.append({"_op_type": "index", "_index": processorIndex, "_type": processorType, "_id": document["_id"], "_source": source})
+  annotatedIds = set(map(lambda x: x["_id"], documents))
+  if len(actions) > 0:
+    success, errors = helpers.bulk(esClient, actions, raise_on_error=False)
+    for error in errors:
+      annotatedIds.discard(error.values()[0]["_id"])
+  cache = __getDocumentCache(config)
+  for documentId in annotatedIds:
+    cache.remove(documentId)
+    config["logger"].info("pos-processor: Annotated document '" + documentId + "'")
+  return filter(lambda x: x not in annotatedIds, documentIds)
 
 def extractFeatures(config, phrase, phraseFeatures):
   processorIndex = config["processor"]["index"]
   processorType = config["processor"]["type"]
   phraseProcessorType = config["processor"]["type"] + "__phrase"
-  esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
+  esClient = __getEsClient(config)
   features = phraseFeatures
   phraseData = esClient.get(index=processorIndex, doc_type=phraseProcessorType, id=__keyify(phrase))["_source"]
   documentId = phraseData["document_id"]
-  annotatedDocument = esClient.get(index=processorIndex, doc_type=processorType, id=documentId)["_source"]
-  posTaggedSentences = annotatedDocument["pos_tagged_sentences"]
+  posTaggedSentences = __getPosTaggedSentences(config, esClient, documentId)
   phrase = phraseData["phrase"]
   phrase = phrase.replace("\"", "")
   phraseWords = nltk.word_tokenize(phrase)
@@ -2,9 +2,18 @@ import sys
 import os
 import os.path
 import re
-from elasticsearch import Elasticsearch
+import threading
 from time import sleep
-from muppet import DurableChannel, RemoteChannel
+from elasticsearch import helpers
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.scroll_iterator import ScrollIterator
+from src.corpus_statistics import CorpusStatistics
+from src.dispatch_checkpoint import DispatchCheckpoint
+from src.dispatch_window import DispatchWindow
+from src.dirty_phrases import DirtyPhrases
+from src import shingle_analyzer
 
 
 esStopWords = ["a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the", "their", "then", "there", "these", "they", "this", "to", "was", "will", "with"]
@@ -16,7 +25,8 @@ class AnnotationDispatcher:
   def __init__(self, config, processingStartIndex, processingEndIndex):
     self.config = config
     self.logger = config["logger"]
-    self.esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
+    self.metrics = metrics.Metrics(config, "annotation_dispatcher")
+    self.esClient = es_client.getClient(config, self.metrics)
     self.bagOfPhrases = {}
     self.corpusIndex = config["corpus"]["index"]
     self.corpusType = config["corpus"]["type"]
@@ -26,6 +36,15 @@ class AnnotationDispatcher:
     self.processorType = config["processor"]["type"]
     self.processorPhraseType = config["processor"]["type"] + "__phrase"
     self.processingPageSize = config["processingPageSize"]
+    self.dispatchBatchSize = 1
+    if "dispatchBatchSize" in config: self.dispatchBatchSize = config["dispatchBatchSize"]
+    self.window = DispatchWindow(config, self.dispatchBatchSize)
+    # guards the window, the counters and the checkpoint, which timeoutCallback updates from the channel's timeout thread
+    self.stateLock = threading.RLock()
+    self.bulkSize = 500
+    if "indexingBulkSize" in config: self.bulkSize = config["indexingBulkSize"]
+    self.incremental = "annotateIncrementally" in config and config["annotateIncrementally"] == True
+    self.dirtyPhrases = DirtyPhrases(config)
     self.analyzerIndex = self.corpusIndex + "__analysis__"
     self.config["processingStartIndex"] = processingStartIndex
     self.config["processingEndIndex"] = processingEndIndex
@@ -33,38 +52,18 @@ class AnnotationDispatcher:
     self.totalDocumentsDispatched = 0
     self.documentsAnnotated = 0
     self.documentsNotAnnotated = 0
-    self.lastDispatcher = False
     self.endProcess = False
     self.dispatcherName = "bayzee.annotation.dispatcher"
     self.workerName = "bayzee.annotation.worker"
     self.timeout = 86400000
     if processingEndIndex != None:
       self.dispatcherName += "." + str(processingStartIndex) + "." + str(processingEndIndex)
+    self.checkpoint = DispatchCheckpoint(config, self.dispatcherName)
+    self.resumeState = None
+    if "resumeDispatch" not in config or config["resumeDispatch"] == True:
+      self.resumeState = self.checkpoint.load()
 
-    analyzerIndexSettings = {
-      "index":{
-        "analysis":{
-          "analyzer":{
-            "analyzer_shingle":{
-              "type": "custom",
-              "tokenizer": "standard",
-              "filter": ["standard", "lowercase", "filter_shingle"]
-            }
-          },
-          "filter":{
-            "filter_shingle":{
-              "type": "shingle",
-              "max_shingle_size": config["generator"]["maxShingleSize"],
-              "min_shingle_size": config["generator"]["minShingleSize"],
-              "output_unigrams": (config["generator"]["minShingleSize"] == 1)
-            },
-            "filter_stop":{
-              "type": "stop"
-            }
-          }
-        }
-      }
-    }
+    analyzerIndexSettings = shingle_analyzer.getAnalyzerSettings(config["generator"]["minShingleSize"], config["generator"]["maxShingleSize"])
     analyzerIndexTypeMapping = {
       "properties":{
         "phrase":{"type":"string"},
@@ -72,23 +71,40 @@ class AnnotationDispatcher:
         "phrase__not_analyzed":{"type":"string","index":"not_analyzed"}
       }
     }
+    annotatedDocumentTypeMapping = {
+      "properties":{
+        "shingles":{"type":"string", "index": "not_analyzed"},
+        "shingle_counts":{"type":"integer", "index": "no"},
+        "shingle_length":{"type":"integer", "index": "no"},
+        "content_hash":{"type":"string", "index": "not_analyzed"},
+        "version":{"type":"long", "index": "no"}
+      }
+    }
     corpusSize = self.esClient.count(index=self.corpusIndex, doc_type=self.corpusType, body={"query":{"match_all":{}}})
     self.corpusSize = corpusSize["count"]
     self.featureNames = map(lambda x: x["name"], config["generator"]["features"])
     for module in config["processor"]["modules"]:
       self.featureNames = self.featureNames + map(lambda x: x["name"], module["features"])
 
-    if processingStartIndex == 0:
+    if processingStartIndex == 0 and self.resumeState == None:
       if self.esClient.indices.exists(self.analyzerIndex):
         self.esClient.indices.delete(self.analyzerIndex)
       data = self.esClient.indices.create(self.analyzerIndex, analyzerIndexSettings) 
         
-    if "annotateFromScratch" not in self.config or self.config["annotateFromScratch"] == True:
+    annotateFromScratch = "annotateFromScratch" not in self.config or self.config["annotateFromScratch"] == True
+    # incremental annotation only starts from scratch when nothing was annotated yet
+    if self.incremental: annotateFromScratch = not self.esClient.indices.exists(self.processorIndex)
+    # a resumed run keeps what the previous run annotated
+    if self.resumeState == None and annotateFromScratch:
       try:
         if self.esClient.indices.exists(self.config["processor"]["index"]):
           self.esClient.indices.delete(self.config["processor"]["index"])
         self.esClient.indices.create(self.config["processor"]["index"])
         self.esClient.indices.put_mapping(index=self.config["processor"]["index"],doc_type=self.processorPhraseType,body=analyzerIndexTypeMapping)
+        self.esClient.indices.put_mapping(index=self.config["processor"]["index"],doc_type=self.processorType,body=annotatedDocumentTypeMapping)
+        if "collectStatistics" in self.config and self.config["collectStatistics"] == True:
+          CorpusStatistics(self.config).clear()
+        self.dirtyPhrases.clear()
         if self.esClient.indices.exists(self.analyzerIndex):
           self.esClient.indices.delete(self.analyzerIndex)
         data = self.esClient.indices.create(self.analyzerIndex, analyzerIndexSettings) 
@@ -98,6 +114,15 @@ class AnnotationDispatcher:
         sys.exit(1)
       else:
         sleep(1)
+    # an index annotated before incremental annotation existed lacks the mapping of the fields it reads and
+    # queries, which can be added as long as the fields weren't mapped otherwise
+    elif self.incremental:
+      try:
+        self.esClient.indices.put_mapping(index=self.processorIndex,doc_type=self.processorType,body=annotatedDocumentTypeMapping)
+      except:
+        error = sys.exc_info()
+        self.logger.error("Annotated documents can't be mapped for incremental annotation, annotate from scratch: " + str(error))
+        sys.exit(1)
 
     #dispatcher creation
     self.annotationDispatcher = DurableChannel(self.dispatcherName, config, self.timeoutCallback)
@@ -106,61 +131,203 @@ class AnnotationDispatcher:
     self.controlChannel = RemoteChannel(self.dispatcherName, config)
 
   def dispatchToAnnotate(self):
+    self.metrics.start()
     if "indexPhrases" in self.config and self.config["indexPhrases"] == False: return
-    nextDocumentIndex = 0
-    if self.config["processingStartIndex"] != None: nextDocumentIndex = self.config["processingStartIndex"]
-    endDocumentIndex = -1
-    if self.config["processingEndIndex"] != None: endDocumentIndex = self.config["processingEndIndex"]
-   
-    if endDocumentIndex != -1 and self.processingPageSize > (endDocumentIndex - nextDocumentIndex):
-      self.processingPageSize = endDocumentIndex - nextDocumentIndex + 1
-
     self.totalDocumentsDispatched = 0
+    startIndex = self.config["processingStartIndex"]
+    cursor = None
+    if self.resumeState != None:
+      # only the documents that were dispatched but not acknowledged are sent again
+      startIndex = self.resumeState["position"]
+      self.totalDocumentsDispatched = self.resumeState["dispatched"]
+      self.documentsAnnotated = self.resumeState["acknowledged"]
+      self.documentsNotAnnotated = self.resumeState["failed"]
+      cursor = self.resumeState["cursor"]
+      self.logger.info("Resuming after document " + str(self.resumeState["cursor"]) + ": " + str(self.totalDocumentsDispatched) + " dispatched, " + str(self.documentsAnnotated) + " annotated, " + str(self.documentsNotAnnotated) + " failed, " + str(len(self.resumeState["pending"])) + " pending")
+      self.__send(self.resumeState["pending"])
+    else:
+      if startIndex == None: startIndex = 0
+      self.checkpoint.start(startIndex)
 
-    while True:
-      documents = self.esClient.search(index=self.corpusIndex, doc_type=self.corpusType, body={"from": nextDocumentIndex,"size": self.processingPageSize,"query":{"match_all":{}}, "sort":[{"_id":{"order":"asc"}}]}, fields=["_id"])
-      if len(documents["hits"]["hits"]) == 0: 
-        break
-      self.totalDocumentsDispatched += len(documents["hits"]["hits"])
-      self.logger.info("Annotating " + str(nextDocumentIndex) + " to " + str(nextDocumentIndex+len(documents["hits"]["hits"])) + " documents...")
-      for document in documents["hits"]["hits"]:
-        self.logger.info("Dispatching document " + document["_id"])
-        content = {"documentId": document["_id"], "type": "annotate", "count": 1, "from":self.dispatcherName}
-        self.annotationDispatcher.send(content, self.workerName)
-      nextDocumentIndex += len(documents["hits"]["hits"])
-      if endDocumentIndex != -1 and endDocumentIndex <= nextDocumentIndex: 
-        break
+    if self.incremental:
+      pages = self.__changedDocumentPages(startIndex, cursor)
+    else:
+      pages = self.__documentPages(startIndex)
+    for nextDocumentIndex, numDocuments, documentIds, cursor in pages:
+      with self.stateLock:
+        self.totalDocumentsDispatched += len(documentIds)
+        self.checkpoint.dispatch(documentIds, nextDocumentIndex + numDocuments, self.totalDocumentsDispatched, cursor)
+      if len(documentIds) == 0: continue
+      self.metrics.increment("bayzee_dispatched_items_total", len(documentIds))
+      self.logger.info("Annotating " + str(len(documentIds)) + " of documents " + str(nextDocumentIndex) + " to " + str(nextDocumentIndex+numDocuments) + "...")
+      self.__send(documentIds)
     
     self.logger.info(str(self.totalDocumentsDispatched) + " documents dispatched")
-    while True:
-      message = self.annotationDispatcher.receive()
-      if "documentId" in message["content"] and message["content"]["documentId"] > 0:
-        self.documentsAnnotated += 1
-        self.annotationDispatcher.close(message)
-        self.logger.info("Annotated document " + message["content"]["documentId"] + " - " + str(self.documentsAnnotated) + "/" + str(self.totalDocumentsDispatched))
-      
-      if (self.documentsAnnotated + self.documentsNotAnnotated) >= self.totalDocumentsDispatched and not self.lastDispatcher:
-        self.controlChannel.send("dying")
-        self.annotationDispatcher.end()
-        break
-    
+    while (self.documentsAnnotated + self.documentsNotAnnotated) < self.totalDocumentsDispatched:
+      self.__receive()
+
+    self.controlChannel.send("dying")
+    self.annotationDispatcher.end()
+    # with several dispatchers, the workers of other slices may still be adding the phrases being pruned
+    if self.incremental and not self.config["processingStartIndex"] and self.config["processingEndIndex"] == None:
+      try:
+        self.__pruneRetractedPhrases()
+      except:
+        error = sys.exc_info()
+        self.logger.error("Error pruning retracted phrases, they are kept for the next run: " + str(error))
+    self.checkpoint.clear()
     self.__terminate()
 
+  # yields (index of the first document in the page, number of documents in the page, ids of the documents to annotate, cursor)
+  def __documentPages(self, startIndex):
+    documents = ScrollIterator(self.esClient, self.corpusIndex, self.corpusType, {"match_all":{}}, [{"_id":{"order":"asc"}}], self.processingPageSize, startIndex, self.config["processingEndIndex"])
+    for nextDocumentIndex, documentIds in documents.pages():
+      yield nextDocumentIndex, len(documentIds), documentIds, documentIds[-1]
+
+  # merge-joins the corpus and the annotated documents, both in _id order, and yields the pages of the corpus in the
+  # format of __documentPages with the ids of the documents that were added, changed or deleted since they were
+  # annotated. Annotated documents at or before 'cursor' belong to an earlier slice or run and are left alone.
+  # A slice also covers the deleted documents up to the first document of the next slice, which it reads as well.
+  def __changedDocumentPages(self, startIndex, cursor):
+    endIndex = self.config["processingEndIndex"]
+    if endIndex != None: endIndex += 1
+    corpus = ScrollIterator(self.esClient, self.corpusIndex, self.corpusType, {"match_all":{}}, [{"_id":{"order":"asc"}}], self.processingPageSize, startIndex, endIndex, version=True)
+    annotated = ScrollIterator(self.esClient, self.processorIndex, self.processorType, {"match_all":{}}, [{"_id":{"order":"asc"}}], self.processingPageSize, None, None, fields=["version"])
+    annotatedHits = self.__hits(annotated)
+    annotatedHit = next(annotatedHits, None)
+    position = startIndex
+    nextSliceId = None
+    for nextDocumentIndex, hits in corpus.hitPages():
+      if endIndex != None and nextDocumentIndex + len(hits) == endIndex:
+        nextSliceId = hits[-1]["_id"]
+        hits = hits[:-1]
+        if len(hits) == 0: break
+      if cursor == None and startIndex > 0: cursor = hits[0]["_id"]
+      documentIds = []
+      for hit in hits:
+        while annotatedHit != None and annotatedHit["_id"] < hit["_id"]:
+          if cursor == None or annotatedHit["_id"] > cursor: documentIds.append(annotatedHit["_id"])
+          annotatedHit = next(annotatedHits, None)
+        if annotatedHit != None and annotatedHit["_id"] == hit["_id"]:
+          if annotatedHit.get("fields", {}).get("version", [None])[0] != hit["_version"]: documentIds.append(hit["_id"])
+          annotatedHit = next(annotatedHits, None)
+        else:
+          documentIds.append(hit["_id"])
+      position = nextDocumentIndex + len(hits)
+      cursor = hits[-1]["_id"]
+      yield nextDocumentIndex, len(hits), documentIds, cursor
+    # a slice past the end of the corpus covers no documents
+    if cursor == None and startIndex > 0: return
+    # annotated documents after the last document of the slice were deleted, up to the next slice
+    documentIds = []
+    while annotatedHit != None and (nextSliceId == None or annotatedHit["_id"] < nextSliceId):
+      if cursor == None or annotatedHit["_id"] > cursor: documentIds.append(annotatedHit["_id"])
+      annotatedHit = next(annotatedHits, None)
+      if len(documentIds) >= self.processingPageSize or (annotatedHit == None and len(documentIds) > 0):
+        yield position, 0, documentIds, documentIds[-1]
+        documentIds = []
+
+  def __hits(self, scrollIterator):
+    for position, hits in scrollIterator.hitPages():
+      for hit in hits:
+        yield hit
+
+  # deletes the retracted phrases that no annotated document contains anymore, and points the others at a
+  # document that still contains them
+  def __pruneRetractedPhrases(self):
+    self.esClient.indices.refresh(index=self.processorIndex)
+    phrasesDeleted = 0
+    for phraseIds in self.dirtyPhrases.retractedPages(self.processingPageSize):
+      body = []
+      for phraseId in phraseIds:
+        body.append({"index": self.processorIndex, "type": self.processorType})
+        body.append({"query": {"term": {"shingles": phraseId}}, "size": 1, "fields": []})
+      responses = self.esClient.msearch(body=body)["responses"]
+      actions = []
+      deletedPhraseIds = []
+      for phraseId, response in zip(phraseIds, responses):
+        if "error" in response:
+          raise Exception("Search failed for phrase '" + phraseId + "': " + str(response["error"]))
+        hits = response["hits"]["hits"]
+        if len(hits) == 0:
+          actions.append({"_op_type": "delete", "_index": self.processorIndex, "_type": self.processorPhraseType, "_id": phraseId})
+          deletedPhraseIds.append(phraseId)
+        else:
+          actions.append({"_op_type": "update", "_index": self.processorIndex, "_type": self.processorPhraseType, "_id": phraseId, "doc": {"document_id": hits[0]["_id"]}})
+      success, errors = helpers.bulk(self.esClient, actions, chunk_size=self.bulkSize, raise_on_error=False)
+      for error in errors:
+        result = error.values()[0]
+        # phrase already deleted
+        if result["status"] == 404: continue
+        raise Exception("Error pruning phrase '" + result["_id"] + "': " + str(result))
+      self.dirtyPhrases.removeDirty(deletedPhraseIds)
+      phrasesDeleted += len(deletedPhraseIds)
+    self.dirtyPhrases.clearRetracted()
+    self.logger.info("Deleted " + str(phrasesDeleted) + " phrases that no document contains anymore")
+
+  def __receive(self):
+    message = self.annotationDispatcher.receive()
+    with self.stateLock:
+      if "documentIds" in message["content"]:
+        failedDocumentIds = message["content"]["failedDocumentIds"]
+        annotatedDocumentIds = filter(lambda x: x not in failedDocumentIds, message["content"]["documentIds"])
+        # replies to messages sent before a restart may arrive twice, only new acknowledgements count
+        annotated = self.checkpoint.acknowledge(annotatedDocumentIds)
+        self.documentsAnnotated += annotated
+        self.window.completed(annotated)
+        self.metrics.increment("bayzee_items_total", annotated, {"status": "processed"})
+        self.annotationDispatcher.close(message)
+        self.logger.info("Annotated " + str(len(annotatedDocumentIds)) + " documents - " + str(self.documentsAnnotated) + "/" + str(self.totalDocumentsDispatched))
+        if len(failedDocumentIds) > 0:
+          self.logger.info("Failed to annotate documents " + ", ".join(failedDocumentIds))
+          if message["content"]["count"] < 5:
+            self.metrics.increment("bayzee_retries_total", 1, {"reason": "failed"})
+            content = {"documentIds": failedDocumentIds, "type": "annotate", "count": message["content"]["count"] + 1, "from":self.dispatcherName}
+            self.annotationDispatcher.send(content, self.workerName)
+          else:
+            notAnnotated = self.checkpoint.fail(failedDocumentIds)
+            self.documentsNotAnnotated += notAnnotated
+            self.window.completed(notAnnotated)
+            self.metrics.increment("bayzee_items_total", notAnnotated, {"status": "failed"})
+
+      self.metrics.setGauge("bayzee_pending_items", self.totalDocumentsDispatched - self.documentsAnnotated - self.documentsNotAnnotated)
+      self.metrics.setGauge("bayzee_dispatch_window", self.window.size)
+
+  # replies are received while the window is full, so that the documents are sent as workers free up
+  def __send(self, documentIds):
+    for i in range(0, len(documentIds), self.dispatchBatchSize):
+      batch = documentIds[i:i+self.dispatchBatchSize]
+      while self.window.isFull(len(batch)):
+        self.__receive()
+      self.logger.info("Dispatching " + str(len(batch)) + " documents starting at " + batch[0])
+      content = {"documentIds": batch, "type": "annotate", "count": 1, "from":self.dispatcherName}
+      with self.stateLock:
+        with self.metrics.timer("send"):
+          self.annotationDispatcher.send(content, self.workerName)
+        self.window.sent(len(batch))
+
   def timeoutCallback(self, message):
-    if message["content"]["count"] < 5:
-      message["content"]["count"] += 1
-      self.annotationDispatcher.send(message["content"], self.workerName, self.timeout)
-    else:
-      #log implementation yet to be done for expired documents
-      self.documentsNotAnnotated += 1
-      if self.documentsNotAnnotated == self.totalDocumentsDispatched or (self.documentsAnnotated + self.documentsNotAnnotated) == self.totalDocumentsDispatched:
-        self.__terminate()
+    with self.stateLock:
+      if message["content"]["count"] < 5:
+        message["content"]["count"] += 1
+        self.metrics.increment("bayzee_retries_total", 1, {"reason": "timeout"})
+        self.annotationDispatcher.send(message["content"], self.workerName, self.timeout)
+      else:
+        self.logger.info("Giving up on documents " + ", ".join(message["content"]["documentIds"]))
+        notAnnotated = self.checkpoint.fail(message["content"]["documentIds"])
+        self.documentsNotAnnotated += notAnnotated
+        self.window.completed(notAnnotated)
+        self.metrics.increment("bayzee_items_total", notAnnotated, {"status": "failed"})
+        if self.documentsNotAnnotated == self.totalDocumentsDispatched or (self.documentsAnnotated + self.documentsNotAnnotated) == self.totalDocumentsDispatched:
+          self.__terminate()
 
   def __terminate(self):
     self.logger.info(str(self.totalDocumentsDispatched) + " total dispatched")
     self.logger.info(str(self.documentsAnnotated) + " annotated")
     self.logger.info(str(self.documentsNotAnnotated) + " failed to annotate")
     self.logger.info("Annotation complete")
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
     self.logger.info("Terminating annotation dispatcher")
 
   def __deleteAnalyzerIndex(self):
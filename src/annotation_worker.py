@@ -2,9 +2,18 @@ import sys
 import os
 import os.path
 import re
-from elasticsearch import Elasticsearch
-from time import sleep
-from muppet import DurableChannel, RemoteChannel
+import time
+import json
+import hashlib
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.message_pool import MessagePool
+from src.shingle_analyzer import ShingleAnalyzer
+from src.corpus_statistics import CorpusStatistics
+from src.dirty_phrases import DirtyPhrases
 
 esStopWords = ["a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the", "their", "then", "there", "these", "they", "this", "to", "was", "will", "with"]
 
@@ -12,10 +21,13 @@ __name__ = "annotation_worker"
 
 class AnnotationWorker:
   
-  def __init__(self, config):
+  # a stream worker runs the worker's batches itself, with its own metrics and message pool
+  def __init__(self, config, workerMetrics = None, messagePool = None):
     self.config = config
     self.logger = config["logger"]
-    self.esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
+    self.metrics = workerMetrics
+    if self.metrics == None: self.metrics = metrics.Metrics(config, "annotation_worker")
+    self.esClient = es_client.getClient(config, self.metrics)
     self.corpusIndex = config["corpus"]["index"]
     self.corpusType = config["corpus"]["type"]
     self.corpusFields = config["corpus"]["text_fields"]
@@ -26,62 +38,310 @@ class AnnotationWorker:
     self.processorType = config["processor"]["type"]
     self.processorPhraseType = config["processor"]["type"] + "__phrase"
     self.analyzerIndex = self.corpusIndex + "__analysis__"
-    self.worker = DurableChannel(self.workerName, config)
+    self.bulkSize = 500
+    if "indexingBulkSize" in config: self.bulkSize = config["indexingBulkSize"]
+    self.shingleAnalyzer = None
+    if "shingleAnalyzer" in config["generator"] and config["generator"]["shingleAnalyzer"] == "local":
+      self.shingleAnalyzer = ShingleAnalyzer(config["generator"]["minShingleSize"], config["generator"]["maxShingleSize"])
+      self.logger.warning("The local shingle analyzer is not verified against Elasticsearch's analyzer_shingle yet, phrases may differ from the ones of the analyze API")
+    self.corpusStatistics = None
+    if "collectStatistics" in config and config["collectStatistics"] == True:
+      self.corpusStatistics = CorpusStatistics(config)
+    self.incremental = "annotateIncrementally" in config and config["annotateIncrementally"] == True
+    self.dirtyPhrases = None
+    if self.incremental:
+      self.dirtyPhrases = DirtyPhrases(config)
+    self.worker = None
+    self.messagePool = messagePool
+    if self.messagePool == None: self.messagePool = MessagePool(config)
     self.dispatchers = {}
 
   def annotate(self):
+    self.worker = DurableChannel(self.workerName, self.config)
+    self.metrics.start()
     while True:
       message = self.worker.receive()
       if message["content"] == "kill":
         message["responseId"] = message["requestId"]
-        self.worker.close(message)
+        with self.messagePool.channelLock:
+          self.worker.close(message)
         if len(self.dispatchers) == 0:
+          # replies of the messages being handled are sent before the channel ends
+          self.messagePool.close()
           self.worker.end()
           break
         else:
-          self.worker.send(content="kill", to=self.workerName)
+          with self.messagePool.channelLock:
+            self.worker.send(content="kill", to=self.workerName)
           continue
       elif message["content"]["type"] == "annotate":
         if message["content"]["from"] not in self.dispatchers:
           self.dispatchers[message["content"]["from"]] = RemoteChannel(message["content"]["from"], self.config)
           self.dispatchers[message["content"]["from"]].listen(self.unregisterDispatcher)
-        documentId = message["content"]["documentId"]
-        document = self.esClient.get(index=self.corpusIndex, doc_type=self.corpusType, id = documentId, fields=self.corpusFields)
-        if "fields" in document:  
-          for field in self.corpusFields:
-            shingles = []
-            if field in document["fields"]:
-              if type(document["fields"][field]) is list:
-                for element in document["fields"][field]:
-                  if len(element) > 0:
-                    shingleTokens = self.esClient.indices.analyze(index=self.analyzerIndex, body=element, analyzer="analyzer_shingle")
-                    shingles += shingleTokens["tokens"]
-              else:
-                if len(document["fields"][field]) > 0:
-                  shingles = self.esClient.indices.analyze(index=self.analyzerIndex, body=document["fields"][field], analyzer="analyzer_shingle")["tokens"]
-              shingles = map(self.__replaceUnderscore, shingles)
-              shingles = filter(self.__filterTokens, shingles)
-            if shingles != None and len(shingles) > 0:
-              for shingle in shingles:
-                phrase = shingle["token"]
-                key = self.__keyify(phrase)
-                if len(key) > 0:
-                  data = {"phrase": phrase,"phrase__not_analyzed": phrase,"document_id": document["_id"]}
-                  if not self.esClient.exists(index=self.processorIndex, doc_type=self.processorPhraseType, id=key):
-                    self.esClient.index(index=self.processorIndex, doc_type=self.processorPhraseType, id=key, body=data)
-        sleep(1)
-        for processorInstance in self.config["processor_instances"]:
-          processorInstance.annotate(self.config, documentId)
-        self.worker.reply(message, {"documentId": documentId, "status" : "processed", "type" : "reply"}, self.timeout)
+        self.messagePool.submit(self.__annotateMessage, message)
 
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
     self.logger.info("Terminating annotation worker")
 
+  def __annotateMessage(self, message):
+    start = time.time()
+    annotatedDocumentIds, failedDocumentIds, documentPhraseIds = self.annotateBatch(message["content"]["documentIds"])
+    self.metrics.recordBatch(time.time() - start, len(annotatedDocumentIds), len(failedDocumentIds))
+    with self.metrics.timer("reply"):
+      with self.messagePool.channelLock:
+        self.worker.reply(message, {"documentIds": annotatedDocumentIds, "failedDocumentIds": failedDocumentIds, "count": message["content"]["count"], "status" : "processed", "type" : "reply"}, self.timeout)
+
+  # annotates a batch of documents, returns the ids of the documents annotated, the ids of the documents that
+  # failed and the ids of the phrases of each document that was annotated again, keyed by document id
+  def annotateBatch(self, documentIds):
+    annotatedDocumentIds = []
+    failedDocumentIds = []
+    phrases = {}
+    statistics = {}
+    # content hash and version of each document, None for documents deleted from the corpus
+    documentVersions = {}
+    annotations = {}
+    if self.incremental:
+      try:
+        annotations = self.__getAnnotations(documentIds)
+      except:
+        error = sys.exc_info()
+        self.logger.error("Error getting annotated documents: " + str(error))
+        failedDocumentIds = list(documentIds)
+        documentIds = []
+    for documentId in documentIds:
+      try:
+        document = self.__getDocument(documentId)
+        if document == None:
+          documentVersions[documentId] = None
+        else:
+          documentVersions[documentId] = {"content_hash": self.__contentHash(document), "version": document["_version"]}
+          # a document whose version changed but whose text did not is not annotated again
+          if documentId not in annotations or annotations[documentId].get("content_hash") != documentVersions[documentId]["content_hash"]:
+            statistics[documentId] = self.__annotateDocument(document, phrases)
+      except:
+        error = sys.exc_info()
+        self.logger.error("Error annotating document " + documentId + ": " + str(error))
+        failedDocumentIds.append(documentId)
+      else:
+        annotatedDocumentIds.append(documentId)
+    for documentId in self.__runProcessors(filter(lambda x: x in statistics, annotatedDocumentIds)):
+      if documentId in annotatedDocumentIds:
+        annotatedDocumentIds.remove(documentId)
+        failedDocumentIds.append(documentId)
+    with self.metrics.timer("index_phrases"):
+      failedPhraseDocumentIds = self.__indexPhrases(phrases)
+    for documentId in failedPhraseDocumentIds:
+      if documentId in annotatedDocumentIds:
+        annotatedDocumentIds.remove(documentId)
+        failedDocumentIds.append(documentId)
+    if self.dirtyPhrases != None:
+      with self.metrics.timer("record_changes"):
+        failedChangeDocumentIds = self.__recordChanges(annotatedDocumentIds, statistics, documentVersions, annotations)
+      for documentId in failedChangeDocumentIds:
+        annotatedDocumentIds.remove(documentId)
+        failedDocumentIds.append(documentId)
+    with self.metrics.timer("store_annotations"):
+      failedAnnotationDocumentIds = self.__storeAnnotations(annotatedDocumentIds, statistics, documentVersions, annotations)
+    for documentId in failedAnnotationDocumentIds:
+      annotatedDocumentIds.remove(documentId)
+      failedDocumentIds.append(documentId)
+    documentPhraseIds = dict(map(lambda x: (x, statistics[x][1].keys()), filter(lambda x: x in statistics, annotatedDocumentIds)))
+    return annotatedDocumentIds, failedDocumentIds, documentPhraseIds
+
+  # returns None for a document that was deleted from the corpus when annotating incrementally
+  def __getDocument(self, documentId):
+    try:
+      return self.esClient.get(index=self.corpusIndex, doc_type=self.corpusType, id = documentId, fields=self.corpusFields)
+    except NotFoundError:
+      if self.incremental: return None
+      raise
+
+  def __contentHash(self, document):
+    return hashlib.md5(json.dumps(document.get("fields", {}), sort_keys=True)).hexdigest()
+
+  # returns the annotated documents that exist, keyed by document id
+  def __getAnnotations(self, documentIds):
+    fields = ["content_hash", "shingles", "shingle_counts", "shingle_length"]
+    documents = self.esClient.mget(index=self.processorIndex, doc_type=self.processorType, body={"ids": documentIds}, _source_include=fields)["docs"]
+    return dict(map(lambda x: (x["_id"], x.get("_source", {})), filter(lambda x: x.get("found", False), documents)))
+
+  # returns the length and shingle counts an annotated document was stored with, None when it has none
+  def __annotationCounts(self, annotation):
+    if "shingle_counts" not in annotation: return None
+    return annotation.get("shingle_length", 0), dict(zip(annotation["shingles"], annotation["shingle_counts"]))
+
+  # collects the document's phrases into 'phrases' (keyed by phrase id, first document wins),
+  # returns the length of the document in shingles and the number of occurrences of each of its phrases
+  def __annotateDocument(self, document, phrases):
+    length = 0
+    shingleCounts = {}
+    if "fields" in document:  
+      for field in self.corpusFields:
+        shingles = []
+        if field in document["fields"]:
+          if type(document["fields"][field]) is list:
+            for element in document["fields"][field]:
+              if len(element) > 0:
+                shingles += self.__analyze(element)["tokens"]
+          else:
+            if len(document["fields"][field]) > 0:
+              shingles = self.__analyze(document["fields"][field])["tokens"]
+          length += len(shingles)
+          shingles = map(self.__replaceUnderscore, shingles)
+          shingles = filter(self.__filterTokens, shingles)
+        if shingles != None and len(shingles) > 0:
+          for shingle in shingles:
+            phrase = shingle["token"]
+            key = self.__keyify(phrase)
+            if len(key) > 0:
+              if key not in phrases:
+                phrases[key] = {"phrase": phrase,"phrase__not_analyzed": phrase,"document_id": document["_id"]}
+              shingleCounts[key] = shingleCounts.get(key, 0) + 1
+    return length, shingleCounts
+
+  # processors that implement annotateDocuments get the whole batch at once, returns ids of the documents that failed
+  def __runProcessors(self, documentIds):
+    failedDocumentIds = set()
+    for processorInstance in self.config["processor_instances"]:
+      pendingDocumentIds = filter(lambda x: x not in failedDocumentIds, documentIds)
+      if len(pendingDocumentIds) == 0: break
+      if hasattr(processorInstance, "annotateDocuments"):
+        try:
+          with self.metrics.timer("processor", {"processor": processorInstance.__name__, "call": "annotateDocuments"}):
+            failedDocumentIds.update(processorInstance.annotateDocuments(self.config, pendingDocumentIds))
+        except:
+          error = sys.exc_info()
+          self.logger.error("Error running processor " + processorInstance.__name__ + ": " + str(error))
+          failedDocumentIds.update(pendingDocumentIds)
+      else:
+        for documentId in pendingDocumentIds:
+          try:
+            with self.metrics.timer("processor", {"processor": processorInstance.__name__, "call": "annotate"}):
+              processorInstance.annotate(self.config, documentId)
+          except:
+            error = sys.exc_info()
+            self.logger.error("Error running processor " + processorInstance.__name__ + " on document " + documentId + ": " + str(error))
+            failedDocumentIds.add(documentId)
+    return failedDocumentIds
+
+  def __analyze(self, text):
+    with self.metrics.timer("analyze"):
+      if self.shingleAnalyzer != None:
+        return self.shingleAnalyzer.analyze(text)
+      return self.esClient.indices.analyze(index=self.analyzerIndex, body=text, analyzer="analyzer_shingle")
+
+  # writes phrases with create-if-absent semantics, returns ids of the documents whose phrases could not be written
+  def __indexPhrases(self, phrases):
+    actions = []
+    for key, data in phrases.iteritems():
+      actions.append({"_op_type": "create", "_index": self.processorIndex, "_type": self.processorPhraseType, "_id": key, "_source": data})
+    failedDocumentIds = set()
+    if len(actions) == 0: return failedDocumentIds
+    try:
+      success, errors = helpers.bulk(self.esClient, actions, chunk_size=self.bulkSize, raise_on_error=False)
+    except:
+      error = sys.exc_info()
+      self.logger.error("Error indexing phrases: " + str(error))
+      return set(map(lambda x: x["document_id"], phrases.values()))
+    for error in errors:
+      result = error.values()[0]
+      # phrase already exists
+      if result["status"] == 409: continue
+      self.logger.error("Error indexing phrase '" + result["_id"] + "': " + str(result))
+      if result["_id"] in phrases:
+        failedDocumentIds.add(phrases[result["_id"]]["document_id"])
+    self.logger.info("Indexed " + str(success) + " new phrases out of " + str(len(actions)))
+    return failedDocumentIds
+
+  # adds the phrases of added, changed and deleted documents to the dirty phrases, and the phrases that
+  # changed and deleted documents no longer contain to the retracted phrases, returns ids of the documents
+  # whose changes could not be recorded
+  def __recordChanges(self, documentIds, statistics, documentVersions, annotations):
+    dirtyPhraseIds = set()
+    retractedPhraseIds = set()
+    for documentId in documentIds:
+      if documentVersions[documentId] != None and documentId not in statistics: continue
+      shingles = set()
+      if documentId in statistics: shingles = set(statistics[documentId][1].keys())
+      previousShingles = set()
+      if documentId in annotations: previousShingles = set(annotations[documentId].get("shingles", []))
+      dirtyPhraseIds.update(shingles | previousShingles)
+      retractedPhraseIds.update(previousShingles - shingles)
+    try:
+      self.dirtyPhrases.add(list(dirtyPhraseIds), list(retractedPhraseIds))
+    except:
+      error = sys.exc_info()
+      self.logger.error("Error recording changed phrases: " + str(error))
+      return set(documentIds)
+    return set()
+
+  # records the shingle counts, content hash and version of each document in its annotated document, deletes
+  # the annotated documents of documents deleted from the corpus and keeps the corpus statistics in step,
+  # returns ids of the documents whose annotations could not be stored
+  def __storeAnnotations(self, documentIds, statistics, documentVersions, annotations):
+    failedDocumentIds = set()
+    # the previous counts of changed and deleted documents leave the statistics before their annotated document is replaced
+    if self.corpusStatistics != None:
+      for documentId in documentIds:
+        if documentId not in annotations or (documentVersions[documentId] != None and documentId not in statistics): continue
+        counts = self.__annotationCounts(annotations[documentId])
+        if counts == None: continue
+        try:
+          self.corpusStatistics.removeDocument(documentId, counts[0], counts[1])
+        except:
+          error = sys.exc_info()
+          self.logger.error("Error removing statistics of document '" + documentId + "': " + str(error))
+          failedDocumentIds.add(documentId)
+    actions = []
+    for documentId in documentIds:
+      if documentId in failedDocumentIds: continue
+      if documentVersions[documentId] == None:
+        actions.append({"_op_type": "delete", "_index": self.processorIndex, "_type": self.processorType, "_id": documentId})
+        continue
+      data = dict(documentVersions[documentId])
+      if documentId in statistics:
+        length, shingleCounts = statistics[documentId]
+        data.update({"shingles": shingleCounts.keys(), "shingle_counts": shingleCounts.values(), "shingle_length": length})
+      actions.append({"_op_type": "update", "_index": self.processorIndex, "_type": self.processorType, "_id": documentId, "doc": data, "doc_as_upsert": True})
+    if len(actions) == 0: return failedDocumentIds
+    try:
+      success, errors = helpers.bulk(self.esClient, actions, chunk_size=self.bulkSize, raise_on_error=False)
+    except:
+      error = sys.exc_info()
+      self.logger.error("Error storing annotated documents: " + str(error))
+      return set(documentIds)
+    for error in errors:
+      result = error.values()[0]
+      # annotated document already deleted
+      if error.keys()[0] == "delete" and result["status"] == 404: continue
+      self.logger.error("Error storing annotated document '" + result["_id"] + "': " + str(result))
+      failedDocumentIds.add(result["_id"])
+    if self.corpusStatistics == None: return failedDocumentIds
+    for documentId in documentIds:
+      if documentId in failedDocumentIds or documentVersions[documentId] == None: continue
+      if documentId in statistics:
+        counts = statistics[documentId]
+      else:
+        # adding an unchanged document again is ignored, unless an earlier attempt failed to add it
+        counts = self.__annotationCounts(annotations[documentId])
+        if counts == None: continue
+      try:
+        self.corpusStatistics.addDocument(documentId, counts[0], counts[1])
+      except:
+        error = sys.exc_info()
+        self.logger.error("Error merging statistics of document '" + documentId + "': " + str(error))
+        failedDocumentIds.add(documentId)
+    return failedDocumentIds
+
   def unregisterDispatcher(self, dispatcher, message):
     if message == "dying":
       self.dispatchers.pop(dispatcher, None)
 
     if len(self.dispatchers) == 0:
-      self.worker.send(content="kill", to=self.workerName)
+      with self.messagePool.channelLock:
+        self.worker.send(content="kill", to=self.workerName)
 
   def __keyify(self, phrase):
     phrase = phrase.strip()
@@ -3,8 +3,13 @@ import os
 import os.path
 import json
 import re
-from elasticsearch import Elasticsearch
-from muppet import DurableChannel, RemoteChannel
+import threading
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.scroll_iterator import ScrollIterator
+from src.dispatch_checkpoint import DispatchCheckpoint
+from src.dispatch_window import DispatchWindow
 
 __name__ = "classification_dispatcher"
 
@@ -13,7 +18,8 @@ class ClassificationDispatcher:
   def __init__(self, config, processingStartIndex, processingEndIndex):
     self.config = config
     self.logger = config["logger"]
-    self.esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
+    self.metrics = metrics.Metrics(config, "classification_dispatcher")
+    self.esClient = es_client.getClient(config, self.metrics)
     self.config["processingStartIndex"] = processingStartIndex
     self.config["processingEndIndex"] = processingEndIndex
     self.bagOfPhrases = {}
@@ -23,6 +29,11 @@ class ClassificationDispatcher:
     self.processorType = config["processor"]["type"]
     self.processorPhraseType = config["processor"]["type"]+"__phrase"
     self.processingPageSize = config["processingPageSize"]
+    self.dispatchBatchSize = 1
+    if "dispatchBatchSize" in config: self.dispatchBatchSize = config["dispatchBatchSize"]
+    self.window = DispatchWindow(config, self.dispatchBatchSize)
+    # guards the window, the counters and the checkpoint, which timeoutCallback updates from the channel's timeout thread
+    self.stateLock = threading.RLock()
     config["processor_phrase_type"] = self.processorPhraseType
     
     self.featureNames = map(lambda x: x["name"], config["generator"]["features"])
@@ -36,6 +47,10 @@ class ClassificationDispatcher:
     self.dispatcherName = "bayzee.classification.dispatcher"
     if processingEndIndex != None:
       self.dispatcherName += "." + str(processingStartIndex) + "." + str(processingEndIndex)
+    self.checkpoint = DispatchCheckpoint(config, self.dispatcherName)
+    self.resumeState = None
+    if "resumeDispatch" not in config or config["resumeDispatch"] == True:
+      self.resumeState = self.checkpoint.load()
     self.workerName = "bayzee.classification.worker"
     
     # creating generation dispatcher
@@ -45,61 +60,104 @@ class ClassificationDispatcher:
     self.controlChannel = RemoteChannel(self.dispatcherName, config)
 
   def dispatchToClassify(self):
+    self.metrics.start()
     processorIndex = self.config["processor"]["index"]
     phraseProcessorType = self.config["processor"]["type"] + "__phrase"
-    nextPhraseIndex = 0
-    if self.config["processingStartIndex"] != None: nextPhraseIndex = self.config["processingStartIndex"]
-    endPhraseIndex = -1
-    if self.config["processingEndIndex"] != None: endPhraseIndex = self.config["processingEndIndex"]
-    
-    if endPhraseIndex != -1 and self.processingPageSize > (endPhraseIndex - nextPhraseIndex):
-      self.processingPageSize = endPhraseIndex - nextPhraseIndex + 1
-    
-    while True:
-      phrases = self.esClient.search(index=processorIndex, doc_type=phraseProcessorType, body={"from": nextPhraseIndex,"size": self.processingPageSize, "query":{"match_all":{}},"sort":[{"phrase__not_analyzed":{"order":"asc"}}]}, fields=["_id"])
-      if len(phrases["hits"]["hits"]) == 0: break
-      self.totalPhrasesDispatched += len(phrases["hits"]["hits"])
-      floatPrecision = "{0:." + str(self.config["generator"]["floatPrecision"]) + "f}"
-      self.logger.info("Classifying phrases from " + str(nextPhraseIndex) + " to " + str(nextPhraseIndex+len(phrases["hits"]["hits"])) + " phrases...")
-      for phraseData in phrases["hits"]["hits"]:
-        self.logger.info("Dispatched phrase " + phraseData["_id"])
-        content = {"phraseId": phraseData["_id"], "type": "classify", "count": 1, "from": self.dispatcherName}
-        self.classificationDispatcher.send(content, self.workerName, self.timeout)
-  
-      nextPhraseIndex += len(phrases["hits"]["hits"])
-      if endPhraseIndex != -1 and nextPhraseIndex >= endPhraseIndex: break
+    startIndex = self.config["processingStartIndex"]
+    if self.resumeState != None:
+      # only the phrases that were dispatched but not acknowledged are sent again
+      startIndex = self.resumeState["position"]
+      self.totalPhrasesDispatched = self.resumeState["dispatched"]
+      self.phrasesClassified = self.resumeState["acknowledged"]
+      self.phrasesNotClassified = self.resumeState["failed"]
+      self.logger.info("Resuming after phrase " + str(self.resumeState["cursor"]) + ": " + str(self.totalPhrasesDispatched) + " dispatched, " + str(self.phrasesClassified) + " classified, " + str(self.phrasesNotClassified) + " failed, " + str(len(self.resumeState["pending"])) + " pending")
+      self.__send(self.resumeState["pending"])
+    else:
+      if startIndex == None: startIndex = 0
+      self.checkpoint.start(startIndex)
+
+    phrases = ScrollIterator(self.esClient, processorIndex, phraseProcessorType, {"match_all":{}}, [{"phrase__not_analyzed":{"order":"asc"}}], self.processingPageSize, startIndex, self.config["processingEndIndex"])
+    for nextPhraseIndex, phraseIds in phrases.pages():
+      with self.stateLock:
+        self.totalPhrasesDispatched += len(phraseIds)
+        self.checkpoint.dispatch(phraseIds, nextPhraseIndex + len(phraseIds), self.totalPhrasesDispatched)
+      self.metrics.increment("bayzee_dispatched_items_total", len(phraseIds))
+      self.logger.info("Classifying phrases from " + str(nextPhraseIndex) + " to " + str(nextPhraseIndex+len(phraseIds)) + " phrases...")
+      self.__send(phraseIds)
     
     self.logger.info("Dispatched " + str(self.totalPhrasesDispatched) + " phrases")
-    
-    while True:
-      message = self.classificationDispatcher.receive()
-      if "phraseId" in message["content"] and message["content"]["phraseId"] > 0:
-        self.phrasesClassified += 1
-        self.classificationDispatcher.close(message)
-        self.logger.info("Classified phrase " + message["content"]["phraseId"] + " " + str(self.phrasesClassified) + "/" + str(self.totalPhrasesDispatched))
-      
-      if (self.phrasesClassified + self.phrasesNotClassified) >= self.totalPhrasesDispatched:
-        self.controlChannel.send("dying")
-        self.classificationDispatcher.end()
-        break
-    
+
+    while (self.phrasesClassified + self.phrasesNotClassified) < self.totalPhrasesDispatched:
+      self.__receive()
+
+    self.controlChannel.send("dying")
+    self.classificationDispatcher.end()
+    self.checkpoint.clear()
     self.__terminate()
 
+  def __receive(self):
+    message = self.classificationDispatcher.receive()
+    with self.stateLock:
+      if "phraseIds" in message["content"]:
+        failedPhraseIds = message["content"]["failedPhraseIds"]
+        classifiedPhraseIds = filter(lambda x: x not in failedPhraseIds, message["content"]["phraseIds"])
+        # replies to messages sent before a restart may arrive twice, only new acknowledgements count
+        classified = self.checkpoint.acknowledge(classifiedPhraseIds)
+        self.phrasesClassified += classified
+        self.window.completed(classified)
+        self.metrics.increment("bayzee_items_total", classified, {"status": "processed"})
+        self.classificationDispatcher.close(message)
+        self.logger.info("Classified " + str(len(classifiedPhraseIds)) + " phrases - " + str(self.phrasesClassified) + "/" + str(self.totalPhrasesDispatched))
+        if len(failedPhraseIds) > 0:
+          self.logger.info("Failed to classify phrases " + ", ".join(failedPhraseIds))
+          if message["content"]["count"] < 5:
+            self.metrics.increment("bayzee_retries_total", 1, {"reason": "failed"})
+            content = {"phraseIds": failedPhraseIds, "type": "classify", "count": message["content"]["count"] + 1, "from": self.dispatcherName}
+            self.classificationDispatcher.send(content, self.workerName, self.timeout)
+          else:
+            notClassified = self.checkpoint.fail(failedPhraseIds)
+            self.phrasesNotClassified += notClassified
+            self.window.completed(notClassified)
+            self.metrics.increment("bayzee_items_total", notClassified, {"status": "failed"})
+
+      self.metrics.setGauge("bayzee_pending_items", self.totalPhrasesDispatched - self.phrasesClassified - self.phrasesNotClassified)
+      self.metrics.setGauge("bayzee_dispatch_window", self.window.size)
+
+  # replies are received while the window is full, so that the phrases are sent as workers free up
+  def __send(self, phraseIds):
+    for i in range(0, len(phraseIds), self.dispatchBatchSize):
+      batch = phraseIds[i:i+self.dispatchBatchSize]
+      while self.window.isFull(len(batch)):
+        self.__receive()
+      self.logger.info("Dispatched " + str(len(batch)) + " phrases starting at " + batch[0])
+      content = {"phraseIds": batch, "type": "classify", "count": 1, "from": self.dispatcherName}
+      with self.stateLock:
+        with self.metrics.timer("send"):
+          self.classificationDispatcher.send(content, self.workerName, self.timeout)
+        self.window.sent(len(batch))
+
 
   def timeoutCallback(self, message):
     self.logger.info("Message timed out: " + str(message))
-    if message["content"]["count"] < 5:
-      message["content"]["count"] += 1
-      self.classificationDispatcher.send(message["content"], self.workerName, self.timeout)
-    else:
-      #log implementation yet to be done for expired phrases
-      self.phrasesNotClassified += 1
-      if self.phrasesNotClassified == self.totalPhrasesDispatched or (self.phrasesClassified + self.phrasesNotClassified) == self.totalPhrasesDispatched:
-        self.__terminate()
+    with self.stateLock:
+      if message["content"]["count"] < 5:
+        message["content"]["count"] += 1
+        self.metrics.increment("bayzee_retries_total", 1, {"reason": "timeout"})
+        self.classificationDispatcher.send(message["content"], self.workerName, self.timeout)
+      else:
+        self.logger.info("Giving up on phrases " + ", ".join(message["content"]["phraseIds"]))
+        notClassified = self.checkpoint.fail(message["content"]["phraseIds"])
+        self.phrasesNotClassified += notClassified
+        self.window.completed(notClassified)
+        self.metrics.increment("bayzee_items_total", notClassified, {"status": "failed"})
+        if self.phrasesNotClassified == self.totalPhrasesDispatched or (self.phrasesClassified + self.phrasesNotClassified) == self.totalPhrasesDispatched:
+          self.__terminate()
 
   def __terminate(self):
     self.logger.info(str(self.totalPhrasesDispatched) + " total dispatched")
     self.logger.info(str(self.phrasesClassified) + " classified")
     self.logger.info(str(self.phrasesNotClassified) + " failed to classify")
     self.logger.info("Classification complete")
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
     self.logger.info("Terminating classification dispatcher")
\ No newline at end of file
@@ -0,0 +1,131 @@
+import sys
+import time
+import multiprocessing
+import orange
+from src import es_client
+from src import classification_model
+from src.naive_bayes_scorer import NaiveBayesScorer
+
+__name__ = "classification_evaluator"
+
+# tables shared with the evaluation processes, set before they are forked so that nothing
+# but fold numbers and measures goes through the queues
+evaluationData = None
+
+# trains on the training set without one fold and scores that fold, or (fold None) trains on the
+# whole training set and scores the hold-out set
+def runEvaluation(name, fold):
+  start = time.time()
+  features = evaluationData["features"]
+  trainingTable = evaluationData["trainingTable"]
+  if fold == None:
+    trainD = trainingTable
+    testD = evaluationData["holdOutTable"]
+  else:
+    trainD = trainingTable.select(evaluationData["folds"], fold, negate=1)
+    testD = trainingTable.select(evaluationData["folds"], fold)
+  trainD = classification_model.discretize(trainD)
+  testD = orange.ExampleTable(trainD.domain, testD)
+  classifier = classification_model.train(trainD, features)
+  scorer = NaiveBayesScorer(classifier, map(lambda x: x["name"], features))
+  featureSets = map(lambda x: classification_model.getFeatureSet(x, features), testD)
+  probs, classTypes = scorer.score(featureSets, "1")
+  measures = classification_model.calculateMeasures(map(lambda x: x[-1].value, testD), classTypes)
+  return {"name": name, "measures": measures, "trainingSize": len(trainD), "testSize": len(testD), "time": time.time() - start}
+
+# body of the evaluation processes
+def runEvaluations(tasks, results):
+  while True:
+    task = tasks.get()
+    if task == None: break
+    try:
+      results.put(runEvaluation(*task))
+    except:
+      error = sys.exc_info()
+      results.put({"name": task[0], "error": str(error)})
+
+# Evaluates the classifier with k-fold cross-validation on the training set and on the hold-out set.
+# Labeled phrases are loaded once, and the folds and the hold-out evaluation run in parallel processes.
+class ClassificationEvaluator:
+
+  def __init__(self, config):
+    self.config = config
+    self.logger = config["logger"]
+    self.esClient = es_client.getClient(config)
+    self.features = classification_model.getFeatures(config)
+    self.folds = 10
+    if "evaluationFolds" in config["classifier"]: self.folds = config["classifier"]["evaluationFolds"]
+    self.processes = 0
+    if "evaluationProcesses" in config["classifier"]: self.processes = config["classifier"]["evaluationProcesses"]
+    if self.processes <= 0: self.processes = multiprocessing.cpu_count()
+
+  def evaluate(self):
+    global evaluationData
+    start = time.time()
+    domain = classification_model.createDomain(self.features)
+    phrases = classification_model.loadLabeledPhrases(self.esClient, self.config, "is_training")
+    trainingTable = classification_model.createTable(domain, self.features, phrases, "is_training", self.logger)
+    phrases = classification_model.loadLabeledPhrases(self.esClient, self.config, "is_holdout")
+    holdOutTable = classification_model.createTable(domain, self.features, phrases, "is_holdout", self.logger)
+    self.logger.info("Loaded " + str(len(trainingTable)) + " training and " + str(len(holdOutTable)) + " hold-out phrases in " + str(round(time.time() - start, 2)) + "s")
+    evaluationData = {"features": self.features, "trainingTable": trainingTable, "holdOutTable": holdOutTable}
+
+    tasks = []
+    if self.folds > 1:
+      evaluationData["folds"] = orange.MakeRandomIndicesCV(trainingTable, self.folds)
+      for fold in range(self.folds):
+        tasks.append(("Fold " + str(fold + 1), fold))
+    if len(holdOutTable) > 0:
+      tasks.append(("Hold-out", None))
+
+    results = self.__run(tasks)
+    foldResults = []
+    for result in results:
+      if "error" in result:
+        self.logger.error(result["name"] + " failed: " + result["error"])
+        continue
+      self.__logResult(result)
+      if result["name"] != "Hold-out": foldResults.append(result)
+    if len(foldResults) > 0:
+      self.logger.info("Mean of " + str(len(foldResults)) + " folds:")
+      for measureName in classification_model.MEASURE_NAMES:
+        mean = sum(map(lambda x: x["measures"][measureName], foldResults)) / len(foldResults)
+        self.logger.info("  " + measureName + ": " + str(round(mean, 2)) + "%")
+    self.logger.info("Evaluation completed in " + str(round(time.time() - start, 2)) + "s")
+    self.logger.info("Terminating classification evaluator")
+
+  # returns the results of the tasks, in the order of the tasks
+  def __run(self, tasks):
+    processes = min(self.processes, len(tasks))
+    if processes <= 1:
+      return map(self.__runInProcess, tasks)
+    taskQueue = multiprocessing.Queue()
+    resultQueue = multiprocessing.Queue()
+    for task in tasks:
+      taskQueue.put(task)
+    workers = []
+    for i in range(processes):
+      taskQueue.put(None)
+      worker = multiprocessing.Process(target=runEvaluations, args=(taskQueue, resultQueue))
+      worker.start()
+      workers.append(worker)
+    self.logger.info("Running " + str(len(tasks)) + " evaluations in " + str(processes) + " processes")
+    results = {}
+    for i in range(len(tasks)):
+      result = resultQueue.get()
+      results[result["name"]] = result
+    for worker in workers:
+      worker.join()
+    return map(lambda x: results[x[0]], tasks)
+
+  def __runInProcess(self, task):
+    try:
+      return runEvaluation(*task)
+    except:
+      error = sys.exc_info()
+      return {"name": task[0], "error": str(error)}
+
+  def __logResult(self, result):
+    self.logger.info(result["name"] + ": trained on " + str(result["trainingSize"]) + " phrases, tested on " + str(result["testSize"]) + " phrases in " + str(round(result["time"], 2)) + "s")
+    for measureName in classification_model.MEASURE_NAMES:
+      self.logger.info("  " + measureName + ": " + str(round(result["measures"][measureName], 2)) + "%")
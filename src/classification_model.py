@@ -0,0 +1,153 @@
+import os
+import os.path
+import pickle
+import time
+import orange
+import nltk
+
+__name__ = "classification_model"
+
+# bump whenever the layout of the saved model changes
+MODEL_VERSION = 1
+
+def getFeatures(config):
+  features = config["generator"]["features"]
+  for module in config["processor"]["modules"]:
+    features = features + module["features"]
+  return features
+
+def __getOrangeVariableForFeature(feature):
+  if feature["isNumerical"]:
+    return orange.FloatVariable(feature["name"])
+  else:
+    return orange.EnumVariable(feature["name"])
+
+def createDomain(features):
+  attributes = map(__getOrangeVariableForFeature, features)
+  classAttribute = orange.EnumVariable("is_good", values = ["0", "1"])
+  domain = orange.Domain(attributes, classAttribute)
+  domain.addmeta(orange.newmetaid(), orange.StringVariable("phrase"))
+  return domain
+
+def loadLabeledPhrases(esClient, config, labelField):
+  processorIndex = config["processor"]["index"]
+  processorPhraseType = config["processor"]["type"] + "__phrase"
+  query = {"query":{"terms":{labelField:["1","0"]}}}
+  phrasesCount = esClient.count(index=processorIndex, doc_type=processorPhraseType, body=query)
+  phrases = esClient.search(index=processorIndex, doc_type=processorPhraseType, body=query, size=phrasesCount["count"])
+  return map(lambda x: x["_source"], phrases["hits"]["hits"])
+
+# builds an orange example out of a phrase record, labelField is None for unlabeled phrases
+def createExample(domain, features, row, labelField):
+  featureValues = []
+  classType = "?"
+  for feature in features:
+    featureValues.append(row["features"][feature["name"]].encode("ascii"))
+  if labelField != None:
+    classType = row[labelField].encode("ascii", "ignore")
+  for i,featureValue in enumerate(featureValues):
+    attr = domain.attributes[i]
+    if type(attr) is orange.EnumVariable:
+      attr.addValue(featureValue)
+  example = orange.Example(domain, (featureValues + [classType]))
+  example[domain.getmetas().items()[0][0]] = row["phrase"].encode("ascii")
+  return example
+
+# builds an orange table out of phrase records, phrases that can't be loaded are skipped
+def createTable(domain, features, phrases, labelField, logger):
+  table = orange.ExampleTable(domain)
+  for row in phrases:
+    try:
+      table.append(createExample(domain, features, row, labelField))
+    except:
+      logger.error("Error loading phrase '" + row["phrase"] + "'")
+  return table
+
+def discretize(table):
+  return orange.Preprocessor_discretize(table, method=orange.EntropyDiscretization())
+
+def getFeatureSet(row, features):
+  featureSet = {}
+  for i,feature in enumerate(features):
+    featureSet[feature["name"]] = row[i].value
+  return featureSet
+
+def train(discretizedTable, features):
+  trainSet = []
+  for row in discretizedTable:
+    trainSet.append((getFeatureSet(row, features), row[-1].value))
+  return nltk.NaiveBayesClassifier.train(trainSet)
+
+MEASURE_NAMES = ["Precision of Good", "Recall of Good", "Balanced F-measure of Good", "Precision of Bad", "Recall of Bad", "Balanced F-measure of Bad"]
+
+def __percent(count, total):
+  if total == 0: return 0.0
+  return 100.0 * count / total
+
+def __fMeasure(precision, recall):
+  if precision + recall == 0: return 0.0
+  return 2.0 * precision * recall / (precision + recall)
+
+# precision, recall and balanced F-measure of both classes in percent, measures without any phrase to count are 0
+def calculateMeasures(actualClassTypes, classTypes):
+  truePositives = 0
+  trueNegatives = 0
+  totalPositives = 0
+  totalNegatives = 0
+  totalGoodPhrases = 0
+  totalBadPhrases = 0
+  for actualClassType, classType in zip(actualClassTypes, classTypes):
+    if classType == "1":
+      totalPositives += 1
+      if classType == actualClassType:
+        truePositives += 1
+    else:
+      totalNegatives += 1
+      if classType == actualClassType:
+        trueNegatives += 1
+
+    if actualClassType == "1":
+      totalGoodPhrases += 1
+    else:
+      totalBadPhrases += 1
+
+  measures = {}
+  measures["Precision of Good"] = __percent(truePositives, totalPositives)
+  measures["Recall of Good"] = __percent(truePositives, totalGoodPhrases)
+  measures["Balanced F-measure of Good"] = __fMeasure(measures["Precision of Good"], measures["Recall of Good"])
+  measures["Precision of Bad"] = __percent(trueNegatives, totalNegatives)
+  measures["Recall of Bad"] = __percent(trueNegatives, totalBadPhrases)
+  measures["Balanced F-measure of Bad"] = __fMeasure(measures["Precision of Bad"], measures["Recall of Bad"])
+  return measures
+
+def save(model, filePath):
+  modelDir = os.path.dirname(filePath)
+  if not os.path.exists(modelDir):
+    os.makedirs(modelDir)
+  # write to a temporary file first so that workers never load a half written model
+  tempFilePath = filePath + "." + str(os.getpid()) + ".tmp"
+  modelFile = open(tempFilePath, "wb")
+  pickle.dump(model, modelFile, pickle.HIGHEST_PROTOCOL)
+  modelFile.close()
+  os.rename(tempFilePath, filePath)
+
+def load(filePath, features):
+  modelFile = open(filePath, "rb")
+  model = pickle.load(modelFile)
+  modelFile.close()
+  if model["version"] != MODEL_VERSION:
+    raise Exception("Model '" + filePath + "' has version " + str(model["version"]) + ", expected " + str(MODEL_VERSION))
+  if model["features"] != map(lambda x: x["name"], features):
+    raise Exception("Model '" + filePath + "' was trained with features " + ", ".join(model["features"]))
+  return model
+
+def create(domain, discretizedTable, classifier, features):
+  return {
+    "version": MODEL_VERSION,
+    "trainedAt": time.time(),
+    "features": map(lambda x: x["name"], features),
+    "trainingSize": len(discretizedTable),
+    "domain": domain,
+    "discretizedDomain": discretizedTable.domain,
+    "classifier": classifier
+  }
@@ -0,0 +1,32 @@
+import sys
+from src import es_client
+from src import classification_model
+
+__name__ = "classification_trainer"
+
+class ClassificationTrainer:
+
+  def __init__(self, config):
+    self.config = config
+    self.logger = config["logger"]
+    self.esClient = es_client.getClient(config)
+    self.features = classification_model.getFeatures(config)
+    self.modelFilePath = config["classifier"]["modelFilePath"]
+
+  def train(self):
+    phrases = classification_model.loadLabeledPhrases(self.esClient, self.config, "is_training")
+    domain = classification_model.createDomain(self.features)
+    trainD = classification_model.createTable(domain, self.features, phrases, "is_training", self.logger)
+    trainD = classification_model.discretize(trainD)
+    for a in trainD.domain.attributes:
+      self.logger.info("%s: %s" % (a.name,reduce(lambda x,y: x+', '+y, [i for i in a.values])))
+
+    self.logger.info("Training Naive Bayes Classifier with " + str(len(trainD)) + " phrases...")
+    classifier = classification_model.train(trainD, self.features)
+    classifier.show_most_informative_features(50)
+
+    model = classification_model.create(domain, trainD, classifier, self.features)
+    classification_model.save(model, self.modelFilePath)
+    self.logger.info("Saved classification model to '" + self.modelFilePath + "'")
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.logger.info("Terminating classification trainer")
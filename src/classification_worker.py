@@ -1,218 +1,145 @@
-import csv
-import math
 import orange
 import sys
-import os.path
-import pickle
-import nltk
 import time
-from elasticsearch import Elasticsearch
-from muppet import DurableChannel, RemoteChannel
+from elasticsearch import helpers
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.message_pool import MessagePool
+from src import classification_model
+from src.naive_bayes_scorer import NaiveBayesScorer
 
 __name__ = "classification_worker"
 
 class ClassificationWorker:
 
-  def __init__(self, config):
+  # a stream worker runs the worker's batches itself, with its own metrics and message pool
+  def __init__(self, config, workerMetrics = None, messagePool = None):
     self.config = config
     self.logger = config["logger"]
-    self.esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
-    self.trainD = None
-    self.classifier = None
-    self.phraseId = None
-    self.phraseData = None
+    self.metrics = workerMetrics
+    if self.metrics == None: self.metrics = metrics.Metrics(config, "classification_worker")
+    self.esClient = es_client.getClient(config, self.metrics)
+    self.model = None
     self.processorIndex = config["processor"]["index"]
     self.processorType = config["processor"]["type"]
     self.processorPhraseType = config["processor"]["type"]+"__phrase"
-    self.features = self.config["generator"]["features"]
-    for module in self.config["processor"]["modules"]:
-      self.features = self.features + module["features"]
+    self.features = classification_model.getFeatures(config)
+    self.modelFilePath = config["classifier"]["modelFilePath"]
+    self.bulkSize = 500
+    if "indexingBulkSize" in config: self.bulkSize = config["indexingBulkSize"]
+    
+    # loading the model trained by the classification trainer, unless a worker supervisor already did
+    if "classification_model" in config:
+      self.model = config["classification_model"]
+    else:
+      try:
+        self.model = classification_model.load(self.modelFilePath, self.features)
+      except:
+        error = sys.exc_info()
+        self.logger.error("Failed to load classification model, run 'bin/dispatcher -t' first: " + str(error))
+        sys.exit(1)
+    self.scorer = NaiveBayesScorer(self.model["classifier"], self.model["features"])
 
     self.workerName = "bayzee.classification.worker"
     self.timeout = 600000
     self.dispatchers = {}
     
-    #creating worker
-    self.worker = DurableChannel(self.workerName, config)
+    self.worker = None
+    self.messagePool = messagePool
+    if self.messagePool == None: self.messagePool = MessagePool(config)
 
   def classify(self):
+    self.worker = DurableChannel(self.workerName, self.config)
+    self.metrics.start()
     while True:
       message = self.worker.receive()
       if message["content"] == "kill":
         message["responseId"] = message["requestId"]
-        self.worker.close(message)
+        with self.messagePool.channelLock:
+          self.worker.close(message)
         if len(self.dispatchers) == 0:
+          # replies of the messages being handled are sent before the channel ends
+          self.messagePool.close()
           self.worker.end()
           break
         else:
-          self.worker.send(content="kill", to=self.workerName)
+          with self.messagePool.channelLock:
+            self.worker.send(content="kill", to=self.workerName)
           continue
       elif message["content"]["type"] == "classify":
         if message["content"]["from"] not in self.dispatchers:
           self.dispatchers[message["content"]["from"]] = RemoteChannel(message["content"]["from"], self.config)
           self.dispatchers[message["content"]["from"]].listen(self.unregisterDispatcher)
-        self.phraseId = message["content"]["phraseId"]
-        if self.classifier == None:
-          self.trainD = self.__loadDataFromES("train", None)
-          self.trainD = orange.Preprocessor_discretize(self.trainD, method=orange.EntropyDiscretization())
-          self.__train()
-
-        self.trainD = self.__loadDataFromES("train", None)
-        testD = self.__loadDataFromES("test", self.trainD.domain)
-      
-        self.trainD = orange.Preprocessor_discretize(self.trainD, method=orange.EntropyDiscretization())
-        testD = orange.ExampleTable(self.trainD.domain, testD)
-
-        for row in testD:
-          phrase = row.getmetas().values()[0].value
-          featureSet = {}
-          for i,feature in enumerate(self.features):
-            featureSet[feature["name"]] = row[i].value
-
-          prob = self.classifier.prob_classify(featureSet).prob("1")
-          classType = self.classifier.classify(featureSet)
-          self.phraseData["_source"]["prob"] = prob
-          self.phraseData["_source"]["class_type"] = classType
-          self.logger.info("Classified '" + phrase + "' as " + classType + " with probability " + str(prob))
-          self.esClient.index(index=self.processorIndex, doc_type=self.processorPhraseType, id=self.phraseId, body=self.phraseData["_source"])
-          self.worker.reply(message, {"phraseId": self.phraseId, "status" : "classified", "type" : "reply"}, 120000000)   
+        self.messagePool.submit(self.__classifyMessage, message)
 
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
     self.logger.info("Terminating classification worker")
 
-  def __getOrangeVariableForFeature(self, feature):
-    if feature["isNumerical"]: 
-      return orange.FloatVariable(feature["name"])
-    else:
-      return orange.EnumVariable(feature["name"])
-
-  def __loadDataFromES(self, dataType, domain):
-    table = None
-    if dataType != "train":
-      table = orange.ExampleTable(domain)
-    else:
-      attributes = map(self.__getOrangeVariableForFeature, self.features)
-      classAttribute = orange.EnumVariable("is_good", values = ["0", "1"])
-      domain = orange.Domain(attributes, classAttribute)
-      domain.addmeta(orange.newmetaid(), orange.StringVariable("phrase"))
-      table = orange.ExampleTable(domain)
-    phrases = []
-    if dataType == "train":
-      phrasesCount = self.esClient.count(index=self.processorIndex, doc_type=self.processorPhraseType, body={"query":{"terms":{"is_training":["1","0"]}}})
-      size = phrasesCount["count"]
-      phrases = self.esClient.search(index=self.processorIndex, doc_type=self.processorPhraseType, body={"query":{"terms":{"is_training":["1","0"]}}}, size=size)
-      phrases = phrases["hits"]["hits"]
-    elif dataType == "holdout":
-      phraseCount = self.esClient.count(index=self.processorIndex, doc_type=self.processorPhraseType, body={"query":{"terms":{"is_holdout":["1","0"]}}})
-      size = phrasesCount["count"]
-      phrases = self.esClient.search(index=self.processorIndex, doc_type=self.processorPhraseType, body={"query":{"terms":{"is_holdout":["1","0"]}}}, size=size)
-      phrases = phrases["hits"]["hits"]
-    else:
-      self.phraseData = self.esClient.get(index=self.processorIndex, doc_type=self.processorPhraseType, id=self.phraseId)
-      phrases = [self.phraseData]
-
-    for row in phrases:
+  def __classifyMessage(self, message):
+    start = time.time()
+    classifiedPhraseIds, failedPhraseIds = self.classifyBatch(message["content"]["phraseIds"])
+    self.metrics.recordBatch(time.time() - start, len(classifiedPhraseIds), len(failedPhraseIds))
+    with self.metrics.timer("reply"):
+      with self.messagePool.channelLock:
+        self.worker.reply(message, {"phraseIds": classifiedPhraseIds, "failedPhraseIds": failedPhraseIds, "count": message["content"]["count"], "status" : "classified", "type" : "reply"}, 120000000)   
+
+  # returns the ids of the phrases classified and the ids of the phrases that failed
+  def classifyBatch(self, phraseIds):
+    if len(phraseIds) == 0: return [], []
+    try:
+      failedPhraseIds = self.__classifyPhrases(phraseIds)
+    except:
+      error = sys.exc_info()
+      self.logger.error("Error classifying phrases starting at " + phraseIds[0] + ": " + str(error))
+      failedPhraseIds = set(phraseIds)
+    return filter(lambda x: x not in failedPhraseIds, phraseIds), filter(lambda x: x in failedPhraseIds, phraseIds)
+
+  # classifies a batch of phrases with one mget, one table and one bulk update of prob and class_type,
+  # returns ids of the phrases that could not be classified
+  def __classifyPhrases(self, phraseIds):
+    failedPhraseIds = set()
+    domain = self.model["domain"]
+    table = orange.ExampleTable(domain)
+    tablePhraseIds = []
+    with self.metrics.timer("load_phrases"):
+      phrases = self.esClient.mget(index=self.processorIndex, doc_type=self.processorPhraseType, body={"ids": phraseIds})["docs"]
+    for phraseData in phrases:
+      if not phraseData.get("found", False):
+        self.logger.error("Phrase '" + phraseData["_id"] + "' not found")
+        failedPhraseIds.add(phraseData["_id"])
+        continue
       try:
-        row = row["_source"]
-        featureValues = []
-        classType = "?"
-        for feature in self.features:
-          featureValues.append(row["features"][feature["name"]].encode("ascii"))
-        if dataType == "train":
-          classType = row["is_training"].encode("ascii", "ignore")
-        elif dataType == "holdout":
-          classType = row["is_holdout"].encode("ascii")
-        example = None
-        for i,featureValue in enumerate(featureValues):
-          attr = domain.attributes[i]
-          if type(attr) is orange.EnumVariable: 
-            attr.addValue(featureValue)
-        example = orange.Example(domain, (featureValues + [classType]))
-        example[domain.getmetas().items()[0][0]] = row["phrase"].encode("ascii")
-        table.append(example)
+        table.append(classification_model.createExample(domain, self.features, phraseData["_source"], None))
       except:
-        self.logger.error("Error classifying phrase '" + row["phrase"] + "'")
-    return table
-
-  def __train(self):
-    for a in self.trainD.domain.attributes:
-      self.logger.info("%s: %s" % (a.name,reduce(lambda x,y: x+', '+y, [i for i in a.values])))
-    trainSet = []
-    for row in self.trainD:
-      phrase = row.getmetas().values()[0].value
-      classType = row[-1].value
-
-      featureSet = {}
-      for i,feature in enumerate(self.features):
-        featureSet[feature["name"]] = row[i].value
-
-      trainSet.append((featureSet, classType))
-
-    self.logger.info("\nTraining Naive Bayes Classifier with " + str(len(trainSet)) + " phrases...")
-    self.classifier = nltk.NaiveBayesClassifier.train(trainSet)
-    
-    self.classifier.show_most_informative_features(50)
-
-  def __calculateMeasures(self):
-  
-    falsePositives = 0
-    falseNegatives = 0
-    truePositives = 0
-    trueNegatives = 0
-    totalPositives = 0
-    totalNegatives = 0
-    totalHoldOutGoodPhrases = 0
-    totalHoldOutBadPhrases = 0
-
-    self.trainD = self.__loadDataFromES("train", None)
-    self.holdOutD = self.__loadDataFromES("hold", self.trainD.domain)
-    self.trainD = orange.Preprocessor_discretize(self.trainD, method=orange.EntropyDiscretization())
-    self.holdOutD = orange.ExampleTable(self.trainD.domain, self.holdOutD)
-    
-    for row in self.holdOutD:
-      actualClassType = row[-1].value
-      phrase = row.getmetas().values()[0].value
-
-      featureSet = {}
-      for i,feature in enumerate(self.features):
-        featureSet[feature["name"]] = row[i].value
-
-      if self.classifier == None:
-        classifierFile = open(self.classifierFilePath)
-        self.classifier = pickle.load(classifierFile)
-        classifierFile.close()  
-      prob = self.classifier.prob_classify(featureSet).prob("1")
-      classType = self.classifier.classify(featureSet)
-
-      if classType == "1":
-        totalPositives += 1
-        if classType == actualClassType:
-          truePositives += 1
+        error = sys.exc_info()
+        self.logger.error("Error loading phrase '" + phraseData["_id"] + "': " + str(error))
+        failedPhraseIds.add(phraseData["_id"])
       else:
-        totalNegatives += 1
-        if classType == actualClassType:
-          trueNegatives += 1
-
-      if actualClassType == "1":
-        totalHoldOutGoodPhrases += 1
-      else:
-        totalHoldOutBadPhrases += 1
-
-    precisionOfGood = 100.0 * truePositives/totalPositives
-    recallOfGood = 100.0 * truePositives/totalHoldOutGoodPhrases
-    fMeasureOfGood = 2.0 * precisionOfGood * recallOfGood / (precisionOfGood + recallOfGood)
-    precisionOfBad = 100.0 * trueNegatives/totalNegatives
-    recallOfBad = 100.0*trueNegatives/totalHoldOutBadPhrases
-    fMeasureOfBad = 2.0 * precisionOfBad * recallOfBad / (precisionOfBad + recallOfBad)
-    self.logger.info("\nPrecision of Good: " + str(round(precisionOfGood, 2)) + "%")
-    self.logger.info("Recall of Good: " + str(round(recallOfGood, 2)) + "%")
-    self.logger.info("Balanced F-measure of Good: " + str(round(fMeasureOfGood, 2)) + "%")
-    self.logger.info("Precision of Bad: " + str(round(precisionOfBad, 2)) + "%")
-    self.logger.info("Recall of Bad: " + str(round(recallOfBad, 2)) + "%")
-    self.logger.info("Balanced F-measure of Bad: " + str(round(fMeasureOfBad, 2)) + "%")
+        tablePhraseIds.append(phraseData["_id"])
+    if len(tablePhraseIds) == 0: return failedPhraseIds
+
+    with self.metrics.timer("score"):
+      table = orange.ExampleTable(self.model["discretizedDomain"], table)
+      featureSets = map(lambda x: classification_model.getFeatureSet(x, self.features), table)
+      probs, classTypes = self.scorer.score(featureSets, "1")
+    actions = []
+    for phraseId, prob, classType in zip(tablePhraseIds, probs, classTypes):
+      actions.append({"_op_type": "update", "_index": self.processorIndex, "_type": self.processorPhraseType, "_id": phraseId, "doc": {"prob": prob, "class_type": classType}})
+    with self.metrics.timer("store"):
+      success, errors = helpers.bulk(self.esClient, actions, chunk_size=self.bulkSize, raise_on_error=False)
+    for error in errors:
+      result = error.values()[0]
+      self.logger.error("Error storing class of phrase '" + result["_id"] + "': " + str(result))
+      failedPhraseIds.add(result["_id"])
+    self.logger.info("Classified " + str(success) + " phrases, " + str(classTypes.count("1")) + " as good")
+    return failedPhraseIds
 
   def unregisterDispatcher(self, dispatcher, message):
     if message == "dying":
       self.dispatchers.pop(dispatcher, None)
 
     if len(self.dispatchers) == 0:
-      self.worker.send(content="kill", to=self.workerName)
+      with self.messagePool.channelLock:
+        self.worker.send(content="kill", to=self.workerName)
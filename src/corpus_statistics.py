@@ -0,0 +1,161 @@
+import math
+from src import transport
+from src import local_redis
+
+__name__ = "corpus_statistics"
+
+# Corpus level n-gram statistics, merged in Redis from the per-document shingle counts that
+# annotation workers emit. Every phrase has a hash with its document frequency (df), the sum
+# and maximum of its term frequency (tf_sum, tf_max) and the sum and maximum of its length
+# normalized term frequency sqrt(tf)/sqrt(length) (norm_sum, norm_max).
+
+# adds a document to the statistics, documents that were already added are ignored
+ADD_DOCUMENT_SCRIPT = """
+if redis.call("sadd", KEYS[2], ARGV[1]) == 0 then
+  return 0
+end
+redis.call("hincrby", KEYS[1], "doc_count", 1)
+redis.call("hincrby", KEYS[1], "length_sum", ARGV[2])
+for i = 3, #KEYS do
+  local tf = tonumber(ARGV[2 * i - 3])
+  local norm = tonumber(ARGV[2 * i - 2])
+  redis.call("hincrby", KEYS[i], "df", 1)
+  redis.call("hincrby", KEYS[i], "tf_sum", tf)
+  redis.call("hincrbyfloat", KEYS[i], "norm_sum", norm)
+  local tfMax = tonumber(redis.call("hget", KEYS[i], "tf_max"))
+  if tfMax == nil or tf > tfMax then
+    redis.call("hset", KEYS[i], "tf_max", tf)
+  end
+  local normMax = tonumber(redis.call("hget", KEYS[i], "norm_max"))
+  if normMax == nil or norm > normMax then
+    redis.call("hset", KEYS[i], "norm_max", ARGV[2 * i - 2])
+  end
+end
+return 1
+"""
+
+# removes a document that was added with the same counts, documents that were not added are ignored.
+# Maxima cannot be recomputed without the other documents, so tf_max and norm_max stay upper bounds
+REMOVE_DOCUMENT_SCRIPT = """
+if redis.call("srem", KEYS[2], ARGV[1]) == 0 then
+  return 0
+end
+redis.call("hincrby", KEYS[1], "doc_count", -1)
+redis.call("hincrby", KEYS[1], "length_sum", -tonumber(ARGV[2]))
+for i = 3, #KEYS do
+  if redis.call("hincrby", KEYS[i], "df", -1) <= 0 then
+    redis.call("del", KEYS[i])
+  else
+    redis.call("hincrby", KEYS[i], "tf_sum", -tonumber(ARGV[2 * i - 3]))
+    redis.call("hincrbyfloat", KEYS[i], "norm_sum", -tonumber(ARGV[2 * i - 2]))
+  end
+end
+return 1
+"""
+
+# the scripts for the in-memory Redis of the "local" transport
+def addDocumentLocally(client, keys, args):
+  if client.sadd(keys[1], args[0]) == 0: return 0
+  client.hincrby(keys[0], "doc_count", 1)
+  client.hincrby(keys[0], "length_sum", args[1])
+  for i in range(2, len(keys)):
+    tf = int(args[2 * i - 2])
+    norm = float(args[2 * i - 1])
+    client.hincrby(keys[i], "df", 1)
+    client.hincrby(keys[i], "tf_sum", tf)
+    client.hincrbyfloat(keys[i], "norm_sum", norm)
+    tfMax = client.hget(keys[i], "tf_max")
+    if tfMax == None or tf > int(tfMax): client.hset(keys[i], "tf_max", tf)
+    normMax = client.hget(keys[i], "norm_max")
+    if normMax == None or norm > float(normMax): client.hset(keys[i], "norm_max", args[2 * i - 1])
+  return 1
+
+def removeDocumentLocally(client, keys, args):
+  if client.srem(keys[1], args[0]) == 0: return 0
+  client.hincrby(keys[0], "doc_count", -1)
+  client.hincrby(keys[0], "length_sum", -int(args[1]))
+  for i in range(2, len(keys)):
+    if client.hincrby(keys[i], "df", -1) <= 0:
+      client.delete(keys[i])
+    else:
+      client.hincrby(keys[i], "tf_sum", -int(args[2 * i - 2]))
+      client.hincrbyfloat(keys[i], "norm_sum", -float(args[2 * i - 1]))
+  return 1
+
+local_redis.SCRIPTS[ADD_DOCUMENT_SCRIPT] = addDocumentLocally
+local_redis.SCRIPTS[REMOVE_DOCUMENT_SCRIPT] = removeDocumentLocally
+
+class CorpusStatistics:
+
+  def __init__(self, config):
+    self.redisClient = transport.getRedisClient(config)
+    self.keyPrefix = "bayzee.statistics." + config["processor"]["index"]
+    self.corpusKey = self.keyPrefix + ".corpus"
+    self.documentsKey = self.keyPrefix + ".documents"
+    self.addDocumentScript = self.redisClient.register_script(ADD_DOCUMENT_SCRIPT)
+    self.removeDocumentScript = self.redisClient.register_script(REMOVE_DOCUMENT_SCRIPT)
+
+  def __phraseKey(self, phraseId):
+    return self.keyPrefix + ".phrase." + phraseId
+
+  # shingleCounts maps phrase id to the number of times the phrase occurs in the document
+  def addDocument(self, documentId, length, shingleCounts):
+    keys, args = self.__documentArguments(documentId, length, shingleCounts)
+    return self.addDocumentScript(keys=keys, args=args) == 1
+
+  # takes the counts the document was added with
+  def removeDocument(self, documentId, length, shingleCounts):
+    keys, args = self.__documentArguments(documentId, length, shingleCounts)
+    return self.removeDocumentScript(keys=keys, args=args) == 1
+
+  def __documentArguments(self, documentId, length, shingleCounts):
+    keys = [self.corpusKey, self.documentsKey]
+    args = [documentId, length]
+    for phraseId, count in shingleCounts.iteritems():
+      keys.append(self.__phraseKey(phraseId))
+      args.append(count)
+      args.append(repr(math.sqrt(count) / math.sqrt(max(length, 1))))
+    return keys, args
+
+  def getCorpusStatistics(self):
+    data = self.redisClient.hgetall(self.corpusKey)
+    return {"doc_count": int(data.get("doc_count", 0)), "length_sum": int(data.get("length_sum", 0))}
+
+  # returns the statistics of each phrase, in the order of phraseIds
+  def getPhraseStatistics(self, phraseIds):
+    pipeline = self.redisClient.pipeline(transaction=False)
+    for phraseId in phraseIds:
+      pipeline.hgetall(self.__phraseKey(phraseId))
+    statistics = []
+    for data in pipeline.execute():
+      statistics.append({
+        "df": int(data.get("df", 0)),
+        "tf_sum": int(data.get("tf_sum", 0)),
+        "tf_max": int(data.get("tf_max", 0)),
+        "norm_sum": float(data.get("norm_sum", 0)),
+        "norm_max": float(data.get("norm_max", 0))
+      })
+    return statistics
+
+  def clear(self):
+    keys = []
+    for key in self.redisClient.scan_iter(match=self.keyPrefix + ".*", count=1000):
+      keys.append(key)
+      if len(keys) >= 1000:
+        self.redisClient.delete(*keys)
+        keys = []
+    if len(keys) > 0:
+      self.redisClient.delete(*keys)
+
+# computes the search based features of a phrase from its statistics, scores use the
+# classic Lucene TF-IDF formula: sqrt(tf) * idf / sqrt(length) with idf = 1 + ln(N / (df + 1))
+def computeFeatures(phraseStatistics, corpusStatistics):
+  df = phraseStatistics["df"]
+  features = {"doc_count": df, "max_term_frequency": 0, "avg_term_frequency": 0, "max_score": 0, "avg_score": 0}
+  if df == 0: return features
+  idf = 1.0 + math.log(corpusStatistics["doc_count"] * 1.0 / (df + 1))
+  features["max_term_frequency"] = phraseStatistics["tf_max"]
+  features["avg_term_frequency"] = phraseStatistics["tf_sum"] * 1.0 / df
+  features["max_score"] = idf * phraseStatistics["norm_max"]
+  features["avg_score"] = idf * phraseStatistics["norm_sum"] / df
+  return features
@@ -0,0 +1,75 @@
+from src import transport
+
+__name__ = "dirty_phrases"
+
+# Phrases touched by incremental annotation, kept in Redis. A phrase is dirty when a document that
+# contains it was added, changed or deleted, so its features may have changed. A phrase is retracted
+# when it was removed from a document, and may no longer occur in any document.
+# A generation moves the dirty phrases into the set of phrases it generates, so that phrases made
+# dirty while it runs are left for the next one, and records the corpus size its IDFs are based on.
+class DirtyPhrases:
+
+  def __init__(self, config):
+    self.redisClient = transport.getRedisClient(config)
+    self.keyPrefix = "bayzee.phrases." + config["processor"]["index"]
+    self.dirtyKey = self.keyPrefix + ".dirty"
+    self.retractedKey = self.keyPrefix + ".retracted"
+    self.generatingKey = self.keyPrefix + ".generating"
+    self.generationKey = self.keyPrefix + ".generation"
+    self.baselineKey = self.keyPrefix + ".baseline"
+
+  def add(self, dirtyPhraseIds, retractedPhraseIds):
+    pipeline = self.redisClient.pipeline()
+    if len(dirtyPhraseIds) > 0: pipeline.sadd(self.dirtyKey, *dirtyPhraseIds)
+    if len(retractedPhraseIds) > 0: pipeline.sadd(self.retractedKey, *retractedPhraseIds)
+    pipeline.execute()
+
+  # yields lists of at most pageSize retracted phrase ids
+  def retractedPages(self, pageSize):
+    phraseIds = []
+    for phraseId in self.redisClient.sscan_iter(self.retractedKey, count=pageSize):
+      phraseIds.append(phraseId)
+      if len(phraseIds) >= pageSize:
+        yield phraseIds
+        phraseIds = []
+    if len(phraseIds) > 0:
+      yield phraseIds
+
+  def removeDirty(self, phraseIds):
+    if len(phraseIds) > 0: self.redisClient.srem(self.dirtyKey, *phraseIds)
+
+  def clearRetracted(self):
+    self.redisClient.delete(self.retractedKey)
+
+  # the phrases of an unfinished generation are generated again by the next one
+  def startGeneration(self, mode, corpusSize):
+    pipeline = self.redisClient.pipeline()
+    pipeline.sunionstore(self.generatingKey, self.generatingKey, self.dirtyKey)
+    pipeline.delete(self.dirtyKey)
+    pipeline.hmset(self.generationKey, {"mode": mode, "corpus_size": corpusSize})
+    pipeline.execute()
+
+  # returns the mode and corpus size of the unfinished generation, None when there is none
+  def getGeneration(self):
+    generation = self.redisClient.hgetall(self.generationKey)
+    if len(generation) == 0: return None
+    return {"mode": generation["mode"], "corpusSize": int(generation["corpus_size"])}
+
+  def generatingPhraseIds(self):
+    return sorted(self.redisClient.smembers(self.generatingKey))
+
+  # makes the corpus size of the generation the baseline of the next ones
+  def finishGeneration(self, corpusSize):
+    pipeline = self.redisClient.pipeline()
+    pipeline.hset(self.baselineKey, "corpus_size", corpusSize)
+    pipeline.delete(self.generatingKey, self.generationKey)
+    pipeline.execute()
+
+  # returns the corpus size of the last complete generation, None when there was none
+  def getBaselineCorpusSize(self):
+    corpusSize = self.redisClient.hget(self.baselineKey, "corpus_size")
+    if corpusSize == None: return None
+    return int(corpusSize)
+
+  def clear(self):
+    self.redisClient.delete(self.dirtyKey, self.retractedKey, self.generatingKey, self.generationKey, self.baselineKey)
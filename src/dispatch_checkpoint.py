@@ -0,0 +1,69 @@
+from src import transport
+
+__name__ = "dispatch_checkpoint"
+
+# Durable progress of a dispatcher run, kept in Redis so that a restarted dispatcher resumes where
+# the previous one stopped instead of starting over. The state hash holds the iteration cursor
+# (position of the next item in sort order and the id of the last dispatched item) and the number
+# of items dispatched. Dispatched items stay in the pending set until a worker acknowledges them,
+# or the dispatcher gives up on them, which moves them to the acknowledged or failed set.
+class DispatchCheckpoint:
+
+  def __init__(self, config, dispatcherName):
+    self.redisClient = transport.getRedisClient(config)
+    self.keyPrefix = "bayzee.checkpoint." + dispatcherName
+    self.stateKey = self.keyPrefix + ".state"
+    self.pendingKey = self.keyPrefix + ".pending"
+    self.acknowledgedKey = self.keyPrefix + ".acknowledged"
+    self.failedKey = self.keyPrefix + ".failed"
+
+  # returns the saved state or None when there is no checkpoint to resume from
+  def load(self):
+    state = self.redisClient.hgetall(self.stateKey)
+    if len(state) == 0: return None
+    pipeline = self.redisClient.pipeline(transaction=False)
+    pipeline.smembers(self.pendingKey)
+    pipeline.scard(self.acknowledgedKey)
+    pipeline.scard(self.failedKey)
+    pending, acknowledged, failed = pipeline.execute()
+    return {
+      "position": int(state["position"]),
+      "cursor": state.get("cursor"),
+      "dispatched": int(state["dispatched"]),
+      "pending": sorted(pending),
+      "acknowledged": acknowledged,
+      "failed": failed
+    }
+
+  def start(self, position):
+    self.clear()
+    self.redisClient.hmset(self.stateKey, {"position": position, "dispatched": 0})
+
+  # records a page of items as pending and moves the cursor past it, before the page is sent. The cursor
+  # defaults to the last item, a page that was scanned without dispatching anything only moves the cursor
+  def dispatch(self, itemIds, position, dispatched, cursor = None):
+    if cursor == None and len(itemIds) > 0: cursor = itemIds[-1]
+    state = {"position": position, "dispatched": dispatched}
+    if cursor != None: state["cursor"] = cursor
+    pipeline = self.redisClient.pipeline()
+    if len(itemIds) > 0: pipeline.sadd(self.pendingKey, *itemIds)
+    pipeline.hmset(self.stateKey, state)
+    pipeline.execute()
+
+  # returns the number of items that had not been acknowledged before
+  def acknowledge(self, itemIds):
+    return self.__complete(itemIds, self.acknowledgedKey)
+
+  # returns the number of items that had not been given up on before
+  def fail(self, itemIds):
+    return self.__complete(itemIds, self.failedKey)
+
+  def __complete(self, itemIds, key):
+    if len(itemIds) == 0: return 0
+    pipeline = self.redisClient.pipeline()
+    pipeline.srem(self.pendingKey, *itemIds)
+    pipeline.sadd(key, *itemIds)
+    return pipeline.execute()[1]
+
+  def clear(self):
+    self.redisClient.delete(self.stateKey, self.pendingKey, self.acknowledgedKey, self.failedKey)
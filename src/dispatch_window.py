@@ -0,0 +1,49 @@
+import time
+
+__name__ = "dispatch_window"
+
+# Bounds the number of items a dispatcher has sent to workers and not heard back about, so that
+# the worker queue in Redis stays short and the message timeouts start close to when a worker
+# picks the message up. The size of the window follows the rate at which workers complete items:
+# it holds about dispatchWindowLatency seconds of work, between one batch and dispatchWindow items.
+# A dispatchWindow of 0 disables the window and every item is sent up front.
+# It isn't thread-safe, dispatchers update it under their stateLock.
+class DispatchWindow:
+
+  def __init__(self, config, batchSize):
+    self.maxSize = 10000
+    if "dispatchWindow" in config: self.maxSize = config["dispatchWindow"]
+    self.latency = 60
+    if "dispatchWindowLatency" in config: self.latency = config["dispatchWindowLatency"]
+    self.minSize = batchSize
+    # grows from ten batches as the completion rate is measured
+    self.size = min(max(self.maxSize, self.minSize), 10 * batchSize)
+    self.inFlight = 0
+    # completed items per second, smoothed over the samples
+    self.rate = None
+    # the first sample starts with the first item sent
+    self.sampleStart = None
+    self.sampleItems = 0
+
+  # whether sending 'items' more items has to wait for replies. A window is never too small for one batch.
+  def isFull(self, items):
+    return self.maxSize > 0 and self.inFlight > 0 and self.inFlight + items > self.size
+
+  def sent(self, items):
+    self.inFlight += items
+    if self.sampleStart == None: self.sampleStart = time.time()
+
+  def completed(self, items):
+    self.inFlight = max(self.inFlight - items, 0)
+    # completions before the sample started, such as replies to items sent before a restart, would inflate its rate
+    if self.sampleStart == None: return
+    self.sampleItems += items
+    elapsed = time.time() - self.sampleStart
+    if elapsed < 1: return
+    rate = self.sampleItems / elapsed
+    if self.rate == None: self.rate = rate
+    else: self.rate = 0.8 * self.rate + 0.2 * rate
+    self.size = int(min(max(self.rate * self.latency, self.minSize), max(self.maxSize, self.minSize)))
+    # the next sample starts with the next item sent
+    self.sampleStart = None
+    self.sampleItems = 0
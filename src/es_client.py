@@ -0,0 +1,108 @@
+import os
+import time
+import threading
+from elasticsearch import Elasticsearch, Transport
+
+__name__ = "es_client"
+
+# Records the number of requests, errors and latency of every kind of Elasticsearch operation, and the
+# latencies in 'metrics' when it is set
+class RequestRecorder:
+
+  def initStats(self, metrics):
+    self.stats = {}
+    self.statsLock = threading.Lock()
+    self.metrics = metrics
+
+  def timeRequest(self, method, url, request):
+    start = time.time()
+    failed = False
+    try:
+      return request()
+    except:
+      failed = True
+      raise
+    finally:
+      self.record(getOperation(method, url), time.time() - start, failed)
+
+  def record(self, operation, duration, failed):
+    with self.statsLock:
+      if operation not in self.stats:
+        self.stats[operation] = {"count": 0, "errors": 0, "totalTime": 0.0, "maxTime": 0.0}
+      stats = self.stats[operation]
+      stats["count"] += 1
+      if failed: stats["errors"] += 1
+      stats["totalTime"] += duration
+      if duration > stats["maxTime"]: stats["maxTime"] = duration
+    if self.metrics != None:
+      self.metrics.observe("bayzee_elasticsearch_request_seconds", duration, {"operation": operation})
+      if failed: self.metrics.increment("bayzee_elasticsearch_errors_total", 1, {"operation": operation})
+
+# Transport of the client shared by the process, its statistics cover the requests of every caller
+class InstrumentedTransport(Transport, RequestRecorder):
+
+  def __init__(self, *args, **kwargs):
+    Transport.__init__(self, *args, **kwargs)
+    self.initStats(None)
+
+  def perform_request(self, method, url, params=None, body=None):
+    return self.timeRequest(method, url, lambda: Transport.perform_request(self, method, url, params=params, body=body))
+
+# Transport of the client of one dispatcher or worker. Requests go through the connection pool of the shared
+# transport, and are recorded in the statistics and metrics of the caller, since a stream worker or a
+# local run has several stages in one process
+class CallerTransport(RequestRecorder):
+
+  def __init__(self, transport, metrics):
+    self.transport = transport
+    self.serializer = transport.serializer
+    self.initStats(metrics)
+
+  def perform_request(self, method, url, params=None, body=None):
+    return self.timeRequest(method, url, lambda: self.transport.perform_request(method, url, params=params, body=body))
+
+# name of the operation behind a request, e.g. "search", "bulk", "analyze", "get" or "exists"
+def getOperation(method, url):
+  path = url.split("?")[0].strip("/")
+  if path.startswith("_search/scroll"): return "scroll"
+  for part in reversed(path.split("/")):
+    if part.startswith("_") and part not in ("_all", "_doc"):
+      return part[1:]
+  if method == "HEAD": return "exists"
+  if method == "GET": return "get"
+  if method == "DELETE": return "delete"
+  return "index"
+
+def createClient(config):
+  esConfig = config["elasticsearch"]
+  hosts = [esConfig["host"] + ":" + str(esConfig["port"])]
+  if "hosts" in esConfig: hosts = esConfig["hosts"]
+  options = {"transport_class": InstrumentedTransport, "maxsize": 10, "timeout": 60, "max_retries": 3, "retry_on_timeout": True}
+  if "poolSize" in esConfig: options["maxsize"] = esConfig["poolSize"]
+  if "timeout" in esConfig: options["timeout"] = esConfig["timeout"]
+  if "maxRetries" in esConfig: options["max_retries"] = esConfig["maxRetries"]
+  if "sniff" in esConfig and esConfig["sniff"] == True:
+    options["sniff_on_start"] = True
+    options["sniff_on_connection_fail"] = True
+    options["sniffer_timeout"] = 60
+    if "snifferTimeout" in esConfig: options["sniffer_timeout"] = esConfig["snifferTimeout"]
+  return Elasticsearch(hosts, **options)
+
+# returns the client of the current process, creating it on first use. The client is kept in the config
+# so that processors share it, and is recreated in forked processes since connections can't be shared.
+# With 'metrics', returns a client of the caller alone on top of it, whose requests are recorded in 'metrics'
+def getClient(config, metrics = None):
+  if "es_client" not in config or config.get("es_client_pid") != os.getpid():
+    config["es_client"] = createClient(config)
+    config["es_client_pid"] = os.getpid()
+  esClient = config["es_client"]
+  if metrics == None or not isinstance(esClient.transport, InstrumentedTransport): return esClient
+  return Elasticsearch(transport_class=lambda hosts, **kwargs: CallerTransport(esClient.transport, metrics))
+
+def formatStats(esClient):
+  if not hasattr(esClient.transport, "stats"): return ""
+  lines = []
+  for operation, stats in sorted(esClient.transport.stats.iteritems()):
+    averageTime = stats["totalTime"] * 1000.0 / max(stats["count"], 1)
+    lines.append(operation + ": " + str(stats["count"]) + " requests, " + str(stats["errors"]) + " errors, avg " + str(round(averageTime, 2)) + "ms, max " + str(round(stats["maxTime"] * 1000.0, 2)) + "ms")
+  return "; ".join(lines)
@@ -3,19 +3,25 @@ import os
 import os.path
 import json
 import re
-from elasticsearch import Elasticsearch
-from muppet import DurableChannel, RemoteChannel
+import threading
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.scroll_iterator import ScrollIterator
+from src.dispatch_checkpoint import DispatchCheckpoint
+from src.dispatch_window import DispatchWindow
+from src.dirty_phrases import DirtyPhrases
+from src.corpus_statistics import CorpusStatistics
 
 __name__ = "generation_dispatcher"
 
 class GenerationDispatcher:
   
-  def __init__(self, config, trainingDataset, holdOutDataset, processingStartIndex, processingEndIndex):
+  def __init__(self, config, processingStartIndex, processingEndIndex):
     self.config = config
     self.logger = config["logger"]
-    self.esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
-    self.trainingDataset = trainingDataset
-    self.holdOutDataset = holdOutDataset
+    self.metrics = metrics.Metrics(config, "generation_dispatcher")
+    self.esClient = es_client.getClient(config, self.metrics)
     self.config["processingStartIndex"] = processingStartIndex
     self.config["processingEndIndex"] = processingEndIndex
     self.bagOfPhrases = {}
@@ -30,12 +36,32 @@ class GenerationDispatcher:
     self.dispatcherName = "bayzee.generation.dispatcher"
     if processingEndIndex != None:
       self.dispatcherName += "." + str(processingStartIndex) + "." + str(processingEndIndex)
+    self.checkpoint = DispatchCheckpoint(config, self.dispatcherName)
+    self.resumeState = None
+    if "resumeDispatch" not in config or config["resumeDispatch"] == True:
+      self.resumeState = self.checkpoint.load()
     self.workerName = "bayzee.generation.worker"
     self.processorIndex = config["processor"]["index"]
     self.processorType = config["processor"]["type"]
     self.processorPhraseType = config["processor"]["type"]+"__phrase"
     self.processingPageSize = config["processingPageSize"]
+    self.dispatchBatchSize = 1
+    if "dispatchBatchSize" in config: self.dispatchBatchSize = config["dispatchBatchSize"]
+    self.window = DispatchWindow(config, self.dispatchBatchSize)
+    # guards the window, the counters and the checkpoint, which timeoutCallback updates from the channel's timeout thread
+    self.stateLock = threading.RLock()
     config["processor_phrase_type"] = self.processorPhraseType
+    self.featureMode = "search"
+    if "featureMode" in config["generator"]: self.featureMode = config["generator"]["featureMode"]
+    self.incremental = "generateIncrementally" in config and config["generateIncrementally"] == True
+    if self.incremental and (processingStartIndex or processingEndIndex != None):
+      self.logger.info("Phrases of a slice are all generated, incremental generation needs a dispatcher for all phrases")
+      self.incremental = False
+    self.corpusSizeDrift = 0.05
+    if "corpusSizeDrift" in config: self.corpusSizeDrift = config["corpusSizeDrift"]
+    self.dirtyPhrases = DirtyPhrases(config)
+    # extra content of the generate messages
+    self.messageOptions = {}
     
     self.featureNames = map(lambda x: x["name"], config["generator"]["features"])
     for module in config["processor"]["modules"]:
@@ -48,56 +74,144 @@ class GenerationDispatcher:
     self.controlChannel = RemoteChannel(self.dispatcherName, config)
 
   def dispatchToGenerate(self):
+    self.metrics.start()
     processorIndex = self.config["processor"]["index"]
     phraseProcessorType = self.config["processor"]["type"] + "__phrase"
-    nextPhraseIndex = 0
-    if self.config["processingStartIndex"] != None: nextPhraseIndex = self.config["processingStartIndex"]
-    endPhraseIndex = -1
-    if self.config["processingEndIndex"] != None: endPhraseIndex = self.config["processingEndIndex"]
+    generation = None
+    if self.incremental:
+      # a resumed run goes on in the mode it was started in
+      if self.resumeState == None:
+        generation = self.__startGeneration()
+      else:
+        generation = self.dirtyPhrases.getGeneration()
+    if generation != None:
+      self.messageOptions = {"corpusSize": generation["corpusSize"], "delta": generation["mode"] == "delta"}
+    startIndex = self.config["processingStartIndex"]
+    if self.resumeState != None:
+      # only the phrases that were dispatched but not acknowledged are sent again
+      startIndex = self.resumeState["position"]
+      self.totalPhrasesDispatched = self.resumeState["dispatched"]
+      self.phrasesGenerated = self.resumeState["acknowledged"]
+      self.phrasesNotGenerated = self.resumeState["failed"]
+      self.logger.info("Resuming after phrase " + str(self.resumeState["cursor"]) + ": " + str(self.totalPhrasesDispatched) + " dispatched, " + str(self.phrasesGenerated) + " generated, " + str(self.phrasesNotGenerated) + " failed, " + str(len(self.resumeState["pending"])) + " pending")
+      self.__send(self.resumeState["pending"])
+    else:
+      if startIndex == None: startIndex = 0
+      self.checkpoint.start(startIndex)
 
-    if endPhraseIndex != -1 and self.processingPageSize > (endPhraseIndex - nextPhraseIndex):
-      self.processingPageSize = endPhraseIndex - nextPhraseIndex + 1
-    
-    while True:
-      phrases = self.esClient.search(index=processorIndex, doc_type=phraseProcessorType, body={"from": nextPhraseIndex,"size": self.processingPageSize, "query":{"match_all":{}},"sort":[{"phrase__not_analyzed":{"order":"asc"}}]}, fields=["_id"])
-      if len(phrases["hits"]["hits"]) == 0: break
-      self.totalPhrasesDispatched += len(phrases["hits"]["hits"])
-      floatPrecision = "{0:." + str(self.config["generator"]["floatPrecision"]) + "f}"
-      self.logger.info("Generating features from " + str(nextPhraseIndex) + " to " + str(nextPhraseIndex+len(phrases["hits"]["hits"])) + " phrases...")
-      for phraseData in phrases["hits"]["hits"]:
-        self.logger.info("Dispatching phrase " + phraseData["_id"])
-        content = {"phraseId": phraseData["_id"], "type": "generate", "count": 1, "from": self.dispatcherName}
-        self.generationDispatcher.send(content, self.workerName, self.timeout)
-      nextPhraseIndex += len(phrases["hits"]["hits"])
-      if endPhraseIndex != -1 and nextPhraseIndex >= endPhraseIndex: break
+    if generation != None and generation["mode"] == "delta":
+      pages = self.__dirtyPhrasePages(startIndex)
+    else:
+      pages = ScrollIterator(self.esClient, processorIndex, phraseProcessorType, {"match_all":{}}, [{"phrase__not_analyzed":{"order":"asc"}}], self.processingPageSize, startIndex, self.config["processingEndIndex"]).pages()
+    for nextPhraseIndex, phraseIds in pages:
+      with self.stateLock:
+        self.totalPhrasesDispatched += len(phraseIds)
+        self.checkpoint.dispatch(phraseIds, nextPhraseIndex + len(phraseIds), self.totalPhrasesDispatched)
+      self.metrics.increment("bayzee_dispatched_items_total", len(phraseIds))
+      self.logger.info("Generating features from " + str(nextPhraseIndex) + " to " + str(nextPhraseIndex+len(phraseIds)) + " phrases...")
+      self.__send(phraseIds)
     
-    while True:
-      message = self.generationDispatcher.receive()
-      if "phraseId" in message["content"] and message["content"]["phraseId"] > 0:
-        self.phrasesGenerated += 1
-        self.generationDispatcher.close(message)
-        self.logger.info("Generated for " + message["content"]["phraseId"] + str(self.phrasesGenerated) + "/" + str(self.totalPhrasesDispatched))
-      
-      if (self.phrasesGenerated + self.phrasesNotGenerated) >= self.totalPhrasesDispatched:
-        self.controlChannel.send("dying")
-        break
+    while (self.phrasesGenerated + self.phrasesNotGenerated) < self.totalPhrasesDispatched:
+      self.__receive()
 
+    self.controlChannel.send("dying")
+    self.generationDispatcher.end()
+    if generation != None: self.dirtyPhrases.finishGeneration(generation["corpusSize"])
+    self.checkpoint.clear()
     self.__terminate()
+
+  # only the dirty phrases are generated, with the corpus size of the last complete generation so that their
+  # IDFs match the IDFs of the other phrases. When the corpus size drifted by more than corpusSizeDrift since,
+  # the IDFs of all phrases are out of date and all phrases are generated with the current corpus size.
+  def __startGeneration(self):
+    if self.featureMode == "statistics":
+      corpusSize = CorpusStatistics(self.config).getCorpusStatistics()["doc_count"]
+    else:
+      corpusSize = self.esClient.count(index=self.corpusIndex, doc_type=self.corpusType, body={"query":{"match_all":{}}})["count"]
+    baselineCorpusSize = self.dirtyPhrases.getBaselineCorpusSize()
+    mode = "delta"
+    if baselineCorpusSize == None:
+      self.logger.info("No complete generation to update, generating all phrases")
+      mode = "full"
+    elif abs(corpusSize - baselineCorpusSize) > self.corpusSizeDrift * baselineCorpusSize:
+      self.logger.info("Corpus size changed from " + str(baselineCorpusSize) + " to " + str(corpusSize) + " documents since the last complete generation, generating all phrases")
+      mode = "full"
+    else:
+      corpusSize = baselineCorpusSize
+    self.dirtyPhrases.startGeneration(mode, corpusSize)
+    return {"mode": mode, "corpusSize": corpusSize}
+
+  # yields the pages of the phrases made dirty since the last generation in the format of ScrollIterator.pages
+  def __dirtyPhrasePages(self, startIndex):
+    phraseIds = self.dirtyPhrases.generatingPhraseIds()
+    self.logger.info(str(len(phraseIds)) + " phrases changed since the last generation")
+    for i in range(startIndex, len(phraseIds), self.processingPageSize):
+      yield i, phraseIds[i:i+self.processingPageSize]
+
+  def __receive(self):
+    message = self.generationDispatcher.receive()
+    with self.stateLock:
+      if "phraseIds" in message["content"]:
+        failedPhraseIds = message["content"]["failedPhraseIds"]
+        generatedPhraseIds = filter(lambda x: x not in failedPhraseIds, message["content"]["phraseIds"])
+        # replies to messages sent before a restart may arrive twice, only new acknowledgements count
+        generated = self.checkpoint.acknowledge(generatedPhraseIds)
+        self.phrasesGenerated += generated
+        self.window.completed(generated)
+        self.metrics.increment("bayzee_items_total", generated, {"status": "processed"})
+        self.generationDispatcher.close(message)
+        self.logger.info("Generated for " + str(len(generatedPhraseIds)) + " phrases - " + str(self.phrasesGenerated) + "/" + str(self.totalPhrasesDispatched))
+        if len(failedPhraseIds) > 0:
+          self.logger.info("Failed to generate for phrases " + ", ".join(failedPhraseIds))
+          if message["content"]["count"] < 5:
+            self.metrics.increment("bayzee_retries_total", 1, {"reason": "failed"})
+            content = {"phraseIds": failedPhraseIds, "type": "generate", "count": message["content"]["count"] + 1, "from": self.dispatcherName}
+            content.update(self.messageOptions)
+            self.generationDispatcher.send(content, self.workerName, self.timeout)
+          else:
+            notGenerated = self.checkpoint.fail(failedPhraseIds)
+            self.phrasesNotGenerated += notGenerated
+            self.window.completed(notGenerated)
+            self.metrics.increment("bayzee_items_total", notGenerated, {"status": "failed"})
+
+      self.metrics.setGauge("bayzee_pending_items", self.totalPhrasesDispatched - self.phrasesGenerated - self.phrasesNotGenerated)
+      self.metrics.setGauge("bayzee_dispatch_window", self.window.size)
+
+  # replies are received while the window is full, so that the phrases are sent as workers free up
+  def __send(self, phraseIds):
+    for i in range(0, len(phraseIds), self.dispatchBatchSize):
+      batch = phraseIds[i:i+self.dispatchBatchSize]
+      while self.window.isFull(len(batch)):
+        self.__receive()
+      self.logger.info("Dispatching " + str(len(batch)) + " phrases starting at " + batch[0])
+      content = {"phraseIds": batch, "type": "generate", "count": 1, "from": self.dispatcherName}
+      content.update(self.messageOptions)
+      with self.stateLock:
+        with self.metrics.timer("send"):
+          self.generationDispatcher.send(content, self.workerName, self.timeout)
+        self.window.sent(len(batch))
     
   def timeoutCallback(self, message):
-    config.logger.info("Message timed out: " + str(message))
-    if message["content"]["count"] < 5:
-      message["content"]["count"] += 1
-      self.generationDispatcher.send(message["content"], self.workerName, self.timeout)
-    else:
-      #log implementation yet to be done for expired phrases
-      self.phrasesNotGenerated += 1
-      if self.phrasesNotGenerated == self.totalPhrasesDispatched or (self.phrasesGenerated + self.phrasesNotGenerated) == self.totalPhrasesDispatched:
-        self.__terminate()
+    self.logger.info("Message timed out: " + str(message))
+    with self.stateLock:
+      if message["content"]["count"] < 5:
+        message["content"]["count"] += 1
+        self.metrics.increment("bayzee_retries_total", 1, {"reason": "timeout"})
+        self.generationDispatcher.send(message["content"], self.workerName, self.timeout)
+      else:
+        self.logger.info("Giving up on phrases " + ", ".join(message["content"]["phraseIds"]))
+        notGenerated = self.checkpoint.fail(message["content"]["phraseIds"])
+        self.phrasesNotGenerated += notGenerated
+        self.window.completed(notGenerated)
+        self.metrics.increment("bayzee_items_total", notGenerated, {"status": "failed"})
+        if self.phrasesNotGenerated == self.totalPhrasesDispatched or (self.phrasesGenerated + self.phrasesNotGenerated) == self.totalPhrasesDispatched:
+          self.__terminate()
 
   def __terminate(self):
     self.logger.info(str(self.totalPhrasesDispatched) + " total dispatched")
     self.logger.info(str(self.phrasesGenerated) + " generated")
     self.logger.info(str(self.phrasesNotGenerated) + " failed to generate")
     self.logger.info("Generation complete")
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
     self.logger.info("Terminating generation dispatcher")
@@ -4,19 +4,24 @@ import os.path
 import json
 import re
 import sys
-from elasticsearch import Elasticsearch
-from muppet import DurableChannel, RemoteChannel
+import time
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.message_pool import MessagePool
+from src import corpus_statistics
 
 __name__ = "generation_worker"
 
 class GenerationWorker:
   
-  def __init__(self, config, trainingDataset, holdOutDataset):
+  # a stream worker runs the worker's batches itself, with its own metrics and message pool
+  def __init__(self, config, workerMetrics = None, messagePool = None):
     self.config = config
     self.logger = config["logger"]
-    self.esClient = Elasticsearch(config["elasticsearch"]["host"] + ":" + str(config["elasticsearch"]["port"]))
-    self.trainingDataset = trainingDataset
-    self.holdOutDataset = holdOutDataset
+    self.metrics = workerMetrics
+    if self.metrics == None: self.metrics = metrics.Metrics(config, "generation_worker")
+    self.esClient = es_client.getClient(config, self.metrics)
     self.bagOfPhrases = {}
     self.corpusIndex = config["corpus"]["index"]
     self.corpusType = config["corpus"]["type"]
@@ -32,103 +37,316 @@ class GenerationWorker:
     for module in config["processor"]["modules"]:
       self.featureNames = self.featureNames + map(lambda x: x["name"], module["features"])
     
+    self.featureMode = "search"
+    if "featureMode" in config["generator"]: self.featureMode = config["generator"]["featureMode"]
+    self.corpusStatistics = None
+    if self.featureMode == "statistics":
+      self.corpusStatistics = corpus_statistics.CorpusStatistics(config)
+    self.searchPageSize = 100
+    if "searchPageSize" in config["generator"]: self.searchPageSize = config["generator"]["searchPageSize"]
+    
     self.workerName = "bayzee.generation.worker"
     self.dispatchers = {}
     
-    #creating worker
-    self.worker = DurableChannel(self.workerName, config)
+    self.worker = None
+    self.messagePool = messagePool
+    if self.messagePool == None: self.messagePool = MessagePool(config)
   
   def generate(self):
     self.__extractFeatures()
 
   def __extractFeatures(self):
+    self.worker = DurableChannel(self.workerName, self.config)
+    self.metrics.start()
     while True:
       message = self.worker.receive()
       if message["content"] == "kill":
         message["responseId"] = message["requestId"]
-        self.worker.close(message)
+        with self.messagePool.channelLock:
+          self.worker.close(message)
         if len(self.dispatchers) == 0:
+          # replies of the messages being handled are sent before the channel ends
+          self.messagePool.close()
           self.worker.end()
           break
         else:
-          self.worker.send(content="kill", to=self.workerName)
+          with self.messagePool.channelLock:
+            self.worker.send(content="kill", to=self.workerName)
           continue
       elif message["content"]["type"] == "generate":
         if message["content"]["from"] not in self.dispatchers:
           self.dispatchers[message["content"]["from"]] = RemoteChannel(message["content"]["from"], self.config)
           self.dispatchers[message["content"]["from"]].listen(self.unregisterDispatcher)
-        phraseId = message["content"]["phraseId"]
-        phraseData = self.esClient.get(index=self.processorIndex, doc_type=self.processorPhraseType, id = phraseId)
-        floatPrecision = "{0:." + str(self.config["generator"]["floatPrecision"]) + "f}"
-        token = phraseData["_source"]["phrase"]
-        documentId = phraseData["_source"]["document_id"]
-        self.logger.info("Extracted common features for phrase '" + token + "'")
-        entry = {}
-        shouldMatch = map(lambda x: {"match_phrase":{x:token}}, self.corpusFields)
-        query = {"query":{"bool":{"should":shouldMatch}}}
-        data = self.esClient.search(index=self.corpusIndex, doc_type=self.corpusType, body=query, explain=True, size=self.corpusSize)
-        entry["max_score"] = 0
-        maxScore = 0
-        avgScore = 0
-        maxTermFrequency = 0
-        avgTermFrequency = 0
-        for hit in data["hits"]["hits"]:
+        self.messagePool.submit(self.__generateMessage, message)
+      if message["content"]["type"] == "stop_dispatcher":
+        with self.messagePool.channelLock:
+          self.worker.reply(message, {"phraseIds": [], "failedPhraseIds": [], "status" : "stop_dispatcher", "type" : "stop_dispatcher"}, self.timeout)        
+
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
+    self.logger.info("Terminating generation worker")
+
+  def __generateMessage(self, message):
+    start = time.time()
+    generatedPhraseIds, failedPhraseIds = self.generateBatch(message["content"]["phraseIds"], message["content"].get("corpusSize"), message["content"].get("delta", False))
+    self.metrics.recordBatch(time.time() - start, len(generatedPhraseIds), len(failedPhraseIds))
+    with self.metrics.timer("reply"):
+      with self.messagePool.channelLock:
+        self.worker.reply(message, {"phraseIds": generatedPhraseIds, "failedPhraseIds": failedPhraseIds, "count": message["content"]["count"], "status" : "generated", "type" : "reply"}, 120000000)
+
+  # generates the features of a batch of phrases, returns the ids of the phrases generated and the ids of the
+  # phrases that failed. In a delta generation, phrases that no longer exist are not generated but do not fail
+  def generateBatch(self, phraseIds, corpusSize = None, delta = False):
+    generatedPhraseIds = []
+    failedPhraseIds = []
+    try:
+      with self.metrics.timer("load_phrases"):
+        phrases = self.__loadPhrases(phraseIds)
+      with self.metrics.timer("compute_features", {"mode": self.featureMode}):
+        featureValues = self.__computeFeatureValues(phrases, corpusSize)
+    except:
+      error = sys.exc_info()
+      self.logger.error("Error loading phrases: " + str(error))
+      return [], list(phraseIds)
+    for phraseId in phraseIds:
+      try:
+        if phraseId in phrases:
+          self.__generatePhrase(phrases[phraseId], featureValues)
+        # dirty phrases may have been deleted since they were changed
+        elif not delta:
+          raise Exception("Phrase not found")
+      except:
+        error = sys.exc_info()
+        self.logger.error("Error generating features for phrase " + phraseId + ": " + str(error))
+        failedPhraseIds.append(phraseId)
+      else:
+        generatedPhraseIds.append(phraseId)
+    return generatedPhraseIds, failedPhraseIds
+
+  # featureValues is None when features are computed with a search per phrase
+  def __generatePhrase(self, phraseData, featureValues):
+    phraseId = phraseData["_id"]
+    floatPrecision = "{0:." + str(self.config["generator"]["floatPrecision"]) + "f}"
+    token = phraseData["_source"]["phrase"]
+    documentId = phraseData["_source"]["document_id"]
+    self.logger.info("Extracted common features for phrase '" + token + "'")
+    entry = {}
+    entry["max_score"] = 0
+    if featureValues != None:
+      values = featureValues[phraseId]
+    else:
+      with self.metrics.timer("search_features"):
+        values = self.__searchFeatures(token)
+    
+    for featureName in ["max_score", "doc_count", "avg_score", "max_term_frequency", "avg_term_frequency"]:
+      if featureName in self.featureNames:
+        entry[featureName] = floatPrecision.format(float(values[featureName]))
+    # get additional features
+    for processorInstance in self.config["processor_instances"]:
+      with self.metrics.timer("processor", {"processor": processorInstance.__name__, "call": "extractFeatures"}):
+        processorInstance.extractFeatures(self.config, token, entry)
+
+    # partial update, so that labels applied by the phrase labeler are kept
+    with self.metrics.timer("store"):
+      self.esClient.update(index=self.processorIndex, doc_type=self.processorPhraseType, id=phraseId, body={"doc": {"features": entry}})
+
+  def __searchFeatures(self, token):
+    query = {"query":self.__phraseQuery(token)}
+    data = self.esClient.search(index=self.corpusIndex, doc_type=self.corpusType, body=query, explain=True, size=self.corpusSize)
+    maxScore = 0
+    avgScore = 0
+    maxTermFrequency = 0
+    avgTermFrequency = 0
+    for hit in data["hits"]["hits"]:
+      avgScore += float(hit["_score"])
+      numOfScores = 0
+      hitTermFrequency = 0
+      explanation = json.dumps(hit["_explanation"])
+      while len(explanation) > len(token):
+        indexOfToken = explanation.find("tf(") + len("tf(")
+        if indexOfToken < len("tf("):
+          break
+        explanation = explanation[indexOfToken:]
+        freqToken = explanation.split(")")[0]
+        explanation = explanation.split(")")[1]
+        if freqToken.find("freq=") >= 0:
+          numOfScores += 1
+          hitTermFrequency += float(freqToken.split("=")[1])
+      if numOfScores > 0 : hitTermFrequency = hitTermFrequency / numOfScores
+      if maxTermFrequency < hitTermFrequency: maxTermFrequency = hitTermFrequency 
+      avgTermFrequency += hitTermFrequency
+
+    if len(data["hits"]["hits"]) > 0:
+      avgTermFrequency = avgTermFrequency * 1.0 / len(data["hits"]["hits"])
+    
+    if int(data["hits"]["total"]) > 0:
+      avgScore = (avgScore * 1.0) / int(data["hits"]["total"])
+    
+    if data["hits"]["max_score"] != None: 
+      maxScore = data["hits"]["max_score"]
+    
+    return {"max_score": maxScore, "doc_count": data["hits"]["total"], "avg_score": avgScore, "max_term_frequency": maxTermFrequency, "avg_term_frequency": avgTermFrequency}
+
+  # returns the phrase records found, keyed by phrase id
+  def __loadPhrases(self, phraseIds):
+    phrases = {}
+    data = self.esClient.mget(index=self.processorIndex, doc_type=self.processorPhraseType, body={"ids": phraseIds})
+    for phraseData in data["docs"]:
+      if phraseData.get("found", False):
+        phrases[phraseData["_id"]] = phraseData
+    return phrases
+
+  # computes the search based features of all phrases at once, returns None in the "search" mode.
+  # In the "statistics" mode, a corpusSize other than None replaces the number of documents of the corpus
+  def __computeFeatureValues(self, phrases, corpusSize):
+    if self.featureMode == "statistics":
+      phraseIds = phrases.keys()
+      corpusStatistics = self.corpusStatistics.getCorpusStatistics()
+      if corpusSize != None: corpusStatistics["doc_count"] = corpusSize
+      phraseStatistics = self.corpusStatistics.getPhraseStatistics(phraseIds)
+      return dict(zip(phraseIds, map(lambda x: corpus_statistics.computeFeatures(x, corpusStatistics), phraseStatistics)))
+    elif self.featureMode == "batched":
+      return self.__batchSearchFeatures(phrases)
+    return None
+
+  # runs the phrase searches of a whole batch in one msearch request, without explanations. Term frequencies
+  # are counted in the term vectors of the hits, and hits beyond the first page are streamed with a scroll cursor
+  def __batchSearchFeatures(self, phrases):
+    phraseIds = phrases.keys()
+    body = []
+    for phraseId in phraseIds:
+      body.append({"index": self.corpusIndex, "type": self.corpusType})
+      body.append({"query": self.__phraseQuery(phrases[phraseId]["_source"]["phrase"]), "size": self.searchPageSize, "fields": []})
+    featureValues = {}
+    if len(body) == 0: return featureValues
+    responses = self.esClient.msearch(body=body)["responses"]
+    for phraseId, response in zip(phraseIds, responses):
+      if "error" in response:
+        raise Exception("Search failed for phrase '" + phraseId + "': " + str(response["error"]))
+    phrasePatterns = self.__analyzePhrases(map(lambda x: phrases[x]["_source"]["phrase"], phraseIds))
+    # the term vectors of the first page of hits of all phrases are fetched at once
+    firstPageIds = set()
+    for response in responses:
+      firstPageIds.update(map(lambda x: x["_id"], response["hits"]["hits"]))
+    termVectors = self.__loadTermVectors(firstPageIds)
+    for phraseId, patterns, response in zip(phraseIds, phrasePatterns, responses):
+      token = phrases[phraseId]["_source"]["phrase"]
+      total = int(response["hits"]["total"])
+      hits = response["hits"]["hits"]
+      if total > len(hits):
+        hits = self.__scrollHits(token)
+      maxScore = 0
+      avgScore = 0
+      maxTermFrequency = 0
+      avgTermFrequency = 0
+      numOfHits = 0
+      for page in self.__pages(hits):
+        pageTermVectors = termVectors
+        if len(filter(lambda x: x["_id"] not in termVectors, page)) > 0:
+          pageTermVectors = self.__loadTermVectors(map(lambda x: x["_id"], page))
+        for hit in page:
+          numOfHits += 1
           avgScore += float(hit["_score"])
-          numOfScores = 0
-          hitTermFrequency = 0
-          explanation = json.dumps(hit["_explanation"])
-          while len(explanation) > len(token):
-            indexOfToken = explanation.find("tf(") + len("tf(")
-            if indexOfToken < len("tf("):
-              break
-            explanation = explanation[indexOfToken:]
-            freqToken = explanation.split(")")[0]
-            explanation = explanation.split(")")[1]
-            if freqToken.find("freq=") >= 0:
-              numOfScores += 1
-              hitTermFrequency += float(freqToken.split("=")[1])
-          if numOfScores > 0 : hitTermFrequency = hitTermFrequency / numOfScores
-          if maxTermFrequency < hitTermFrequency: maxTermFrequency = hitTermFrequency 
+          hitTermFrequency = self.__countTermFrequency(patterns, pageTermVectors.get(hit["_id"], {}))
+          if maxTermFrequency < hitTermFrequency: maxTermFrequency = hitTermFrequency
           avgTermFrequency += hitTermFrequency
+      if numOfHits > 0:
+        avgTermFrequency = avgTermFrequency * 1.0 / numOfHits
+      if total > 0:
+        avgScore = (avgScore * 1.0) / total
+      if response["hits"]["max_score"] != None:
+        maxScore = response["hits"]["max_score"]
+      featureValues[phraseId] = {"max_score": maxScore, "doc_count": total, "avg_score": avgScore, "max_term_frequency": maxTermFrequency, "avg_term_frequency": avgTermFrequency}
+    return featureValues
 
-        if len(data["hits"]["hits"]) > 0:
-          avgTermFrequency = avgTermFrequency * 1.0 / len(data["hits"]["hits"])
-        
-        if int(data["hits"]["total"]) > 0:
-          avgScore = (avgScore * 1.0) / int(data["hits"]["total"])
-        
-        if data["hits"]["max_score"] != None: 
-          maxScore = data["hits"]["max_score"]
-        
-        if "max_score" in self.featureNames:
-          entry["max_score"] = floatPrecision.format(float(maxScore))
-        if "doc_count" in self.featureNames:
-          entry["doc_count"] = floatPrecision.format(float(data["hits"]["total"]))
-        if "avg_score" in self.featureNames:
-          entry["avg_score"] = floatPrecision.format(float(avgScore))
-        if "max_term_frequency" in self.featureNames:
-          entry["max_term_frequency"] = floatPrecision.format(float(maxTermFrequency))
-        if "avg_term_frequency" in self.featureNames:
-          entry["avg_term_frequency"] = floatPrecision.format(float(avgTermFrequency))
-        # get additional features
-        for processorInstance in self.config["processor_instances"]:
-          processorInstance.extractFeatures(self.config, token, entry)
-
-        phraseData["_source"]["features"] = entry
-        if token in self.trainingDataset:
-          phraseData["_source"]["is_training"] = self.trainingDataset[token].strip()
-        if token in self.holdOutDataset:
-          phraseData["_source"]["is_holdout"] = self.holdOutDataset[token].strip()
-        self.esClient.index(index=self.processorIndex, doc_type=self.processorPhraseType, id=phraseId, body=phraseData["_source"])
-        self.worker.reply(message, {"phraseId": phraseId, "status" : "generated", "type" : "reply"}, 120000000)   
-      if message["content"]["type"] == "stop_dispatcher":
-        self.worker.reply(message, {"phraseId": -1, "status" : "stop_dispatcher", "type" : "stop_dispatcher"}, self.timeout)        
+  def __phraseQuery(self, token):
+    shouldMatch = map(lambda x: {"match_phrase":{x:token}}, self.corpusFields)
+    return {"bool":{"should":shouldMatch}}
 
-    self.logger.info("Terminating generation worker")
+  def __scrollHits(self, token):
+    data = self.esClient.search(index=self.corpusIndex, doc_type=self.corpusType, body={"query": self.__phraseQuery(token), "size": self.searchPageSize, "fields": []}, scroll="5m")
+    try:
+      while len(data["hits"]["hits"]) > 0:
+        for hit in data["hits"]["hits"]:
+          yield hit
+        data = self.esClient.scroll(scroll_id=data["_scroll_id"], scroll="5m")
+    finally:
+      try:
+        self.esClient.clear_scroll(scroll_id=data["_scroll_id"])
+      except:
+        pass
+
+  def __pages(self, hits):
+    page = []
+    for hit in hits:
+      page.append(hit)
+      if len(page) == self.searchPageSize:
+        yield page
+        page = []
+    if len(page) > 0: yield page
+
+  # positions of the terms of each phrase as the corpus fields analyze it, which is how a phrase query matches
+  # them: for each field, a list of (position relative to the first term, terms at that position)
+  def __analyzePhrases(self, tokens):
+    if len(tokens) == 0: return []
+    docs = map(lambda x: {"doc": dict(map(lambda y: (y, x), self.corpusFields)), "positions": True, "offsets": False, "payloads": False, "term_statistics": False, "field_statistics": False}, tokens)
+    response = self.esClient.mtermvectors(index=self.corpusIndex, doc_type=self.corpusType, body={"docs": docs})
+    phrasePatterns = []
+    for doc in response["docs"]:
+      patterns = {}
+      for field, positions in self.__termPositions(doc).iteritems():
+        if len(positions) == 0: continue
+        firstPosition = min(positions.keys())
+        patterns[field] = sorted(map(lambda x: (x[0] - firstPosition, x[1]), positions.iteritems()))
+      phrasePatterns.append(patterns)
+    return phrasePatterns
+
+  # returns the terms at each position of the corpus fields of the documents, keyed by document id
+  def __loadTermVectors(self, documentIds):
+    termVectors = {}
+    docs = map(lambda x: {"_id": x, "fields": self.corpusFields, "positions": True, "offsets": False, "payloads": False, "term_statistics": False, "field_statistics": False}, documentIds)
+    if len(docs) == 0: return termVectors
+    response = self.esClient.mtermvectors(index=self.corpusIndex, doc_type=self.corpusType, body={"docs": docs})
+    for doc in response["docs"]:
+      if doc.get("found", False):
+        termVectors[doc["_id"]] = self.__termPositions(doc)
+    return termVectors
+
+  def __termPositions(self, doc):
+    termPositions = {}
+    for field, vector in doc.get("term_vectors", {}).iteritems():
+      positions = {}
+      for term, info in vector["terms"].iteritems():
+        for termToken in info.get("tokens", []):
+          if "position" not in termToken:
+            raise Exception("Term vectors of field '" + field + "' have no positions")
+          positions.setdefault(termToken["position"], set()).add(term)
+      termPositions[field] = positions
+    return termPositions
+
+  # term frequency of the phrase in the hit, averaged over the fields that contain it (like the
+  # tf(freq=...) entries of an explanation). The phrase occurs wherever each of its terms is at its position
+  def __countTermFrequency(self, patterns, termPositions):
+    numOfScores = 0
+    termFrequency = 0
+    for field, pattern in patterns.iteritems():
+      if field not in termPositions: continue
+      positions = termPositions[field]
+      freq = 0
+      for position, terms in positions.iteritems():
+        if len(terms & pattern[0][1]) == 0: continue
+        if all(map(lambda x: len(positions.get(position + x[0], set()) & x[1]) > 0, pattern[1:])):
+          freq += 1
+      if freq > 0:
+        numOfScores += 1
+        termFrequency += freq
+    if numOfScores > 0: termFrequency = termFrequency * 1.0 / numOfScores
+    return termFrequency
 
   def unregisterDispatcher(self, dispatcher, message):
     if message == "dying":
       self.dispatchers.pop(dispatcher, None)
 
     if len(self.dispatchers) == 0:
-      self.worker.send(content="kill", to=self.workerName)
+      with self.messagePool.channelLock:
+        self.worker.send(content="kill", to=self.workerName)
@@ -0,0 +1,129 @@
+import fnmatch
+import threading
+
+__name__ = "local_redis"
+
+# Python implementations of the Lua scripts registered with register_script, keyed by script source.
+# They are called with the client, the keys and the arguments of the script.
+SCRIPTS = {}
+
+# In-memory Redis with the commands bayzee uses (hashes, sets, pipelines, scan and scripts), for runs
+# that keep every stage in one process. Commands are serialized with a lock, and a pipeline or a
+# script runs as a whole under it, the way Redis runs a transaction or a script.
+class LocalRedis:
+
+  def __init__(self):
+    self.data = {}
+    self.lock = threading.RLock()
+
+  def hgetall(self, key):
+    with self.lock:
+      return dict(self.data.get(key, {}))
+
+  def hget(self, key, field):
+    with self.lock:
+      return self.data.get(key, {}).get(field)
+
+  def hset(self, key, field, value):
+    with self.lock:
+      self.data.setdefault(key, {})[field] = str(value)
+
+  def hmset(self, key, mapping):
+    with self.lock:
+      for field, value in mapping.iteritems():
+        self.hset(key, field, value)
+      return True
+
+  def hincrby(self, key, field, amount = 1):
+    with self.lock:
+      value = int(self.data.setdefault(key, {}).get(field, 0)) + int(amount)
+      self.data[key][field] = str(value)
+      return value
+
+  def hincrbyfloat(self, key, field, amount = 1.0):
+    with self.lock:
+      value = float(self.data.setdefault(key, {}).get(field, 0)) + float(amount)
+      self.data[key][field] = repr(value)
+      return value
+
+  def sadd(self, key, *members):
+    with self.lock:
+      values = self.data.setdefault(key, set())
+      added = len(filter(lambda x: x not in values, set(members)))
+      values.update(members)
+      return added
+
+  def srem(self, key, *members):
+    with self.lock:
+      values = self.data.setdefault(key, set())
+      removed = len(filter(lambda x: x in values, set(members)))
+      values.difference_update(members)
+      return removed
+
+  def smembers(self, key):
+    with self.lock:
+      return set(self.data.get(key, set()))
+
+  def scard(self, key):
+    with self.lock:
+      return len(self.data.get(key, set()))
+
+  def sunionstore(self, destination, *keys):
+    with self.lock:
+      values = set()
+      for key in keys:
+        values.update(self.data.get(key, set()))
+      self.data[destination] = values
+      return len(values)
+
+  def sismember(self, key, member):
+    with self.lock:
+      return member in self.data.get(key, set())
+
+  def delete(self, *keys):
+    with self.lock:
+      for key in keys:
+        self.data.pop(key, None)
+
+  def scan_iter(self, match = None, count = None):
+    with self.lock:
+      keys = self.data.keys()
+    for key in keys:
+      if match == None or fnmatch.fnmatchcase(key, match):
+        yield key
+
+  def sscan_iter(self, key, match = None, count = None):
+    with self.lock:
+      members = list(self.data.get(key, set()))
+    for member in members:
+      if match == None or fnmatch.fnmatchcase(member, match):
+        yield member
+
+  def pipeline(self, transaction = True):
+    return LocalPipeline(self)
+
+  def register_script(self, script):
+    if script not in SCRIPTS:
+      raise Exception("Script is not supported by the local Redis client")
+    implementation = SCRIPTS[script]
+    client = self
+    def run(keys = [], args = []):
+      with client.lock:
+        return implementation(client, keys, args)
+    return run
+
+class LocalPipeline:
+
+  def __init__(self, client):
+    self.client = client
+    self.commands = []
+
+  def __getattr__(self, name):
+    method = getattr(self.client, name)
+    return lambda *args, **kwargs: self.commands.append((method, args, kwargs))
+
+  def execute(self):
+    with self.client.lock:
+      results = map(lambda x: x[0](*x[1], **x[2]), self.commands)
+    self.commands = []
+    return results
@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+
+__name__ = "lru_cache"
+
+# Least recently used cache bounded by both the number of entries and their total size in bytes.
+# Sizes are supplied by the caller, since only the caller knows how to estimate them cheaply.
+# It can be used from several threads at once.
+class LRUCache:
+
+  def __init__(self, maxItems, maxBytes):
+    self.lock = threading.RLock()
+    self.maxItems = maxItems
+    self.maxBytes = maxBytes
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return None
+      self.hits += 1
+      value, size = self.entries.pop(key)
+      self.entries[key] = (value, size)
+      return value
+
+  def put(self, key, value, size):
+    with self.lock:
+      self.remove(key)
+      if size > self.maxBytes or self.maxItems <= 0: return
+      self.entries[key] = (value, size)
+      self.bytes += size
+      while len(self.entries) > self.maxItems or self.bytes > self.maxBytes:
+        oldKey, (oldValue, oldSize) = self.entries.popitem(last=False)
+        self.bytes -= oldSize
+        self.evictions += 1
+
+  def remove(self, key):
+    with self.lock:
+      if key in self.entries:
+        value, size = self.entries.pop(key)
+        self.bytes -= size
+
+  def stats(self):
+    with self.lock:
+      return {"items": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,57 @@
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+__name__ = "message_pool"
+
+# Handles up to workerConcurrency messages of a worker at once, so that the Elasticsearch and Redis
+# requests of different messages overlap instead of the worker waiting on one request at a time. The
+# requests release the GIL while waiting on the network, so threads are enough to overlap them.
+# Sends, replies and closes are serialized with channelLock. The receiving thread calls receive outside
+# of it, since receive blocks until a message arrives, so a channel has to allow one receive alongside
+# the other calls: the local channels and muppet's channels keep their state in a queue and in Redis.
+# Processors are called from several threads at once and have to be thread-safe; CPU bound processor
+# work, like POS tagging, runs in the processor's own processes. With a concurrency of 1, messages are
+# handled in the receiving thread.
+class MessagePool:
+
+  def __init__(self, config):
+    self.logger = config["logger"]
+    self.concurrency = 1
+    if "workerConcurrency" in config: self.concurrency = max(config["workerConcurrency"], 1)
+    self.channelLock = threading.RLock()
+    self.pool = None
+    if self.concurrency > 1:
+      self.slots = threading.Semaphore(self.concurrency)
+      self.pool = ThreadPool(self.concurrency)
+
+  # blocks while workerConcurrency messages are being handled
+  def submit(self, handler, message):
+    if self.pool == None:
+      handler(message)
+      return
+    self.slots.acquire()
+    self.pool.apply_async(self.__handle, (handler, message))
+
+  def __handle(self, handler, message):
+    try:
+      handler(message)
+    except:
+      error = sys.exc_info()
+      self.logger.error("Error handling message " + str(message.get("requestId")) + ": " + str(error))
+    finally:
+      self.slots.release()
+
+  # waits until the messages being handled are done
+  def join(self):
+    if self.pool == None: return
+    for i in range(self.concurrency):
+      self.slots.acquire()
+    for i in range(self.concurrency):
+      self.slots.release()
+
+  def close(self):
+    if self.pool == None: return
+    self.join()
+    self.pool.close()
+    self.pool.join()
@@ -0,0 +1,179 @@
+import os
+import os.path
+import time
+import threading
+import BaseHTTPServer
+
+__name__ = "metrics"
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# labels is a sequence of (name, value) pairs
+def formatLabels(labels):
+  if len(labels) == 0: return ""
+  return "{" + ",".join(map(lambda x: x[0] + "=\"" + str(x[1]).replace("\\", "\\\\").replace("\"", "\\\"") + "\"", labels)) + "}"
+
+class Timer:
+
+  def __init__(self, metrics, name, labels):
+    self.metrics = metrics
+    self.name = name
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, errorType, error, traceback):
+    self.metrics.observe(self.name, time.time() - self.start, self.labels)
+    return False
+
+# Counters, gauges and latency histograms of one dispatcher or worker process. Every metric gets a
+# "stage" label, and they are written in the Prometheus text format to '<dir>/<stage>.<pid>.prom'
+# every 'flushInterval' seconds, and served over HTTP on 'port' when it is set.
+class Metrics:
+
+  def __init__(self, config, stage):
+    self.stage = stage
+    self.logger = config["logger"]
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+    self.startTime = time.time()
+    self.filePath = None
+    self.flushInterval = 10
+    self.port = 0
+    self.flushThread = None
+    self.server = None
+    if "metrics" in config:
+      if "dir" in config["metrics"]:
+        self.filePath = os.path.join(config["metrics"]["dir"], stage + "." + str(os.getpid()) + ".prom")
+      if "flushInterval" in config["metrics"]: self.flushInterval = config["metrics"]["flushInterval"]
+      if "port" in config["metrics"]: self.port = config["metrics"]["port"]
+
+  def __key(self, name, labels):
+    items = [("stage", self.stage)]
+    if labels != None: items += sorted(labels.items())
+    return (name, tuple(items))
+
+  def increment(self, name, value = 1, labels = None):
+    key = self.__key(name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def setGauge(self, name, value, labels = None):
+    key = self.__key(name, labels)
+    with self.lock:
+      self.gauges[key] = value
+
+  def observe(self, name, seconds, labels = None):
+    key = self.__key(name, labels)
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+      histogram = self.histograms[key]
+      for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+          histogram["buckets"][i] += 1
+          break
+      histogram["sum"] += seconds
+      histogram["count"] += 1
+
+  # times the enclosed block of a step of the stage, e.g. with metrics.timer("analyze"): ...
+  def timer(self, step, labels = None):
+    stepLabels = {"step": step}
+    if labels != None: stepLabels.update(labels)
+    return Timer(self, "bayzee_step_seconds", stepLabels)
+
+  # records a message handled by a worker
+  def recordBatch(self, seconds, processed, failed):
+    self.observe("bayzee_batch_seconds", seconds)
+    self.increment("bayzee_items_total", processed, {"status": "processed"})
+    self.increment("bayzee_items_total", failed, {"status": "failed"})
+
+  def render(self):
+    lines = []
+    with self.lock:
+      elapsed = max(time.time() - self.startTime, 0.001)
+      processed = 0
+      for (name, labels), value in self.counters.iteritems():
+        if name == "bayzee_items_total" and ("status", "processed") in labels: processed += value
+      gauges = dict(self.gauges)
+      gauges[self.__key("bayzee_items_per_second", None)] = processed / elapsed
+      gauges[self.__key("bayzee_uptime_seconds", None)] = elapsed
+      for metricType, metrics in [("counter", self.counters), ("gauge", gauges)]:
+        lastName = None
+        for (name, labels), value in sorted(metrics.iteritems()):
+          if name != lastName:
+            lines.append("# TYPE " + name + " " + metricType)
+            lastName = name
+          lines.append(name + formatLabels(labels) + " " + repr(value))
+      lastName = None
+      for (name, labels), histogram in sorted(self.histograms.iteritems()):
+        if name != lastName:
+          lines.append("# TYPE " + name + " histogram")
+          lastName = name
+        count = 0
+        for bound, bucketCount in zip(BUCKETS, histogram["buckets"]):
+          count += bucketCount
+          lines.append(name + "_bucket" + formatLabels(labels + (("le", repr(bound)),)) + " " + str(count))
+        lines.append(name + "_bucket" + formatLabels(labels + (("le", "+Inf"),)) + " " + str(histogram["count"]))
+        lines.append(name + "_sum" + formatLabels(labels) + " " + repr(histogram["sum"]))
+        lines.append(name + "_count" + formatLabels(labels) + " " + str(histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+  def flush(self):
+    if self.filePath == None: return
+    try:
+      if not os.path.exists(os.path.dirname(self.filePath)):
+        os.makedirs(os.path.dirname(self.filePath))
+      tempFilePath = self.filePath + ".tmp"
+      metricsFile = open(tempFilePath, "w")
+      metricsFile.write(self.render())
+      metricsFile.close()
+      os.rename(tempFilePath, self.filePath)
+    except:
+      self.logger.error("Failed to write metrics to '" + self.filePath + "'")
+
+  def start(self):
+    if self.filePath != None and self.flushThread == None:
+      self.flushThread = threading.Thread(target=self.__flushPeriodically)
+      self.flushThread.daemon = True
+      self.flushThread.start()
+    if self.port > 0 and self.server == None:
+      try:
+        self.server = BaseHTTPServer.HTTPServer(("", self.port), MetricsRequestHandler)
+      except:
+        self.logger.error("Failed to serve metrics on port " + str(self.port))
+        return
+      self.server.metrics = self
+      serverThread = threading.Thread(target=self.server.serve_forever)
+      serverThread.daemon = True
+      serverThread.start()
+      self.logger.info("Serving metrics on port " + str(self.port))
+
+  def stop(self):
+    self.flush()
+    if self.server != None:
+      self.server.shutdown()
+      self.server = None
+
+  def __flushPeriodically(self):
+    while True:
+      time.sleep(self.flushInterval)
+      self.flush()
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    body = self.server.metrics.render()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
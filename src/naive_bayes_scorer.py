@@ -0,0 +1,66 @@
+import numpy
+
+__name__ = "naive_bayes_scorer"
+
+# value no feature ever takes, used to get the probability nltk assigns to values not seen in training
+UNSEEN_VALUE = object()
+
+# Compact form of a trained nltk.NaiveBayesClassifier: for every feature, an array of base 2 log
+# probabilities indexed by label and by value (the last column is for values not seen in training).
+# Scores whole batches of feature sets with array operations and gives the same probabilities as
+# the classifier's prob_classify.
+class NaiveBayesScorer:
+
+  def __init__(self, classifier, featureNames):
+    self.labels = list(classifier.labels())
+    self.featureNames = featureNames
+    self.labelLogProbs = numpy.array(map(lambda x: classifier._label_probdist.logprob(x), self.labels))
+    self.valueIndexes = []
+    self.featureLogProbs = []
+    for featureName in featureNames:
+      values = set()
+      for label in self.labels:
+        if (label, featureName) in classifier._feature_probdist:
+          values.update(classifier._feature_probdist[label, featureName].samples())
+      valueIndexes = dict(map(lambda x: (x[1], x[0]), enumerate(values)))
+      logProbs = numpy.empty((len(self.labels), len(valueIndexes) + 1))
+      for i, label in enumerate(self.labels):
+        if (label, featureName) not in classifier._feature_probdist:
+          logProbs[i].fill(-numpy.inf)
+          continue
+        probDist = classifier._feature_probdist[label, featureName]
+        for value, j in valueIndexes.iteritems():
+          logProbs[i, j] = probDist.logprob(value)
+        logProbs[i, -1] = probDist.logprob(UNSEEN_VALUE)
+      self.valueIndexes.append(valueIndexes)
+      self.featureLogProbs.append(logProbs)
+
+  # returns an array with the index of every value in featureSets, one row per feature set
+  def encode(self, featureSets):
+    codes = numpy.empty((len(featureSets), len(self.featureNames)), dtype=numpy.intp)
+    for j, featureName in enumerate(self.featureNames):
+      valueIndexes = self.valueIndexes[j]
+      unseen = len(valueIndexes)
+      codes[:, j] = map(lambda x: valueIndexes.get(x[featureName], unseen), featureSets)
+    return codes
+
+  # returns an array with the probability of every label (in the order of self.labels), one row per feature set
+  def probabilities(self, featureSets):
+    codes = self.encode(featureSets)
+    logProbs = numpy.tile(self.labelLogProbs, (len(featureSets), 1))
+    for j in range(len(self.featureNames)):
+      logProbs += self.featureLogProbs[j][:, codes[:, j]].T
+    maxLogProbs = logProbs.max(axis=1)
+    # rows where every label is impossible get a uniform distribution, as in nltk
+    impossible = numpy.isneginf(maxLogProbs)
+    logProbs[impossible] = 0.0
+    maxLogProbs[impossible] = 0.0
+    probs = numpy.exp2(logProbs - maxLogProbs[:, numpy.newaxis])
+    return probs / probs.sum(axis=1)[:, numpy.newaxis]
+
+  # returns the probability of 'label' and the most probable label of every feature set
+  def score(self, featureSets, label):
+    if len(featureSets) == 0: return [], []
+    probs = self.probabilities(featureSets)
+    classTypes = map(lambda x: self.labels[x], probs.argmax(axis=1))
+    return probs[:, self.labels.index(label)].tolist(), classTypes
@@ -0,0 +1,91 @@
+import csv
+import re
+from elasticsearch import helpers
+from src import es_client
+from src.scroll_iterator import ScrollIterator
+
+__name__ = "phrase_labeler"
+
+# Applies the labels of the training and hold-out sets to the phrases. The csv files are streamed
+# and written with bulk partial updates keyed by phrase id, so relabeling doesn't need a new
+# generation. Labels of phrases that are no longer in a file are cleared.
+class PhraseLabeler:
+
+  def __init__(self, config, trainingFilePath, holdOutFilePath):
+    self.config = config
+    self.logger = config["logger"]
+    self.esClient = es_client.getClient(config)
+    self.labelFiles = [("is_training", trainingFilePath), ("is_holdout", holdOutFilePath)]
+    self.processorIndex = config["processor"]["index"]
+    self.processorPhraseType = config["processor"]["type"] + "__phrase"
+    self.processingPageSize = config["processingPageSize"]
+    self.bulkSize = 500
+    if "indexingBulkSize" in config: self.bulkSize = config["indexingBulkSize"]
+
+  def label(self):
+    for labelField, filePath in self.labelFiles:
+      labeledPhraseIds = self.__applyLabels(labelField, filePath)
+      self.__clearLabels(labelField, labeledPhraseIds)
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.logger.info("Terminating phrase labeler")
+
+  # returns ids of the phrases that were labeled
+  def __applyLabels(self, labelField, filePath):
+    phraseIds = set()
+    labelFile = open(filePath, "rb")
+    try:
+      actions = self.__labelActions(labelField, csv.reader(labelFile), phraseIds)
+      success, errors = helpers.bulk(self.esClient, actions, chunk_size=self.bulkSize, raise_on_error=False)
+    finally:
+      labelFile.close()
+    missing = 0
+    for error in errors:
+      result = error.values()[0]
+      phraseIds.discard(result["_id"])
+      if result["status"] == 404:
+        missing += 1
+      else:
+        self.logger.error("Error labeling phrase '" + result["_id"] + "': " + str(result))
+    self.logger.info("Applied " + labelField + " to " + str(success) + " phrases from '" + filePath + "', " + str(missing) + " phrases not found")
+    return phraseIds
+
+  def __labelActions(self, labelField, rows, phraseIds):
+    for i, row in enumerate(rows):
+      # header
+      if i == 0: continue
+      if len(row) < 2: continue
+      phrase = row[0].decode("utf-8").strip()
+      label = row[1].strip()
+      if label not in ["0", "1"]:
+        self.logger.error("Invalid label '" + label + "' for phrase '" + phrase + "' on line " + str(i + 1))
+        continue
+      phraseId = self.__keyify(phrase)
+      if len(phraseId) == 0: continue
+      phraseIds.add(phraseId)
+      yield {"_op_type": "update", "_index": self.processorIndex, "_type": self.processorPhraseType, "_id": phraseId, "doc": {labelField: label}}
+
+  def __clearLabels(self, labelField, labeledPhraseIds):
+    query = {"filtered":{"filter":{"exists":{"field":labelField}}}}
+    phrases = ScrollIterator(self.esClient, self.processorIndex, self.processorPhraseType, query, [{"phrase__not_analyzed":{"order":"asc"}}], self.processingPageSize, None, None)
+    actions = []
+    for firstIndex, phraseIds in phrases.pages():
+      for phraseId in phraseIds:
+        if phraseId not in labeledPhraseIds:
+          actions.append({"_op_type": "update", "_index": self.processorIndex, "_type": self.processorPhraseType, "_id": phraseId, "doc": {labelField: None}})
+    if len(actions) == 0: return
+    success, errors = helpers.bulk(self.esClient, actions, chunk_size=self.bulkSize, raise_on_error=False)
+    for error in errors:
+      result = error.values()[0]
+      self.logger.error("Error clearing " + labelField + " of phrase '" + result["_id"] + "': " + str(result))
+    self.logger.info("Cleared " + labelField + " of " + str(success) + " phrases")
+
+  # same ids as the annotation worker gives to phrases
+  def __keyify(self, phrase):
+    phrase = phrase.strip()
+    if len(phrase) == 0:
+      return ""
+    key = re.sub("[^A-Za-z0-9]", " ", phrase)
+    key = " ".join(phrase.split())
+    key = key.lower()
+    key = "-".join(phrase.split())
+    return key
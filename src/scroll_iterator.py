@@ -0,0 +1,67 @@
+__name__ = "scroll_iterator"
+
+# Streams document ids out of an Elasticsearch index page by page using a scroll cursor,
+# so every page costs the same no matter how deep into the index the iteration is.
+# Items are numbered from 0 in sort order and only items with startIndex <= n < endIndex are returned.
+class ScrollIterator:
+
+  def __init__(self, esClient, index, docType, query, sort, pageSize, startIndex, endIndex, scrollTimeout = "10m", fields = None, version = False):
+    self.esClient = esClient
+    self.index = index
+    self.docType = docType
+    self.query = query
+    self.sort = sort
+    self.pageSize = pageSize
+    self.startIndex = 0
+    if startIndex != None: self.startIndex = startIndex
+    self.endIndex = -1
+    if endIndex != None: self.endIndex = endIndex
+    self.scrollTimeout = scrollTimeout
+    self.fields = ["_id"]
+    if fields != None: self.fields = fields
+    self.version = version
+    self.scrollId = None
+
+  # yields (index of the first item in the page, list of ids in the page)
+  def pages(self):
+    for position, hits in self.hitPages():
+      yield position, map(lambda x: x["_id"], hits)
+
+  # yields (index of the first item in the page, list of hits in the page), hits have the requested
+  # fields and, when version is True, the version of the document
+  def hitPages(self):
+    position = 0
+    try:
+      hits = self.__search()
+      while len(hits) > 0:
+        if position + len(hits) > self.startIndex:
+          pageStart = max(self.startIndex - position, 0)
+          pageEnd = len(hits)
+          if self.endIndex != -1: pageEnd = min(pageEnd, self.endIndex - position)
+          if pageEnd > pageStart:
+            yield position + pageStart, hits[pageStart:pageEnd]
+        position += len(hits)
+        if self.endIndex != -1 and position >= self.endIndex: break
+        hits = self.__scroll()
+    finally:
+      self.__clear()
+
+  def __search(self):
+    body = {"size": self.pageSize, "query": self.query, "sort": self.sort}
+    if self.version: body["version"] = True
+    data = self.esClient.search(index=self.index, doc_type=self.docType, body=body, scroll=self.scrollTimeout, fields=self.fields)
+    self.scrollId = data["_scroll_id"]
+    return data["hits"]["hits"]
+
+  def __scroll(self):
+    data = self.esClient.scroll(scroll_id=self.scrollId, scroll=self.scrollTimeout)
+    self.scrollId = data["_scroll_id"]
+    return data["hits"]["hits"]
+
+  def __clear(self):
+    if self.scrollId == None: return
+    try:
+      self.esClient.clear_scroll(scroll_id=self.scrollId)
+    except:
+      pass
+    self.scrollId = None
@@ -0,0 +1,161 @@
+import unicodedata
+
+__name__ = "shingle_analyzer"
+
+# Generates the same shingles as the 'analyzer_shingle' analyzer that the annotation dispatcher
+# creates in Elasticsearch (standard tokenizer, lowercase filter and shingle filter), without a
+# network round-trip per field value. Tokens are returned in the format of the analyze API.
+
+ALETTER = "L"
+NUMERIC = "N"
+EXTEND_NUM_LET = "U"
+MID_LETTER = "ML"
+MID_NUM = "MN"
+MID_NUM_LET = "MNL"
+EXTEND = "E"
+IDEOGRAPHIC = "I"
+OTHER = "O"
+
+MID_LETTER_CHARS = u":\u00b7\u0387\u05f4\u2027\ufe13\ufe55\uff1a"
+MID_NUM_CHARS = u",;\u037e\u0589\u060c\u060d\u066c\u07f8\u2044\ufe10\ufe14\ufe50\ufe54\uff0c\uff1b"
+MID_NUM_LET_CHARS = u".'\u2018\u2019\u2024\ufe52\uff07\uff0e"
+
+FILLER_TOKEN = "_"
+TOKEN_SEPARATOR = " "
+
+# index settings of the 'analyzer_shingle' analyzer
+def getAnalyzerSettings(minShingleSize, maxShingleSize):
+  return {
+    "index":{
+      "analysis":{
+        "analyzer":{
+          "analyzer_shingle":{
+            "type": "custom",
+            "tokenizer": "standard",
+            "filter": ["standard", "lowercase", "filter_shingle"]
+          }
+        },
+        "filter":{
+          "filter_shingle":{
+            "type": "shingle",
+            "max_shingle_size": maxShingleSize,
+            "min_shingle_size": minShingleSize,
+            "output_unigrams": (minShingleSize == 1)
+          },
+          "filter_stop":{
+            "type": "stop"
+          }
+        }
+      }
+    }
+  }
+
+def __isIdeographic(char):
+  codePoint = ord(char)
+  return (0x3040 <= codePoint <= 0x309f) or (0x3400 <= codePoint <= 0x4dbf) or (0x4e00 <= codePoint <= 0x9fff) or (0xf900 <= codePoint <= 0xfaff)
+
+def getCharType(char):
+  if char in MID_NUM_LET_CHARS: return MID_NUM_LET
+  if char in MID_LETTER_CHARS: return MID_LETTER
+  if char in MID_NUM_CHARS: return MID_NUM
+  category = unicodedata.category(char)
+  if category == "Pc": return EXTEND_NUM_LET
+  if category in ("Mn", "Me", "Mc", "Cf"): return EXTEND
+  if category == "Nd": return NUMERIC
+  if category[0] == "L" or category == "Nl":
+    if __isIdeographic(char): return IDEOGRAPHIC
+    return ALETTER
+  return OTHER
+
+class ShingleAnalyzer:
+
+  def __init__(self, minShingleSize, maxShingleSize, maxTokenLength = 255):
+    self.minShingleSize = minShingleSize
+    self.maxShingleSize = maxShingleSize
+    self.outputUnigrams = (minShingleSize == 1)
+    self.maxTokenLength = maxTokenLength
+
+  # returns a list of (token, position) pairs, positions start at 0 and skip over tokens that are too long
+  def tokenize(self, text):
+    return self.__tokenize(text)[0]
+
+  def __tokenize(self, text):
+    if type(text) is str:
+      text = text.decode("utf-8")
+    tokens = []
+    position = -1
+    skippedPositions = 0
+    i = 0
+    length = len(text)
+    while i < length:
+      charType = getCharType(text[i])
+      if charType == IDEOGRAPHIC:
+        position += 1 + skippedPositions
+        skippedPositions = 0
+        tokens.append((text[i], position))
+        i += 1
+        continue
+      if charType not in (ALETTER, NUMERIC, EXTEND_NUM_LET):
+        i += 1
+        continue
+      start = i
+      lastType = charType
+      hasWordChar = charType != EXTEND_NUM_LET
+      i += 1
+      while i < length:
+        charType = getCharType(text[i])
+        if charType == EXTEND:
+          i += 1
+        elif charType in (ALETTER, NUMERIC, EXTEND_NUM_LET):
+          hasWordChar = hasWordChar or charType != EXTEND_NUM_LET
+          lastType = charType
+          i += 1
+        elif charType in (MID_LETTER, MID_NUM, MID_NUM_LET):
+          # a middle character only joins two letters or two digits
+          j = i + 1
+          while j < length and getCharType(text[j]) == EXTEND:
+            j += 1
+          if j >= length: break
+          nextType = getCharType(text[j])
+          joinsLetters = lastType == ALETTER and nextType == ALETTER and charType != MID_NUM
+          joinsNumbers = lastType == NUMERIC and nextType == NUMERIC and charType != MID_LETTER
+          if not joinsLetters and not joinsNumbers: break
+          i = j
+        else:
+          break
+      if not hasWordChar: continue
+      token = text[start:i]
+      if len(token) > self.maxTokenLength:
+        skippedPositions += 1
+        continue
+      position += 1 + skippedPositions
+      skippedPositions = 0
+      tokens.append((token.lower(), position))
+    # skippedPositions now holds the trailing holes, reported at the end of the token stream
+    return tokens, skippedPositions
+
+  def analyze(self, text):
+    tokens, trailingPositions = self.__tokenize(text)
+    if len(tokens) == 0:
+      return {"tokens": []}
+    # lay tokens out by position, filling holes with filler tokens
+    window = []
+    previousPosition = -1
+    for token, position in tokens:
+      for k in range(min(position - previousPosition - 1, self.maxShingleSize - 1)):
+        window.append(FILLER_TOKEN)
+      window.append(token)
+      previousPosition = position
+    for k in range(min(trailingPositions, self.maxShingleSize - 1)):
+      window.append(FILLER_TOKEN)
+
+    shingles = []
+    for start in range(len(window)):
+      if self.outputUnigrams and window[start] != FILLER_TOKEN:
+        shingles.append({"token": window[start], "position": start + 1, "type": "word"})
+      for size in range(max(self.minShingleSize, 2), self.maxShingleSize + 1):
+        if start + size > len(window): break
+        words = window[start:start + size]
+        if words.count(FILLER_TOKEN) == size: continue
+        shingles.append({"token": TOKEN_SEPARATOR.join(words), "position": start + 1, "type": "shingle"})
+    return {"tokens": shingles}
@@ -0,0 +1,155 @@
+import os
+import sys
+import time
+import threading
+import Queue
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.dispatch_window import DispatchWindow
+
+__name__ = "stream_dispatcher"
+
+# Sends the ids of new documents, read one per line from 'inputFile', to the stream workers as they
+# arrive. While workers are busy, ids are sent in batches of dispatchBatchSize, and when they are idle,
+# the ids that arrive within streamLinger seconds of each other go out together. Dispatching ends with
+# the input, once every document has been streamed or given up on.
+class StreamDispatcher:
+
+  def __init__(self, config, inputFile):
+    self.config = config
+    self.logger = config["logger"]
+    self.metrics = metrics.Metrics(config, "stream_dispatcher")
+    self.esClient = es_client.getClient(config, self.metrics)
+    self.inputFile = inputFile
+    self.processorIndex = config["processor"]["index"]
+    self.dispatchBatchSize = 1
+    if "dispatchBatchSize" in config: self.dispatchBatchSize = config["dispatchBatchSize"]
+    self.linger = 0.5
+    if "streamLinger" in config: self.linger = config["streamLinger"]
+    self.window = DispatchWindow(config, self.dispatchBatchSize)
+    # guards the window and the counters, which timeoutCallback updates from the channel's timeout thread
+    self.stateLock = threading.RLock()
+    self.totalDocumentsDispatched = 0
+    self.documentsStreamed = 0
+    self.documentsNotStreamed = 0
+    self.phrasesClassified = 0
+    # documents are streamed into an annotated corpus, with a trained model
+    if not self.esClient.indices.exists(self.processorIndex):
+      self.logger.error("Processor index '" + self.processorIndex + "' does not exist, run 'bin/dispatcher -a' first")
+      sys.exit(1)
+    # the replies of several stream dispatchers must not mix
+    self.dispatcherName = "bayzee.stream.dispatcher." + str(os.getpid())
+    self.workerName = "bayzee.stream.worker"
+    self.timeout = 600000
+    # document ids read from the input, None once it is exhausted
+    self.documentIds = Queue.Queue()
+    self.streamDispatcher = DurableChannel(self.dispatcherName, config, self.timeoutCallback)
+    self.controlChannel = RemoteChannel(self.dispatcherName, config)
+
+  def dispatchToStream(self):
+    self.metrics.start()
+    reader = threading.Thread(target=self.__readDocumentIds)
+    reader.daemon = True
+    reader.start()
+    pendingDocumentIds = []
+    ended = False
+    while not ended or len(pendingDocumentIds) > 0 or self.window.inFlight > 0:
+      if not ended:
+        ended = self.__collect(pendingDocumentIds)
+      # a partial batch is only sent when the workers would otherwise wait for it
+      if len(pendingDocumentIds) >= self.dispatchBatchSize or (len(pendingDocumentIds) > 0 and (ended or self.window.inFlight == 0)):
+        batch = pendingDocumentIds[:self.dispatchBatchSize]
+        del pendingDocumentIds[:self.dispatchBatchSize]
+        with self.stateLock:
+          self.totalDocumentsDispatched += len(batch)
+        self.metrics.increment("bayzee_dispatched_items_total", len(batch))
+        self.__send(batch)
+      elif self.window.inFlight > 0:
+        self.__receive()
+
+    self.controlChannel.send("dying")
+    self.streamDispatcher.end()
+    self.__terminate()
+
+  def __readDocumentIds(self):
+    for line in iter(self.inputFile.readline, ""):
+      documentId = line.strip()
+      if len(documentId) > 0: self.documentIds.put(documentId)
+    self.documentIds.put(None)
+
+  # moves the ids read so far to 'documentIds', returns whether the input is exhausted. While workers are idle,
+  # waits for the next id and collects the ids that arrive in the following streamLinger seconds
+  def __collect(self, documentIds):
+    wait = self.window.inFlight == 0 and len(documentIds) == 0
+    deadline = None
+    while len(documentIds) < self.dispatchBatchSize:
+      try:
+        if not wait: documentId = self.documentIds.get(False)
+        elif deadline == None: documentId = self.documentIds.get()
+        else: documentId = self.documentIds.get(True, max(deadline - time.time(), 0))
+      except Queue.Empty:
+        return False
+      if documentId == None: return True
+      documentIds.append(documentId)
+      if wait and deadline == None: deadline = time.time() + self.linger
+    return False
+
+  def __receive(self):
+    message = self.streamDispatcher.receive()
+    with self.stateLock:
+      if "documentIds" in message["content"]:
+        failedDocumentIds = message["content"]["failedDocumentIds"]
+        streamedDocumentIds = message["content"]["documentIds"]
+        self.documentsStreamed += len(streamedDocumentIds)
+        self.phrasesClassified += message["content"]["phrases"]
+        self.window.completed(len(streamedDocumentIds))
+        self.metrics.increment("bayzee_items_total", len(streamedDocumentIds), {"status": "processed"})
+        self.streamDispatcher.close(message)
+        self.logger.info("Streamed " + str(len(streamedDocumentIds)) + " documents - " + str(self.documentsStreamed) + "/" + str(self.totalDocumentsDispatched))
+        if len(failedDocumentIds) > 0:
+          self.logger.info("Failed to stream documents " + ", ".join(failedDocumentIds))
+          if message["content"]["count"] < 5:
+            self.metrics.increment("bayzee_retries_total", 1, {"reason": "failed"})
+            content = {"documentIds": failedDocumentIds, "type": "stream", "count": message["content"]["count"] + 1, "from": self.dispatcherName}
+            self.streamDispatcher.send(content, self.workerName, self.timeout)
+          else:
+            self.documentsNotStreamed += len(failedDocumentIds)
+            self.window.completed(len(failedDocumentIds))
+            self.metrics.increment("bayzee_items_total", len(failedDocumentIds), {"status": "failed"})
+
+      self.metrics.setGauge("bayzee_pending_items", self.totalDocumentsDispatched - self.documentsStreamed - self.documentsNotStreamed)
+      self.metrics.setGauge("bayzee_dispatch_window", self.window.size)
+
+  def __send(self, documentIds):
+    while self.window.isFull(len(documentIds)):
+      self.__receive()
+    self.logger.info("Dispatching " + str(len(documentIds)) + " documents starting at " + documentIds[0])
+    content = {"documentIds": documentIds, "type": "stream", "count": 1, "from": self.dispatcherName}
+    with self.stateLock:
+      with self.metrics.timer("send"):
+        self.streamDispatcher.send(content, self.workerName, self.timeout)
+      self.window.sent(len(documentIds))
+
+  def timeoutCallback(self, message):
+    self.logger.info("Message timed out: " + str(message))
+    with self.stateLock:
+      if message["content"]["count"] < 5:
+        message["content"]["count"] += 1
+        self.metrics.increment("bayzee_retries_total", 1, {"reason": "timeout"})
+        self.streamDispatcher.send(message["content"], self.workerName, self.timeout)
+      else:
+        self.logger.info("Giving up on documents " + ", ".join(message["content"]["documentIds"]))
+        self.documentsNotStreamed += len(message["content"]["documentIds"])
+        self.window.completed(len(message["content"]["documentIds"]))
+        self.metrics.increment("bayzee_items_total", len(message["content"]["documentIds"]), {"status": "failed"})
+
+  def __terminate(self):
+    self.logger.info(str(self.totalDocumentsDispatched) + " total dispatched")
+    self.logger.info(str(self.documentsStreamed) + " streamed")
+    self.logger.info(str(self.documentsNotStreamed) + " failed to stream")
+    self.logger.info(str(self.phrasesClassified) + " phrases classified")
+    self.logger.info("Streaming complete")
+    self.logger.info("Elasticsearch requests: " + es_client.formatStats(self.esClient))
+    self.metrics.stop()
+    self.logger.info("Terminating stream dispatcher")
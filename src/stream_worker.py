@@ -0,0 +1,92 @@
+import sys
+import time
+from src.transport import DurableChannel, RemoteChannel
+from src import es_client
+from src import metrics
+from src.message_pool import MessagePool
+from src.annotation_worker import AnnotationWorker
+from src.generation_worker import GenerationWorker
+from src.classification_worker import ClassificationWorker
+
+__name__ = "stream_worker"
+
+# Takes each batch of documents through annotation, generation and classification at once, so that the
+# phrases of new documents are classified within seconds instead of after three runs over the corpus.
+# The phrases a batch shares with earlier documents are generated and classified again, and writing
+# them is idempotent: phrases are created if absent, and their features and class are overwritten.
+class StreamWorker:
+
+  def __init__(self, config):
+    self.config = config
+    self.logger = config["logger"]
+    self.metrics = metrics.Metrics(config, "stream_worker")
+    self.messagePool = MessagePool(config)
+    self.annotationWorker = AnnotationWorker(config, self.metrics, self.messagePool)
+    self.generationWorker = GenerationWorker(config, self.metrics, self.messagePool)
+    self.classificationWorker = ClassificationWorker(config, self.metrics, self.messagePool)
+    self.workerName = "bayzee.stream.worker"
+    self.timeout = 6000
+    self.dispatchers = {}
+    self.worker = None
+
+  def stream(self):
+    self.worker = DurableChannel(self.workerName, self.config)
+    self.metrics.start()
+    while True:
+      message = self.worker.receive()
+      if message["content"] == "kill":
+        message["responseId"] = message["requestId"]
+        with self.messagePool.channelLock:
+          self.worker.close(message)
+        if len(self.dispatchers) == 0:
+          # replies of the messages being handled are sent before the channel ends
+          self.messagePool.close()
+          self.worker.end()
+          break
+        else:
+          with self.messagePool.channelLock:
+            self.worker.send(content="kill", to=self.workerName)
+          continue
+      elif message["content"]["type"] == "stream":
+        if message["content"]["from"] not in self.dispatchers:
+          self.dispatchers[message["content"]["from"]] = RemoteChannel(message["content"]["from"], self.config)
+          self.dispatchers[message["content"]["from"]].listen(self.unregisterDispatcher)
+        self.messagePool.submit(self.__streamMessage, message)
+
+    for stageWorker in [self.annotationWorker, self.generationWorker, self.classificationWorker]:
+      self.logger.info("Elasticsearch requests of " + stageWorker.workerName + ": " + es_client.formatStats(stageWorker.esClient))
+    self.metrics.stop()
+    self.logger.info("Terminating stream worker")
+
+  # a document is streamed when it is annotated and all of its phrases are generated and classified
+  def __streamMessage(self, message):
+    start = time.time()
+    with self.metrics.timer("annotate"):
+      annotatedDocumentIds, failedDocumentIds, documentPhraseIds = self.annotationWorker.annotateBatch(message["content"]["documentIds"])
+    phraseIds = set()
+    for documentId in annotatedDocumentIds:
+      phraseIds.update(documentPhraseIds.get(documentId, []))
+    with self.metrics.timer("generate"):
+      generatedPhraseIds, failedPhraseIds = self.generationWorker.generateBatch(sorted(phraseIds))
+    with self.metrics.timer("classify"):
+      classifiedPhraseIds, failedClassPhraseIds = self.classificationWorker.classifyBatch(generatedPhraseIds)
+    failedPhraseIds = set(failedPhraseIds + failedClassPhraseIds)
+    streamedDocumentIds = []
+    for documentId in annotatedDocumentIds:
+      if len(failedPhraseIds.intersection(documentPhraseIds.get(documentId, []))) > 0:
+        failedDocumentIds.append(documentId)
+      else:
+        streamedDocumentIds.append(documentId)
+    self.logger.info("Streamed " + str(len(streamedDocumentIds)) + " documents, classified " + str(len(classifiedPhraseIds)) + " of their phrases")
+    self.metrics.recordBatch(time.time() - start, len(streamedDocumentIds), len(failedDocumentIds))
+    with self.metrics.timer("reply"):
+      with self.messagePool.channelLock:
+        self.worker.reply(message, {"documentIds": streamedDocumentIds, "failedDocumentIds": failedDocumentIds, "phrases": len(classifiedPhraseIds), "count": message["content"]["count"], "status" : "streamed", "type" : "reply"}, self.timeout)
+
+  def unregisterDispatcher(self, dispatcher, message):
+    if message == "dying":
+      self.dispatchers.pop(dispatcher, None)
+
+    if len(self.dispatchers) == 0:
+      with self.messagePool.channelLock:
+        self.worker.send(content="kill", to=self.workerName)
@@ -0,0 +1,150 @@
+import copy
+import time
+import threading
+import Queue
+from src.local_redis import LocalRedis
+
+__name__ = "transport"
+
+# Channels and Redis client of the dispatchers and workers. With the default "muppet" transport, they
+# talk through muppet channels and a Redis server and can run in separate processes on different boxes.
+# With the "local" transport, they run in one process and talk through in-memory queues and an
+# in-memory Redis, with the same message, reply, retry and timeout semantics.
+
+# returns the DurableChannel 'name' of the configured transport
+def DurableChannel(name, config, timeoutCallback = None):
+  if __isLocal(config):
+    return LocalDurableChannel(name, config, timeoutCallback)
+  import muppet
+  return muppet.DurableChannel(name, config, timeoutCallback)
+
+# returns the RemoteChannel 'name' of the configured transport
+def RemoteChannel(name, config):
+  if __isLocal(config):
+    return LocalRemoteChannel(name, config)
+  import muppet
+  return muppet.RemoteChannel(name, config)
+
+def getRedisClient(config):
+  if __isLocal(config):
+    return getLocalBroker().redisClient
+  import redis
+  return redis.StrictRedis(host=config["redis"]["host"], port=config["redis"]["port"])
+
+def __isLocal(config):
+  return "transport" in config and config["transport"] == "local"
+
+localBroker = None
+localBrokerLock = threading.Lock()
+
+# the broker shared by the local channels of the process
+def getLocalBroker():
+  global localBroker
+  with localBrokerLock:
+    if localBroker == None: localBroker = LocalBroker()
+    return localBroker
+
+# Queues and listeners of the local channels. A message that was sent with a timeout stays pending
+# until it is replied to or closed, and when it times out, the timeout callback of its sender gets it.
+class LocalBroker:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.queues = {}
+    self.listeners = {}
+    # pending messages by request id, with their deadline and sender
+    self.pending = {}
+    self.nextRequestId = 0
+    self.redisClient = LocalRedis()
+
+  def queue(self, name):
+    with self.lock:
+      if name not in self.queues: self.queues[name] = Queue.Queue()
+      return self.queues[name]
+
+  def send(self, content, to, sender, timeout, responseId = None):
+    with self.lock:
+      self.nextRequestId += 1
+      message = {"requestId": self.nextRequestId, "content": copy.deepcopy(content), "from": sender.name}
+      if responseId != None: message["responseId"] = responseId
+      if timeout != None and sender.timeoutCallback != None:
+        self.pending[message["requestId"]] = (time.time() + timeout / 1000.0, sender, message)
+    self.queue(to).put(message)
+
+  def complete(self, requestId):
+    with self.lock:
+      self.pending.pop(requestId, None)
+
+  # calls the timeout callbacks of the messages of 'sender' past their deadline
+  def expire(self, sender):
+    now = time.time()
+    expired = []
+    with self.lock:
+      for requestId, entry in self.pending.items():
+        if entry[1] == sender and entry[0] <= now:
+          expired.append(entry[2])
+          del self.pending[requestId]
+    for message in expired:
+      sender.timeoutCallback(copy.deepcopy(message))
+
+  def listen(self, name, callback):
+    with self.lock:
+      self.listeners.setdefault(name, []).append(callback)
+
+  def broadcast(self, name, message):
+    with self.lock:
+      callbacks = list(self.listeners.get(name, []))
+    for callback in callbacks:
+      callback(name, message)
+
+class LocalDurableChannel:
+
+  def __init__(self, name, config, timeoutCallback = None):
+    self.name = name
+    self.broker = getLocalBroker()
+    self.timeoutCallback = timeoutCallback
+    # milliseconds between two checks for timed out messages
+    self.monitorFrequency = 1000
+    if "timeoutMonitorFrequency" in config: self.monitorFrequency = config["timeoutMonitorFrequency"]
+    self.ended = threading.Event()
+    if self.timeoutCallback != None:
+      monitor = threading.Thread(target=self.__monitorTimeouts)
+      monitor.daemon = True
+      monitor.start()
+
+  def send(self, content, to, timeout = None):
+    self.broker.send(content, to, self, timeout)
+
+  def receive(self):
+    # waits in slices, so that the process still gets signals
+    while True:
+      try:
+        return self.broker.queue(self.name).get(True, 1)
+      except Queue.Empty:
+        pass
+
+  def reply(self, message, content, timeout = None):
+    self.broker.complete(message["requestId"])
+    self.broker.send(content, message["from"], self, timeout, message["requestId"])
+
+  def close(self, message):
+    self.broker.complete(message["requestId"])
+
+  def end(self):
+    self.ended.set()
+
+  def __monitorTimeouts(self):
+    while not self.ended.wait(self.monitorFrequency / 1000.0):
+      self.broker.expire(self)
+
+class LocalRemoteChannel:
+
+  def __init__(self, name, config):
+    self.name = name
+    self.broker = getLocalBroker()
+
+  def send(self, message):
+    self.broker.broadcast(self.name, message)
+
+  def listen(self, callback):
+    self.broker.listen(self.name, callback)
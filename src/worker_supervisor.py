@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import signal
+
+__name__ = "worker_supervisor"
+
+# Runs numWorkers worker processes of one stage on a box. The config, processor modules and their
+# models are loaded once by the supervisor, and forked worker processes share them copy-on-write.
+# A worker that crashes is started again after workerRestartDelay seconds. A worker that exits
+# normally, after receiving the "kill" message once its dispatchers are gone, is not, and the
+# supervisor exits when all of its workers have. SIGTERM and SIGINT are forwarded to the workers.
+class WorkerSupervisor:
+
+  def __init__(self, config, stage, createWorker, runWorker, numWorkers):
+    self.config = config
+    self.logger = config["logger"]
+    self.stage = stage
+    self.createWorker = createWorker
+    self.runWorker = runWorker
+    self.numWorkers = numWorkers
+    self.restartDelay = 1
+    if "workerRestartDelay" in config: self.restartDelay = config["workerRestartDelay"]
+    # worker index of every running worker process
+    self.workers = {}
+    self.stopping = False
+
+  def supervise(self):
+    for processorInstance in self.config["processor_instances"]:
+      if hasattr(processorInstance, "preload"):
+        processorInstance.preload(self.config)
+    signal.signal(signal.SIGTERM, self.__stop)
+    signal.signal(signal.SIGINT, self.__stop)
+    for index in range(self.numWorkers):
+      self.__start(index)
+    self.logger.info("Started " + str(self.numWorkers) + " " + self.stage + " workers")
+
+    while len(self.workers) > 0:
+      try:
+        pid, status = os.wait()
+      except OSError:
+        # interrupted by a signal
+        continue
+      if pid not in self.workers: continue
+      index = self.workers.pop(pid)
+      if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        self.logger.info(self.stage + " worker " + str(index) + " (pid " + str(pid) + ") finished")
+      elif self.stopping:
+        self.logger.info(self.stage + " worker " + str(index) + " (pid " + str(pid) + ") stopped")
+      else:
+        self.logger.error(self.stage + " worker " + str(index) + " (pid " + str(pid) + ") crashed with " + self.__describe(status) + ", restarting it")
+        time.sleep(self.restartDelay)
+        if not self.stopping: self.__start(index)
+    self.logger.info("Terminating " + self.stage + " worker supervisor")
+
+  def __start(self, index):
+    pid = os.fork()
+    if pid != 0:
+      self.workers[pid] = index
+      return
+    # worker process
+    exitCode = 1
+    try:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.default_int_handler)
+      # every worker of the box serves its metrics on its own port
+      if "metrics" in self.config and "port" in self.config["metrics"] and self.config["metrics"]["port"] != 0:
+        self.config["metrics"]["port"] += index
+      self.runWorker(self.createWorker())
+      exitCode = 0
+    except SystemExit as error:
+      if error.code == None: exitCode = 0
+      elif type(error.code) is int: exitCode = error.code
+    except KeyboardInterrupt:
+      pass
+    except:
+      error = sys.exc_info()
+      self.logger.error(self.stage + " worker " + str(index) + " failed: " + str(error))
+    finally:
+      # skip the supervisor's exit handlers
+      os._exit(exitCode)
+
+  def __stop(self, signalNumber, frame):
+    self.stopping = True
+    for pid in self.workers.keys():
+      try:
+        os.kill(pid, signalNumber)
+      except OSError:
+        pass
+
+  def __describe(self, status):
+    if os.WIFSIGNALED(status): return "signal " + str(os.WTERMSIG(status))
+    return "exit code " + str(os.WEXITSTATUS(status))
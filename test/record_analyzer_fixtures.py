@@ -0,0 +1,42 @@
+import sys
+import os
+import json
+import yaml
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src import es_client
+from src import shingle_analyzer
+
+# Records the tokens Elasticsearch's 'analyzer_shingle' analyzer returns for the texts of
+# fixtures/analyzer_shingle.json, with the cluster of the config file:
+#   python test/record_analyzer_fixtures.py <path-to-config-file>
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "analyzer_shingle.json")
+ANALYZER_INDEX = "bayzee__analyzer_fixtures__"
+
+if len(sys.argv) != 2:
+  print "Invalid number of arguments passed, please see README for usage"
+  sys.exit(1)
+
+configFile = open(sys.argv[1], "r")
+config = yaml.load(configFile)
+configFile.close()
+esClient = es_client.createClient(config)
+fixtureFile = open(FIXTURES_PATH, "r")
+fixtures = json.load(fixtureFile)
+fixtureFile.close()
+
+if esClient.indices.exists(ANALYZER_INDEX):
+  esClient.indices.delete(ANALYZER_INDEX)
+esClient.indices.create(ANALYZER_INDEX, shingle_analyzer.getAnalyzerSettings(fixtures["min_shingle_size"], fixtures["max_shingle_size"]))
+try:
+  for case in fixtures["cases"]:
+    response = esClient.indices.analyze(index=ANALYZER_INDEX, body=case["text"].encode("utf-8"), analyzer=fixtures["analyzer"])
+    case["tokens"] = map(lambda x: x["token"], response["tokens"])
+finally:
+  esClient.indices.delete(ANALYZER_INDEX)
+fixtures["recorded_from"] = "elasticsearch " + esClient.info()["version"]["number"]
+
+fixtureFile = open(FIXTURES_PATH, "w")
+fixtureFile.write(json.dumps(fixtures, indent=2, separators=(",", ": ")) + "\n")
+fixtureFile.close()
@@ -0,0 +1,68 @@
+import os
+import logging
+import unittest
+from bench.fake_elasticsearch import FakeElasticsearch
+from src.shingle_analyzer import ShingleAnalyzer
+from src.generation_worker import GenerationWorker
+
+FEATURE_NAMES = ["max_score", "doc_count", "avg_score", "max_term_frequency", "avg_term_frequency"]
+STOP_WORDS = ["a", "and", "for", "of", "the"]
+
+# analyzes like a field mapped with the stop and a crude plural stemming filter: stop words leave a
+# hole in the positions and the terms differ from the words of the text
+def analyzeStemmed(text):
+  tokens = []
+  for word, position in ShingleAnalyzer(2, 3).tokenize(text):
+    if word in STOP_WORDS: continue
+    if len(word) > 3 and word.endswith("s"): word = word[:-1]
+    tokens.append((word, position))
+  return tokens
+
+DOCUMENTS = [
+  ("doc-1", {"description": "Red shoes for the runner, red shoe laces and red shoes"}),
+  ("doc-2", {"description": "State of the art running shoes"}),
+  ("doc-3", {"description": ["State of art runners", "the state of the art red shoe"]}),
+  ("doc-4", {"description": "Runners love state in art, art runners"}),
+  ("doc-5", {"description": "Nothing to see here"})
+]
+PHRASES = ["red shoes", "state of the art", "art runners", "running shoes", "shoe laces", "state of art", "runners"]
+
+# Checks that the "batched" feature mode, which reads term frequencies from term vectors, generates the
+# same features as the default mode, which reads them from explanations, when the corpus field is not
+# analyzed like the phrases
+class FeatureModesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.esClient = FakeElasticsearch(2, 3, {"description": analyzeStemmed})
+    self.esClient.load("corpus", "document", DOCUMENTS)
+    self.esClient.load("processor", "document__phrase", map(lambda x: (x.replace(" ", "-"), {"phrase": x, "phrase__not_analyzed": x, "document_id": "doc-1"}), PHRASES))
+    logger = logging.getLogger("bayzee.test")
+    logger.addHandler(logging.NullHandler())
+    self.config = {
+      "logger": logger,
+      "es_client": self.esClient,
+      "es_client_pid": os.getpid(),
+      "corpus": {"index": "corpus", "type": "document", "text_fields": ["description"]},
+      "processor": {"index": "processor", "type": "document", "modules": []},
+      "processor_instances": [],
+      "generator": {"features": map(lambda x: {"name": x}, FEATURE_NAMES), "floatPrecision": 4, "minShingleSize": 2, "maxShingleSize": 3, "searchPageSize": 2}
+    }
+
+  def __generate(self, featureMode):
+    self.config["generator"]["featureMode"] = featureMode
+    phraseIds = map(lambda x: x.replace(" ", "-"), PHRASES)
+    generatedPhraseIds, failedPhraseIds = GenerationWorker(self.config).generateBatch(phraseIds)
+    self.assertEqual(failedPhraseIds, [])
+    phrases = self.esClient.store["processor"]["document__phrase"]
+    return dict(map(lambda x: (x, dict(phrases[x]["features"])), phraseIds))
+
+  def testBatchedFeaturesMatchExplainedFeatures(self):
+    explained = self.__generate("search")
+    batched = self.__generate("batched")
+    tolerance = 10 ** -self.config["generator"]["floatPrecision"]
+    for phraseId in explained:
+      for featureName in FEATURE_NAMES:
+        self.assertAlmostEqual(float(batched[phraseId][featureName]), float(explained[phraseId][featureName]), delta=tolerance, msg=phraseId + " " + featureName)
+    # stemming and stop words change the frequencies, so counting the words of the text would not match
+    self.assertEqual(float(explained["red-shoes"]["max_term_frequency"]), 3.0)
+    self.assertEqual(float(explained["state-of-the-art"]["doc_count"]), 3.0)
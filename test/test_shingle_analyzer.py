@@ -0,0 +1,39 @@
+import os
+import json
+import unittest
+from src.shingle_analyzer import ShingleAnalyzer
+from src.annotation_worker import AnnotationWorker
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# the phrases the annotation worker keeps from the tokens of an analyze response
+def getPhrases(tokens):
+  replaceUnderscore = AnnotationWorker._AnnotationWorker__replaceUnderscore.im_func
+  filterTokens = AnnotationWorker._AnnotationWorker__filterTokens.im_func
+  shingles = map(lambda x: replaceUnderscore(None, {"token": x}), tokens)
+  return map(lambda x: x["token"], filter(lambda x: filterTokens(None, x), shingles))
+
+# Checks the local shingle analyzer against the tokens Elasticsearch's 'analyzer_shingle' analyzer returns
+# for texts with punctuation, apostrophes, numbers with separators, unicode, stop words and filler tokens.
+# They are kept in fixtures/analyzer_shingle.json, which test/record_analyzer_fixtures.py records from a cluster.
+# Until they are recorded, the tokens in it are placeholders and the test is skipped.
+class ShingleAnalyzerTest(unittest.TestCase):
+
+  def setUp(self):
+    fixtureFile = open(os.path.join(FIXTURES_DIR, "analyzer_shingle.json"), "r")
+    self.fixtures = json.load(fixtureFile)
+    fixtureFile.close()
+    if self.fixtures["recorded_from"] == None:
+      self.skipTest("fixtures/analyzer_shingle.json was not recorded from Elasticsearch, run test/record_analyzer_fixtures.py")
+    self.analyzer = ShingleAnalyzer(self.fixtures["min_shingle_size"], self.fixtures["max_shingle_size"])
+
+  def __tokens(self, text):
+    return map(lambda x: x["token"], self.analyzer.analyze(text)["tokens"])
+
+  def testTokens(self):
+    for case in self.fixtures["cases"]:
+      self.assertEqual(self.__tokens(case["text"]), case["tokens"], case["name"])
+
+  def testPhrases(self):
+    for case in self.fixtures["cases"]:
+      self.assertEqual(getPhrases(self.__tokens(case["text"])), getPhrases(case["tokens"]), case["name"])